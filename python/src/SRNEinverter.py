@@ -1,11 +1,25 @@
+import math
+from contextlib import contextmanager
 from enum import Enum
 from threading import Lock
-from time import sleep
-from typing import Union
+from time import monotonic, perf_counter, time
+from typing import Any, Iterable, Iterator, Optional, Union
 
 import minimalmodbus
-
-from srnecommands import BATTERY_VOLTAGE, INVERTER_COMMANDS
+from bustiming import BusTiming
+from capture import CaptureSerial, CaptureWriter
+from metrics import Counter, Histogram
+from readplanner import (
+    ReadBlock,
+    decode_block,
+    encode_register,
+    plan_reads,
+    plan_writes,
+)
+from readresult import Quality, ReadError, ReadResult, error_quality
+from registercache import RegisterCache
+from registermap import DEFAULT_MAP, READ_FUNCTION_CODE, RegisterMap, load_register_map
+from validator import validate_command
 
 
 class Units(Enum):
@@ -37,9 +51,36 @@ class BatteryType(Enum):
     LFP = 4
     NCA = 5
 
-BATTERY_SETUP_MULTIPLIER = int(BATTERY_VOLTAGE/12)
+BATTERY_SETUP_MULTIPLIER = DEFAULT_MAP.parameters['batteryMultiplier']
 Number = Union[int, float]
 
+# Seconds past its cache TTL a value is still served, flagged stale, when reading it fails
+STALE_GRACE = 60
+# Block plans kept per inverter, keyed by the set of commands read
+PLAN_CACHE_SIZE = 64
+
+# Commands read by get_record(), fetched together with block reads, in record order
+RECORD_COMMANDS = DEFAULT_MAP.record_commands
+
+# Bus instrumentation exported by GET /metrics, labelled by serial port and slave address
+REQUEST_LATENCY = Histogram('srne_modbus_request_seconds', "Duration of Modbus transactions by start register",
+                            ('port', 'slave', 'operation', 'register'))
+LOCK_WAIT = Histogram('srne_lock_wait_seconds', "Time spent waiting for the inverter lock", ('port', 'slave'))
+BUS_ERRORS = Counter('srne_modbus_errors', "Failed Modbus transactions by error type",
+                     ('port', 'slave', 'operation', 'type'))
+
+
+def error_type(error: IOError) -> str:
+    """Metric label of a failed transaction, invalid_response covers CRC errors"""
+    if isinstance(error, minimalmodbus.NoResponseError):
+        return 'timeout'
+    if isinstance(error, minimalmodbus.InvalidResponseError):
+        return 'invalid_response'
+    if isinstance(error, minimalmodbus.SlaveReportedException):
+        return 'slave_exception'
+    return 'io'
+
+
 # region SRNE Inverter Class
 
 
@@ -50,41 +91,154 @@ class SRNEInverter():
     """
     # region Private
 
-    def __init__(self, deviceid: str, baudrate: int = 9600, slaveaddress: int = 1, debug: bool = False, serialtimeout: int = 1) -> None:
-        instr = minimalmodbus.Instrument(deviceid, slaveaddress)
+    def __init__(
+        self,
+        deviceid: str,
+        baudrate: int = 9600,
+        slaveaddress: int = 1,
+        debug: bool = False,
+        serialtimeout: int = 1,
+        cache_ttl: Optional[dict[int, float]] = None,
+        bus_timing: Optional[BusTiming] = None,
+        model: Optional[str] = None,
+        transport: Optional[Any] = None,
+        capture: Optional[CaptureWriter] = None,
+    ) -> None:
+        """Inverters sharing a serial port should share its bus_timing
+        model selects the register map variant by model name ('HF2430S80-H') or battery voltage ('48V')
+        transport is a serial port like object used instead of opening deviceid, such as capture.ReplaySerial or supervisor.SerialSupervisor
+        capture records the frames of every transaction
+        """
+        instr = minimalmodbus.Instrument(transport if transport is not None else deviceid, slaveaddress)
+        self._capture: Optional[CaptureSerial] = None
+        if capture is not None:
+            instr.serial = self._capture = CaptureSerial(instr.serial, capture)
         instr.serial.baudrate = baudrate
         instr.serial.timeout = serialtimeout
         instr.debug = debug
         self._instrument = instr
         self._lock = Lock()
+        self._timing = bus_timing if bus_timing is not None else BusTiming(baudrate)
+        self._map = DEFAULT_MAP if model is None else load_register_map(model)
+        self._commands = self._map.commands
+        self._plans: dict[frozenset[str], list[ReadBlock]] = {}
+        self._cache = RegisterCache(cache_ttl, self._map.freshness)
+        self._raw: dict[int, int] = {}
+        self._raw_times: dict[int, float] = {}  # monotonic time each raw word was read
+        self._read_keys: dict[int, list[str]] = {}
+        for register in self._map.registers.values():
+            if register.functioncode == READ_FUNCTION_CODE:
+                self._read_keys.setdefault(register.address, []).append(register.key)
+        self._labels = (deviceid, str(slaveaddress))
+
+    @contextmanager
+    def _transaction(self, operation: str, register: int) -> Iterator[None]:
+        """Hold the lock and the bus for one request, recording lock wait, latency and errors"""
+        requested = perf_counter()
+        with self._lock:
+            LOCK_WAIT.observe(perf_counter() - requested, self._labels)
+            with self._timing.transaction():
+                started = perf_counter()
+                outcome = 'io'
+                try:
+                    yield
+                    outcome = 'ok'
+                except IOError as e:
+                    outcome = error_type(e)
+                    BUS_ERRORS.inc((*self._labels, operation, outcome))
+                    raise
+                finally:
+                    REQUEST_LATENCY.observe(perf_counter() - started, (*self._labels, operation, hex(register)))
+                    if self._capture is not None:
+                        self._capture.commit(outcome)
 
     def _write_register(self, value: Number, register: int, decimals: int = 0, functioncode: int = 6, signed: bool = False) -> bool:
-        with self._lock:
-            sleep(0.1)
-            try:
+        try:
+            with self._transaction('write', register):
                 self._instrument.write_register(
                     register, value, decimals, functioncode, signed)
-                return True
-            except IOError:
-                return False
-
-    def _read_register(self, register: int, decimals: int, functioncode: int = 3, signed: bool = False) -> Number:
-        with self._lock:
-            sleep(0.1)
-            try:
-                value = self._instrument.read_register(
-                    register, decimals, functioncode, signed)
-                return value
-            except IOError:
-                return -10
+            return True
+        except IOError:
+            return False
+
+    def _read_registers(self, register: int, count: int, functioncode: int = 3) -> list[int]:
+        """Raises IOError when the read fails"""
+        with self._transaction('read', register):
+            return self._instrument.read_registers(register, count, functioncode)
+
+    def _read_command(self, key: str) -> Number:
+        """Read a single command, served from the cache if present
+        Raises ReadError when no value is available
+        """
+        result = self.read_results([key])[key]
+        if result.value is None:
+            raise ReadError(key, result.quality)
+        return result.value
+
+    def _failed_result(self, key: str, quality: Quality) -> ReadResult:
+        """The last good value flagged stale while it is recent enough, else no value"""
+        last = self._cache.last(key)
+        if last is not None and last[1] <= self._cache.ttl(key) + STALE_GRACE:
+            return ReadResult(last[0], Quality.STALE, time() - last[1])
+        return ReadResult(None, quality)
+
+    def _store_words(self, register: int, words: list[int]) -> None:
+        now = monotonic()
+        for address, word in enumerate(words, register):
+            self._raw[address] = word
+            self._raw_times[address] = now
+
+    def _forget_words(self, register: int, count: int) -> None:
+        """Drop the raw words and cached values of registers that changed or failed to read"""
+        for address in range(register, register + count):
+            self._raw.pop(address, None)
+            self._raw_times.pop(address, None)
+            for key in self._read_keys.get(address, ()):
+                self._cache.invalidate(key)
+
+    def _write_command(self, key: str, value: Number) -> bool:
+        """Write a command and drop the cached value of the matching read command"""
+        if not self._write_register(value, *self._commands[key]):
+            return False
+        self._forget_words(self._commands[key][0], 1)
+        return True
 # endregion
 
+    @property
+    def bus_timing(self) -> BusTiming:
+        """Inter-frame timing of the bus, reports the current gap and effective request rate"""
+        return self._timing
+
+    @property
+    def register_map(self) -> RegisterMap:
+        """Register definitions of the configured model or variant"""
+        return self._map
+
+    def plan_reads(self, keys: Iterable[str]) -> list[ReadBlock]:
+        """Block reads of a set of commands, compiled once per distinct set"""
+        keys = frozenset(keys)
+        blocks = self._plans.get(keys)
+        if blocks is None:
+            if len(self._plans) >= PLAN_CACHE_SIZE:
+                self._plans.clear()
+            blocks = self._plans[keys] = plan_reads(keys, self._commands)
+        return blocks
+
     # region Getters
 
+    # Any read command of the register map
+    def get_value(self, key: str) -> Union[Number, str]:
+        """Engineering value of a command: decimals, sign and scale applied, or its enum name
+        Raises ReadError when it cannot be read, ValueError when it is not a known enum value
+        """
+        value = self._map.value(key, self._read_command(key))
+        if value is None:
+            raise ValueError(f"Unknown value of '{key}'.")
+        return value
+
     # Battery Voltage
     def get_battery_voltage(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('battery_voltage'))
-        return float(value)
+        return self.get_value('battery_voltage')
 
     # Battery Current (Charge/Discharge)
     def get_battery_charge_current(self) -> float:
@@ -92,193 +246,283 @@ class SRNEInverter():
         Negative value if discharging
         Positive value if charging
         """
-        value = self._read_register(*INVERTER_COMMANDS.get('battery_current'))
-        return (-1) * float(value)
+        return self.get_value('battery_current')
 
     # Battery Charge Power
     def get_battery_charge_power(self) -> int:
         """Battery Charge Power(Grid + PV)"""
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_charge_power'))
-        return int(value)
+        return self.get_value('battery_charge_power')
 
     # Battery State of Charge
     def get_battery_soc(self) -> int:
-        value = self._read_register(*INVERTER_COMMANDS.get('battery_soc'))
-        return int(value)
+        return self.get_value('battery_soc')
 
     # Battery Max Charge Current
     def get_battery_charge_max_current(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_max_charge_current'))
-        return float(value)
+        return self.get_value('battery_max_charge_current')
 
     # Battery Type    
     def get_battery_type(self) -> str:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_type'))
-        return BatteryType(int(value)).name
+        return self.get_value('battery_type')
 
     # Battery Boost Charge Voltage
     def get_battery_boost_charge_voltage(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_boost_charge_voltage'))
-        return float(value * BATTERY_SETUP_MULTIPLIER)
+        return self.get_value('battery_boost_charge_voltage')
     
     # Battery Boost Charge Time
     def get_battery_boost_charge_time(self) -> int:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_boost_charge_time'))
-        return int(value)
+        return self.get_value('battery_boost_charge_time')
     
     # Battery Float Charge Voltage
     def get_battery_float_charge_voltage(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('battery_float_charge_voltage'))
-        return float(value * BATTERY_SETUP_MULTIPLIER)
+        return self.get_value('battery_float_charge_voltage')
 
     # PV Input Voltage
     def get_pv_input_voltage(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('pv_voltage'))
-        return float(value)
+        return self.get_value('pv_voltage')
 
     # PV Input Current
     def get_pv_input_current(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('pv_current'))
-        return float(value)
+        return self.get_value('pv_current')
 
     # PV Input Power
     def get_pv_input_power(self) -> int:
-        value = self._read_register(*INVERTER_COMMANDS.get('pv_power'))
-        return int(value)
+        return self.get_value('pv_power')
 
     # Grid Voltage
     def get_grid_voltage(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('grid_voltage'))
-        return float(value)
+        return self.get_value('grid_voltage')
 
     # Grid Input Current
     def get_grid_input_current(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('grid_input_current'))
-        return float(value)
+        return self.get_value('grid_input_current')
 
     # Grid Battery Charge Current
     def get_grid_battery_charge_current(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('grid_battery_charge_current'))
-        return float(value)
+        return self.get_value('grid_battery_charge_current')
 
     # Grid Frequency
     def get_grid_frequency(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('grid_frequency'))
-        return float(value)
+        return self.get_value('grid_frequency')
 
     # Grid Battery Charge Max Current
     def get_grid_battery_charge_max_current(self) -> int:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('grid_battery_charge_max_current'))
-        return float(value)
+        return self.get_value('grid_battery_charge_max_current')
 
     # Inverter Output Voltage
     def get_inverter_output_voltage(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('inverter_voltage'))
-        return float(value)
+        return self.get_value('inverter_voltage')
 
     # Inverter Output Current
     def get_inverter_output_current(self) -> float:
-        value = self._read_register(*INVERTER_COMMANDS.get('inverter_current'))
-        return float(value)
+        return self.get_value('inverter_current')
 
     # Inverter Output Frequency
     def get_inverter_frequency(self) -> float:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('inverter_frequency'))
-        return float(value)
+        return self.get_value('inverter_frequency')
 
     # Inverter Output Power
     def get_inverter_output_power(self) -> int:
-        value = self._read_register(*INVERTER_COMMANDS.get('inverter_power'))
-        return int(value)
+        return self.get_value('inverter_power')
 
     # Inverter output priority
     def get_inverter_output_priority(self) -> OutputPriority:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('inverter_output_priority'))
+        value = self._read_command('inverter_output_priority')
         return OutputPriority(int(value))
 
     # Inverter charger priority
     def get_inverter_charger_priority(self) -> ChargerPriority:
-        value = self._read_register(
-            *INVERTER_COMMANDS.get('inverter_charger_priority'))
+        value = self._read_command('inverter_charger_priority')
         return ChargerPriority(int(value))
 
+    # Read several commands with as few block reads as possible
+    def read_results(self, keys: Iterable[str], cached: bool = True) -> dict[str, ReadResult]:
+        """Returns a ReadResult for every key
+        Values still fresh in the cache are not read again unless cached is False
+        Keys of a block that failed to read get the last good value flagged stale, or no value
+        and the error quality
+        """
+        keys = set(keys)
+        results: dict[str, ReadResult] = {}
+        if cached:
+            for key in keys:
+                last = self._cache.last(key)
+                if last is not None and last[1] <= self._cache.ttl(key):
+                    results[key] = ReadResult(last[0], Quality.GOOD, time() - last[1])
+        for block in self.plan_reads(keys.difference(results)):
+            try:
+                registers = self._read_registers(block.start, block.count, block.functioncode)
+            except IOError as e:
+                quality = error_quality(e)
+                results.update({key: self._failed_result(key, quality) for key in block.keys})
+                for register in range(block.start, block.end + 1):
+                    self._raw.pop(register, None)
+                    self._raw_times.pop(register, None)
+                continue
+            decoded = decode_block(block, registers)
+            self._cache.update(decoded)
+            now = time()
+            results.update({key: ReadResult(value, Quality.GOOD, now) for key, value in decoded.items()})
+            self._store_words(block.start, registers)
+        return results
+
+    def read_commands(self, keys: Iterable[str], cached: bool = True) -> dict[str, Number]:
+        """Returns the value of every key that could be read, stale values included
+        Use read_results() for the quality of each value
+        """
+        return {key: result.value for key, result in self.read_results(keys, cached).items()
+                if result.value is not None}
+
+    # Raw words of the registers fetched by the latest block reads
+    def raw_registers(self) -> dict[int, int]:
+        """Returns {address: word}, registers of failed blocks are left out"""
+        return dict(self._raw)
+
+    # Raw words of recently read registers, without bus access
+    def recent_words(self, register: int, count: int, max_age: float) -> Optional[list[int]]:
+        """Returns the words when every register was read within max_age seconds, or within the
+        cache TTL of its command when that is longer, None otherwise
+        """
+        now = monotonic()
+        words = []
+        for address in range(register, register + count):
+            word = self._raw.get(address)
+            read = self._raw_times.get(address)
+            if word is None or read is None:
+                return None
+            ttl = max((self._cache.ttl(key) for key in self._read_keys.get(address, ())), default=0)
+            if now - read > max(max_age, ttl):
+                return None
+            words.append(word)
+        return words
+
+    # Read consecutive registers as raw words
+    def read_words(self, register: int, count: int, functioncode: int = READ_FUNCTION_CODE) -> list[int]:
+        """Raises IOError when the read fails, holding registers read refresh recent_words()"""
+        words = self._read_registers(register, count, functioncode)
+        if functioncode == READ_FUNCTION_CODE:
+            self._store_words(register, words)
+        return words
+
+    # Cached value of a read command, without bus access
+    def cached(self, key: str) -> Optional[Number]:
+        """Returns the value while it is fresh, None otherwise"""
+        return self._cache.get(key)
+
+    # Drop cached values so the next read goes to the inverter
+    def invalidate_cache(self, key: Optional[str] = None) -> None:
+        self._cache.invalidate(key)
+
     # Get a complete record of all the parameters
     def get_record(self):
-        record = {
-            'battery': {
-                'voltage': self.get_battery_voltage(),
-                'current': self.get_battery_charge_current(),
-                'chargePower': self.get_battery_charge_power(),
-                'soc':  self.get_battery_soc(),
-                'type': self.get_battery_type(),
-                'boostChargeVoltage': self.get_battery_boost_charge_voltage(),
-                'boostChargeTime': self.get_battery_boost_charge_time(),
-                'floatChargeVoltage': self.get_battery_float_charge_voltage(),
-            },
-            'pv': {
-                'voltage': self.get_pv_input_voltage(),
-                'current': self.get_pv_input_current(),
-                'power': self.get_pv_input_power(),
-            },
-            'grid': {
-                'voltage': self.get_grid_voltage(),
-                'inputCurrent': self.get_grid_input_current(),
-                'batteryChargeCurrent':  self.get_grid_battery_charge_current(),
-                'frequency': self.get_grid_frequency(),
-            },
-            'inverter': {
-                'voltage': self.get_inverter_output_voltage(),
-                'current': self.get_inverter_output_current(),
-                'frequency': self.get_inverter_frequency(),
-                'power': self.get_inverter_output_power(),
-            },
-            'settings': {
-                'chargerPriority': self.get_inverter_charger_priority().name,
-                'outputPriority': self.get_inverter_output_priority().name,
-                'maxBatteryChargeCurrent': self.get_battery_charge_max_current(),
-                'maxGridChargeCurrent': self.get_grid_battery_charge_max_current()
-            }
-        }
-        return record
+        """Fields that could not be read are None, a block failure does not fail the record
+        record['quality'] maps the path of every field that is not good to its quality
+        ('stale', 'timeout', 'crc_error', 'error' or 'invalid'), stale fields keep their last value
+        """
+        return self.build_record(self.read_results(RECORD_COMMANDS))
+
+    def build_record(self, results: dict[str, ReadResult]):
+        """Record from the results of RECORD_COMMANDS read beforehand, without bus access"""
+        return self._map.build_record(results)
 
     # endregion
 
     # region Setters
 
+    # Write any write command of the register map by key
+    def write_command(self, key: str, value: Number) -> bool:
+        """Values are not validated here, see validator.validate_command()"""
+        if not key.endswith('_write') or key not in self._commands:
+            raise KeyError(f"'{key}' is not a write command.")
+        return self._write_command(key, value)
+
+    # Write several settings with as few requests as possible
+    def apply_settings(self, settings: dict[str, Union[Number, Enum]]) -> dict[str, dict[str, Any]]:
+        """Keys are read command names such as 'battery_max_charge_current' ('_write' is optional)
+        Every value is validated first, nothing is written if one is invalid. Consecutive
+        registers are written with one request and all keys are verified with one block read
+        Returns {key: {'success': bool, 'value': read back value, 'message': on failure}}
+        """
+        values: dict[str, Number] = {}
+        invalid: dict[str, str] = {}
+        for key, value in settings.items():
+            name = key.removesuffix('_write')
+            value = value.value if isinstance(value, Enum) else value
+            validation = validate_command(f'{name}_write', value, self._map.write_limits)
+            if validation is True:
+                values[name] = value
+            else:
+                invalid[name] = validation.get('message')
+        if invalid:
+            return {
+                key.removesuffix('_write'): {
+                    'success': False,
+                    'message': invalid.get(key.removesuffix('_write'), "Not written, another setting is invalid."),
+                }
+                for key in settings
+            }
+
+        written: set[str] = set()
+        failure = None
+        for block in plan_writes((f'{name}_write' for name in values), self._commands):
+            names = [key.removesuffix('_write') for key in block.keys]
+            words = []
+            for name, key in zip(names, block.keys):
+                _, decimals, _, signed = self._commands[key]
+                words.append(encode_register(values[name], decimals, signed))
+            try:
+                self.write_words(block.start, words)
+            except IOError as e:
+                failure = f"Error occurred when setting the value: {error_quality(e).value}."
+                break
+            written.update(names)
+
+        readback = self.read_results(values, cached=False) if written else {}
+        results: dict[str, dict[str, Any]] = {}
+        for name, value in values.items():
+            if name not in written:
+                results[name] = {'success': False, 'message': failure}
+                continue
+            result = readback[name]
+            if result.good and math.isclose(result.value, value):
+                results[name] = {'success': True, 'value': result.value}
+            else:
+                results[name] = {'success': False, 'value': result.value,
+                                 'message': f"Read back value does not match ({result.quality.value})."}
+        return results
+
+    # Write raw words to consecutive registers
+    def write_words(self, register: int, words: list[int], functioncode: Optional[int] = None) -> None:
+        """Function code 6 writes one register and 16 any number, by default 6 for a single word
+        Values are not validated. Raises IOError when the write fails; the raw words and cached
+        values of the registers are dropped either way, a timed out write may have been applied
+        """
+        if functioncode is None:
+            functioncode = 6 if len(words) == 1 else 16
+        try:
+            with self._transaction('write', register):
+                if functioncode == 6:
+                    self._instrument.write_register(register, words[0], 0, functioncode)
+                else:
+                    self._instrument.write_registers(register, list(words))
+        finally:
+            self._forget_words(register, len(words))
+
     # Set inverter output priority
     def set_inverter_output_priority(self, priority: OutputPriority) -> bool:
-        params = (priority.value, *
-                  INVERTER_COMMANDS.get('inverter_output_priority_write'))
-        return self._write_register(*params)
+        return self._write_command('inverter_output_priority_write', priority.value)
 
     # Set inverter charging priority
     def set_inverter_charger_priority(self, priority: ChargerPriority) -> bool:
-        params = (priority.value, *
-                  INVERTER_COMMANDS.get('inverter_charger_priority_write'))
-        return self._write_register(*params)
+        return self._write_command('inverter_charger_priority_write', priority.value)
 
     # Set max charging current
     def set_battery_charge_max_current(self, current: int) -> bool:
-        params = (
-            current, *INVERTER_COMMANDS.get('battery_max_charge_current_write'))
-        return self._write_register(*params)
+        return self._write_command('battery_max_charge_current_write', current)
 
     # Set max utility charging current
     def set_grid_battery_charger_maximum_current(self, current: int) -> bool:
-        params = (
-            current, *INVERTER_COMMANDS.get('grid_battery_charge_max_current_write'))
-        return self._write_register(*params)
+        return self._write_command('grid_battery_charge_max_current_write', current)
     # endregion
 
 # endregion
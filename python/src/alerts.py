@@ -0,0 +1,276 @@
+"""
+Streaming alert rules
+
+Rules are compiled once from plain dicts (see `DEFAULT_RULES`, or a JSON
+list loaded with `load_rules()`) and evaluated on every published record,
+so alerts never cause a bus read. Each rule keeps O(1) state per inverter.
+
+    {"name": "battery_soc_low", "metric": "battery.soc", "below": 20, "clear": 25, "for": 60}
+
+metric      dotted record path; missing or flagged values are skipped
+above/below threshold, exactly one of them
+clear       hysteresis: the alert clears once the value is back past it,
+            the threshold by default
+rate        makes it a rate-of-change rule: every `rate` seconds the change
+            per minute since the previous evaluation is compared instead
+for         seconds the condition has to hold before the alert is raised
+clear_for   seconds the clear condition has to hold before it is cleared
+when        conditions ({"metric", "above" or "below"}) that must all hold
+            for the rule to apply, otherwise the alert clears
+severity    'info', 'warning' (default) or 'critical'
+
+Only transitions produce events ('raised' and 'cleared'), so `for` and
+`clear_for` debounce flapping values. Events go to the listeners of the
+engine, such as the /alerts/stream broadcaster and `WebhookNotifier`,
+which batches them into one POST per burst.
+"""
+import asyncio
+import json
+import urllib.request
+from collections import deque
+from time import time
+from typing import Any, Callable, Iterable, Optional
+
+from metrics import Counter, Gauge
+from records import Number, record_value
+
+SEVERITIES = ('info', 'warning', 'critical')
+RAISED = 'raised'
+CLEARED = 'cleared'
+
+WEBHOOK_DELAY = 1  # second, events of a burst are posted together
+WEBHOOK_TIMEOUT = 5  # second
+WEBHOOK_RETRIES = 3
+WEBHOOK_QUEUE_SIZE = 1000
+
+DEFAULT_RULES: list[dict[str, Any]] = [
+    {'name': 'battery_soc_low', 'metric': 'battery.soc', 'below': 20, 'clear': 25, 'for': 60},
+    {'name': 'battery_soc_falling_fast', 'metric': 'battery.soc', 'rate': 300, 'below': -1, 'severity': 'info'},
+    {'name': 'grid_loss', 'metric': 'grid.voltage', 'below': 1, 'clear': 50, 'for': 5, 'clear_for': 30,
+     'severity': 'critical'},
+    {'name': 'temperature_dc_high', 'metric': 'temperature.dc', 'above': 80, 'clear': 75, 'for': 30,
+     'severity': 'critical'},
+    {'name': 'temperature_ac_high', 'metric': 'temperature.ac', 'above': 80, 'clear': 75, 'for': 30,
+     'severity': 'critical'},
+    {'name': 'temperature_transformer_high', 'metric': 'temperature.transformer', 'above': 80, 'clear': 75,
+     'for': 30, 'severity': 'critical'},
+    # Panels are lit and the battery can take charge, yet little power comes in
+    {'name': 'pv_underperformance', 'metric': 'pv.power', 'below': 100, 'clear': 200, 'for': 1800,
+     'when': [{'metric': 'pv.voltage', 'above': 120}, {'metric': 'battery.soc', 'below': 90}]},
+]
+
+ALERT_EVENTS = Counter('srne_alert_events', "Alert transitions by rule and state", ('inverter', 'rule', 'state'))
+ACTIVE_ALERTS = Gauge('srne_alert_active', "1 while an alert is raised", ('inverter', 'rule'))
+WEBHOOK_FAILURES = Counter('srne_alert_webhook_failures', "Alert batches that could not be delivered")
+
+
+def _limits(spec: dict[str, Any], name: str) -> tuple[float, bool]:
+    """(threshold, rising) of a spec with exactly one of above and below"""
+    above, below = spec.get('above'), spec.get('below')
+    if (above is None) == (below is None):
+        raise ValueError(f"Rule '{name}' needs either above or below.")
+    return (above, True) if above is not None else (below, False)
+
+
+class Rule():
+    """Compiled rule, see the module documentation for the fields"""
+
+    def __init__(self, spec: dict[str, Any]) -> None:
+        self.name = spec['name']
+        self.metric = spec['metric']
+        self.threshold, self.rising = _limits(spec, self.name)
+        self.clear = spec.get('clear', self.threshold)
+        if (self.clear > self.threshold) if self.rising else (self.clear < self.threshold):
+            raise ValueError(f"Rule '{self.name}' clears beyond its threshold.")
+        self.rate: Optional[float] = spec.get('rate')
+        self.duration = spec.get('for', 0)
+        self.clear_duration = spec.get('clear_for', 0)
+        self.severity = spec.get('severity', 'warning')
+        if self.severity not in SEVERITIES:
+            raise ValueError(f"Rule '{self.name}' has an unknown severity.")
+        self.when = [(condition['metric'], *_limits(condition, self.name)) for condition in spec.get('when', ())]
+        unit = '/min' if self.rate is not None else ''
+        self.message = spec.get('message') or \
+            f"{self.metric} {'above' if self.rising else 'below'} {self.threshold}{unit}"
+
+    def describe(self) -> dict[str, Any]:
+        return {'name': self.name, 'metric': self.metric, 'above' if self.rising else 'below': self.threshold,
+                'clear': self.clear, 'rate': self.rate, 'for': self.duration, 'clear_for': self.clear_duration,
+                'severity': self.severity, 'message': self.message}
+
+    def applies(self, record: dict[str, Any]) -> bool:
+        for metric, threshold, rising in self.when:
+            value = record_value(record, metric)
+            if value is None or (value <= threshold if rising else value >= threshold):
+                return False
+        return True
+
+    def triggered(self, value: Number) -> bool:
+        return value > self.threshold if self.rising else value < self.threshold
+
+    def cleared(self, value: Number) -> bool:
+        return value <= self.clear if self.rising else value >= self.clear
+
+
+class RuleState():
+    __slots__ = ('active', 'since', 'raised', 'reference', 'value')
+
+    def __init__(self) -> None:
+        self.active = False
+        self.since: Optional[float] = None  # start of the pending transition
+        self.raised: Optional[float] = None
+        self.reference: Optional[tuple[float, Number]] = None  # (timestamp, value) of rate rules
+        self.value: Optional[Number] = None
+
+
+def _rate(rule: Rule, state: RuleState, value: Number, timestamp: float) -> Optional[float]:
+    """Change per minute once every `rate` seconds, None in between and after a gap"""
+    reference = state.reference
+    if reference is None or timestamp - reference[0] > 2 * rule.rate:
+        state.reference = (timestamp, value)
+        return None
+    if timestamp - reference[0] < rule.rate:
+        return None
+    state.reference = (timestamp, value)
+    return (value - reference[1]) / (timestamp - reference[0]) * 60
+
+
+def load_rules(path: str) -> list[dict[str, Any]]:
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+class AlertEngine():
+    def __init__(self, rules: Iterable[dict[str, Any]] = DEFAULT_RULES) -> None:
+        """Raises ValueError for invalid rules"""
+        self.rules = [Rule(spec) for spec in rules]
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError("Rule names have to be unique.")
+        self._states: dict[str, list[RuleState]] = {}
+        self._listeners: list[Callable[[dict[str, Any]], None]] = []
+
+    def add_listener(self, listener: Callable[[dict[str, Any]], None]) -> None:
+        """Call listener(event) for every raised or cleared alert"""
+        self._listeners.append(listener)
+
+    def evaluate(self, inverter_id: str, record: dict[str, Any], timestamp: Optional[float] = None) -> list[dict[str, Any]]:
+        """Update the rules with a record and return the events it caused"""
+        timestamp = time() if timestamp is None else timestamp
+        states = self._states.get(inverter_id)
+        if states is None:
+            states = self._states[inverter_id] = [RuleState() for _ in self.rules]
+        events = []
+        for rule, state in zip(self.rules, states):
+            value = record_value(record, rule.metric)
+            if value is None:
+                continue
+            if rule.rate is not None:
+                value = _rate(rule, state, value, timestamp)
+                if value is None:
+                    continue
+            state.value = value
+            applies = rule.applies(record)
+            if state.active:
+                changing = not applies or rule.cleared(value)
+                duration = rule.clear_duration
+            else:
+                changing = applies and rule.triggered(value)
+                duration = rule.duration
+            if not changing:
+                state.since = None
+                continue
+            if state.since is None:
+                state.since = timestamp
+            if timestamp - state.since < duration:
+                continue
+            state.active = not state.active
+            state.since = None
+            state.raised = timestamp if state.active else None
+            events.append(self._event(inverter_id, rule, state, timestamp))
+        for event in events:
+            ALERT_EVENTS.inc((inverter_id, event['rule'], event['state']))
+            ACTIVE_ALERTS.set(1 if event['state'] == RAISED else 0, (inverter_id, event['rule']))
+            for listener in self._listeners:
+                listener(event)
+        return events
+
+    def active(self, inverter_id: Optional[str] = None) -> list[dict[str, Any]]:
+        """Raised alerts, of every inverter unless one is given"""
+        return [
+            {'inverter': state_id, 'rule': rule.name, 'severity': rule.severity, 'metric': rule.metric,
+             'value': state.value, 'since': state.raised, 'message': rule.message}
+            for state_id, states in self._states.items() if inverter_id is None or state_id == inverter_id
+            for rule, state in zip(self.rules, states) if state.active
+        ]
+
+    def _event(self, inverter_id: str, rule: Rule, state: RuleState, timestamp: float) -> dict[str, Any]:
+        return {
+            'inverter': inverter_id,
+            'rule': rule.name,
+            'state': RAISED if state.active else CLEARED,
+            'severity': rule.severity,
+            'metric': rule.metric,
+            'value': state.value,
+            'threshold': rule.threshold if state.active else rule.clear,
+            'message': rule.message,
+            'timestamp': timestamp,
+        }
+
+
+class WebhookNotifier():
+    """POSTs {"events": [...]} to every URL, one request per burst of events
+    Failed deliveries are retried with backoff, then dropped
+    """
+
+    def __init__(self, urls: Iterable[str], delay: float = WEBHOOK_DELAY, timeout: float = WEBHOOK_TIMEOUT,
+                 retries: int = WEBHOOK_RETRIES, queuesize: int = WEBHOOK_QUEUE_SIZE) -> None:
+        self._urls = list(urls)
+        self._delay = delay
+        self._timeout = timeout
+        self._retries = retries
+        self._pending: deque[dict[str, Any]] = deque(maxlen=queuesize)
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def notify(self, event: dict[str, Any]) -> None:
+        self._pending.append(event)
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self._delay)
+            self._wakeup.clear()
+            events = list(self._pending)
+            self._pending.clear()
+            body = json.dumps({'events': events}).encode()
+            await asyncio.gather(*(self._deliver(url, body) for url in self._urls))
+
+    async def _deliver(self, url: str, body: bytes) -> None:
+        for attempt in range(self._retries + 1):
+            try:
+                await asyncio.to_thread(self._post, url, body)
+                return
+            except OSError:
+                if attempt < self._retries:
+                    await asyncio.sleep(2 ** attempt)
+        WEBHOOK_FAILURES.inc()
+
+    def _post(self, url: str, body: bytes) -> None:
+        request = urllib.request.Request(url, body, {'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request, timeout=self._timeout):
+            pass
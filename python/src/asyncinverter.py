@@ -0,0 +1,170 @@
+"""
+Async facade over SRNEInverter
+
+All blocking Modbus calls are handed to a dedicated I/O worker thread
+through a priority queue, so coroutines await the result and the event
+loop never blocks on the RS485 bus.
+
+Jobs are scheduled by priority class: control writes first, then
+interactive reads, fast telemetry and slow settings. A record is read
+as one job per register block, so a write waits for at most the block
+being transferred instead of the whole record.
+"""
+import asyncio
+from concurrent.futures import Future
+from enum import Enum, IntEnum
+from itertools import count
+from queue import PriorityQueue
+from threading import Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable, Optional, TypeVar, Union
+
+from metrics import Histogram
+from readplanner import ReadBlock
+from readresult import ReadResult
+from srnecommands import COMMAND_FRESHNESS, SETTINGS
+from SRNEinverter import ChargerPriority, Number, OutputPriority, SRNEInverter
+
+T = TypeVar('T')
+
+
+class Priority(IntEnum):
+    """Scheduling classes of bus jobs, lower values run first"""
+    CONTROL = 0
+    INTERACTIVE = 1
+    TELEMETRY = 2
+    SETTINGS = 3
+
+
+# Queued after every job, so stop() lets the pending jobs finish
+STOP_PRIORITY = len(Priority)
+
+QUEUE_WAIT = Histogram('srne_scheduler_wait_seconds', "Time bus jobs spend queued before they run",
+                       ('worker', 'priority'))
+
+Job = tuple[Future[Any], Callable[..., Any], tuple[Any, ...], float]
+
+
+def block_priority(block: ReadBlock, freshness: dict[str, int] = COMMAND_FRESHNESS) -> Priority:
+    """Blocks holding only settings are read after the telemetry"""
+    if all(freshness.get(key) == SETTINGS for key in block.keys):
+        return Priority.SETTINGS
+    return Priority.TELEMETRY
+
+
+class IOWorker():
+    """Thread executing the queued blocking calls one at a time, by priority
+    then in submission order
+    """
+
+    def __init__(self, name: str = 'srne-io') -> None:
+        self.name = name
+        self._jobs: PriorityQueue[tuple[int, int, Optional[Job]]] = PriorityQueue()
+        self._sequence = count()
+        self._thread = Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, fn: Callable[..., T], *args: Any,
+               priority: Priority = Priority.INTERACTIVE) -> "asyncio.Future[T]":
+        future: Future[T] = Future()
+        self._jobs.put((priority, next(self._sequence), (future, fn, args, perf_counter())))
+        return asyncio.wrap_future(future)
+
+    def stop(self) -> None:
+        self._jobs.put((STOP_PRIORITY, next(self._sequence), None))
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            priority, _, job = self._jobs.get()
+            if job is None:
+                break
+            future, fn, args, queued = job
+            # Skip jobs whose caller went away while they were queued
+            if not future.set_running_or_notify_cancel():
+                continue
+            QUEUE_WAIT.observe(perf_counter() - queued, (self.name, Priority(priority).name.lower()))
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+
+class AsyncSRNEInverter():
+    """Awaitable versions of the SRNEInverter methods, executed on an IOWorker"""
+
+    def __init__(self, inverter: SRNEInverter, worker: Optional[IOWorker] = None) -> None:
+        self.inverter = inverter
+        self.worker = worker if worker is not None else IOWorker()
+        register_map = inverter.register_map
+        # (keys, priority) of the blocks read by get_record()
+        self._record_blocks = [(block.keys, block_priority(block, register_map.freshness))
+                               for block in inverter.plan_reads(register_map.record_commands)]
+
+    async def run(self, fn: Callable[..., T], *args: Any, priority: Priority = Priority.INTERACTIVE) -> T:
+        """Run any blocking callable on the I/O worker"""
+        return await self.worker.submit(fn, *args, priority=priority)
+
+    async def control(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run a write ahead of every queued read"""
+        return await self.run(fn, *args, priority=Priority.CONTROL)
+
+    # region Getters
+
+    def raw_registers(self) -> dict[int, int]:
+        """Raw words of the latest block reads, served from memory without bus access"""
+        return self.inverter.raw_registers()
+
+    async def read_commands(self, keys: Iterable[str]) -> dict[str, Number]:
+        return await self.run(self.inverter.read_commands, tuple(keys))
+
+    async def read_results(self, keys: Iterable[str]) -> dict[str, ReadResult]:
+        return await self.run(self.inverter.read_results, tuple(keys))
+
+    def cached(self, key: str) -> Optional[Number]:
+        """Fresh cached value of a read command, without bus access"""
+        return self.inverter.cached(key)
+
+    async def get_record(self):
+        """Read the record block by block at telemetry or settings priority"""
+        reads = [self.run(self.inverter.read_results, keys, priority=priority) for keys, priority in self._record_blocks]
+        results: dict[str, ReadResult] = {}
+        for block_results in await asyncio.gather(*reads):
+            results.update(block_results)
+        return self.inverter.build_record(results)
+
+    async def get_battery_charge_max_current(self) -> float:
+        return await self.run(self.inverter.get_battery_charge_max_current)
+
+    async def get_grid_battery_charge_max_current(self) -> float:
+        return await self.run(self.inverter.get_grid_battery_charge_max_current)
+
+    async def get_inverter_output_priority(self) -> OutputPriority:
+        return await self.run(self.inverter.get_inverter_output_priority)
+
+    async def get_inverter_charger_priority(self) -> ChargerPriority:
+        return await self.run(self.inverter.get_inverter_charger_priority)
+
+    # endregion
+
+    # region Setters
+
+    async def write_command(self, key: str, value: Number) -> bool:
+        return await self.control(self.inverter.write_command, key, value)
+
+    async def apply_settings(self, settings: dict[str, Union[Number, Enum]]) -> dict[str, dict[str, Any]]:
+        return await self.control(self.inverter.apply_settings, settings)
+
+    async def set_inverter_output_priority(self, priority: OutputPriority) -> bool:
+        return await self.control(self.inverter.set_inverter_output_priority, priority)
+
+    async def set_inverter_charger_priority(self, priority: ChargerPriority) -> bool:
+        return await self.control(self.inverter.set_inverter_charger_priority, priority)
+
+    async def set_battery_charge_max_current(self, current: int) -> bool:
+        return await self.control(self.inverter.set_battery_charge_max_current, current)
+
+    async def set_grid_battery_charger_maximum_current(self, current: int) -> bool:
+        return await self.control(self.inverter.set_grid_battery_charger_maximum_current, current)
+
+    # endregion
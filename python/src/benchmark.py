@@ -0,0 +1,421 @@
+"""
+Polling throughput and latency benchmark
+
+Runs the SRNEInverter read path and the HTTP stream against the virtual
+inverter from simulator.py (started in a subprocess, so CPU figures only
+cover this process) and writes the results as JSON.
+
+    python benchmark.py --bauds 9600,19200,115200 --clients 1,5,20 --output bench.json
+
+--mqtt sends that many MQTT commands through an in-process `MemoryBroker`
+and fails unless each is acknowledged with the value read back.
+
+With --replay the records are read from a bus capture (capture.py) instead:
+
+    python benchmark.py --replay data/capture/ttyUSB0-20250101T120000.cap --replay-speed 0
+
+Latencies are reported in milliseconds, allocations in bytes.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from itertools import cycle
+from time import monotonic, perf_counter, process_time, time
+from typing import Any, Callable
+
+from capture import ReplaySerial
+from delta import DeltaEncoder
+from frames import decode_frame, decode_frames, encode_frame
+from mqttclient import MemoryBroker
+from mqttcommands import MqttCommands
+from mqttpublisher import MqttPublisher
+from readplanner import plan_reads
+from records import flatten_record
+from registry import InverterConfig, InverterRegistry
+from srnecommands import INVERTER_COMMANDS, WRITE_LIMITS
+from SRNEinverter import RECORD_COMMANDS, SRNEInverter
+
+READ_KEYS = [key for key in INVERTER_COMMANDS if not key.endswith('_write')]
+MQTT_COMMAND = 'battery_max_charge_current'
+MQTT_TIMEOUT = 5  # second
+SIMULATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulator.py')
+STREAM_PORT = 5098
+# Request and response overhead of a Modbus RTU read: address, function code, CRC, byte count
+READ_REQUEST_BYTES = 8
+READ_RESPONSE_OVERHEAD = 5
+BITS_PER_CHARACTER = 11
+ENCODING_RECORDS = 20  # Successive polls the encoders cycle through
+
+
+def start_simulator(baudrate: int, latency: float, static: bool = True) -> tuple["subprocess.Popen[str]", str]:
+    """Start the virtual inverter on a pty, returns the process and the device path
+
+    static=False runs the day cycle scenario, so successive polls return changing values.
+    """
+    process = subprocess.Popen(
+        [sys.executable, SIMULATOR, '--pty', '--baud', str(baudrate), '--latency', str(latency)]
+        + (['--static'] if static else []),
+        stdout=subprocess.PIPE, text=True)
+    assert process.stdout is not None
+    return process, process.stdout.readline().split()[-1]
+
+
+def distribution(samples: list[float]) -> dict[str, Any]:
+    """Summary of latencies given in seconds, reported in milliseconds"""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, round(fraction * (len(ordered) - 1)))] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': percentile(0.5),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+
+def allocation(fn: Callable[[], Any], repeat: int) -> dict[str, int]:
+    """Peak traced memory of one call and bytes still allocated per call after `repeat` calls"""
+    fn()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn()
+        peak = tracemalloc.get_traced_memory()[1] - before
+        for _ in range(repeat - 1):
+            fn()
+        retained = (tracemalloc.get_traced_memory()[0] - before) // repeat
+    finally:
+        tracemalloc.stop()
+    return {'peak_bytes': peak, 'retained_bytes_per_call': retained}
+
+
+def bench_registers(inverter: SRNEInverter, repeat: int) -> dict[str, Any]:
+    results: dict[str, Any] = {}
+    for key in READ_KEYS:
+        samples: list[float] = []
+        for _ in range(repeat):
+            started = perf_counter()
+            inverter.read_commands([key], cached=False)
+            samples.append(perf_counter() - started)
+        results[key] = distribution(samples)
+    return results
+
+
+def bench_record(inverter: SRNEInverter, repeat: int, baudrate: int) -> dict[str, Any]:
+    blocks = plan_reads(RECORD_COMMANDS)
+    wire_bytes = sum(READ_REQUEST_BYTES + READ_RESPONSE_OVERHEAD + 2 * block.count for block in blocks)
+    samples: list[float] = []
+    cpu = 0.0
+    for _ in range(repeat):
+        inverter.invalidate_cache()
+        started = perf_counter()
+        started_cpu = process_time()
+        inverter.get_record()
+        cpu += process_time() - started_cpu
+        samples.append(perf_counter() - started)
+
+    def uncached_record() -> None:
+        inverter.invalidate_cache()
+        inverter.get_record()
+
+    mean = sum(samples) / len(samples)
+    return {
+        'latency': distribution(samples),
+        'requests_per_record': len(blocks),
+        'requests_per_second': round(len(blocks) / mean, 2),
+        'wire_bytes_per_record': wire_bytes,
+        'bus_utilization': round(wire_bytes * BITS_PER_CHARACTER / baudrate / mean, 4),
+        'cpu_ms_per_record': round(cpu / repeat * 1000, 3),
+        'allocation': allocation(uncached_record, min(repeat, 10)),
+        'effective_request_rate': round(inverter.bus_timing.request_rate, 2),
+    }
+
+
+def bench_encoding(inverter: SRNEInverter, repeat: int) -> dict[str, Any]:
+    """Encoders over successive polls of a changing inverter, the delta is reported as keyframe and steady state"""
+    records = []
+    for _ in range(ENCODING_RECORDS):
+        inverter.invalidate_cache()
+        records.append(inverter.get_record())
+    registers = inverter.raw_registers()
+    timestamp = time()
+    polls = cycle(records)
+    encoders: dict[str, Callable[[], Any]] = {
+        'json': lambda: json.dumps(next(polls)),
+        'frame': lambda: encode_frame(registers, timestamp),
+    }
+    results: dict[str, Any] = {}
+    for name, encode in encoders.items():
+        started_cpu = process_time()
+        for _ in range(repeat):
+            payload = encode()
+        cpu = process_time() - started_cpu
+        results[name] = {
+            'bytes_per_frame': len(payload),
+            'cpu_us_per_frame': round(cpu / repeat * 1e6, 3),
+            'allocation': allocation(encode, repeat),
+        }
+    results['delta'] = bench_delta(records, repeat)
+    return results
+
+
+def bench_delta(records: list[dict[str, Any]], repeat: int) -> dict[str, Any]:
+    """Keyframe of the first record, then steady-state deltas cycling through the rest"""
+    delta = DeltaEncoder(math.inf)
+    keyframe = json.dumps(delta.encode(records[0])[1], separators=(',', ':'))
+    polls = cycle(records[1:] + records[:1])
+    changed = 0
+    size = 0
+    started_cpu = process_time()
+    for _ in range(repeat):
+        changes = delta.encode(next(polls))[1]
+        size += len(json.dumps(changes, separators=(',', ':')))
+        changed += len(changes)
+    cpu = process_time() - started_cpu
+    paths = len(flatten_record(records[0]))
+    return {
+        'records': len(records),
+        'paths': paths,
+        'keyframe_bytes': len(keyframe),
+        'bytes_per_frame': round(size / repeat, 1),
+        'changed_paths_per_frame': round(changed / repeat, 2),
+        'change_rate': round(changed / repeat / paths, 3),
+        'cpu_us_per_frame': round(cpu / repeat * 1e6, 3),
+        'allocation': allocation(lambda: json.dumps(delta.encode(next(polls))[1], separators=(',', ':')), repeat),
+    }
+
+
+def bench_decoding(inverter: SRNEInverter, count: int) -> dict[str, Any]:
+    """Per-frame decode against the vectorized batch decode of the same frames"""
+    registers = inverter.raw_registers()
+    frames = [encode_frame(registers, time() + index) for index in range(count)]
+    started_cpu = process_time()
+    for frame in frames:
+        decode_frame(frame)
+    loop = process_time() - started_cpu
+    started_cpu = process_time()
+    decode_frames(frames)
+    batch = process_time() - started_cpu
+    return {
+        'frames': count,
+        'loop_us_per_frame': round(loop / count * 1e6, 3),
+        'batch_us_per_frame': round(batch / count * 1e6, 3),
+    }
+
+
+async def stream_client(port: int, duration: float) -> tuple[list[float], int]:
+    """Read binary frames from /stream, returns publish-to-receive latencies and the frame count"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(b'GET /stream?format=frame HTTP/1.0\r\nHost: localhost\r\nAccept: text/event-stream\r\n\r\n')
+    await writer.drain()
+    latencies: list[float] = []
+    frames = 0
+    deadline = monotonic() + duration
+    try:
+        while (remaining := deadline - monotonic()) > 0:
+            try:
+                line = await asyncio.wait_for(reader.readline(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                break
+            if line.startswith(b'data: '):
+                frames += 1
+                timestamp, _ = decode_frame(base64.b64decode(line[6:].strip()))
+                # The first frame is the latest snapshot queued on subscribe, not a live one
+                if frames > 1:
+                    latencies.append(time() - timestamp)
+    finally:
+        writer.close()
+    return latencies, frames
+
+
+async def bench_stream(device: str, client_counts: list[int], duration: float) -> dict[str, Any]:
+    import uvicorn
+
+    os.environ['SRNE_DEVICE'] = device
+    os.chdir(tempfile.mkdtemp(prefix='srne-bench-'))
+    import main
+
+    server = uvicorn.Server(uvicorn.Config(main.app, host='127.0.0.1', port=STREAM_PORT, log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+    results: dict[str, Any] = {}
+    try:
+        for count in client_counts:
+            started_cpu = process_time()
+            outcomes = await asyncio.gather(*(stream_client(STREAM_PORT, duration) for _ in range(count)))
+            frames = sum(frames for _, frames in outcomes)
+            results[str(count)] = {
+                'latency': distribution([latency for latencies, _ in outcomes for latency in latencies]),
+                'frames_per_second': round(frames / duration, 2),
+                'frames_per_client_per_second': round(frames / duration / count, 2),
+                'cpu_ms_per_frame': round((process_time() - started_cpu) / max(frames, 1) * 1000, 3),
+            }
+    finally:
+        server.should_exit = True
+        await task
+    return results
+
+
+async def bench_mqtt(device: str, count: int) -> dict[str, Any]:
+    """Command to ack round trips through a MemoryBroker, plus the telemetry published meanwhile
+    Raises RuntimeError when an ack is missing or does not confirm the written value, or no telemetry arrives
+    """
+    broker = MemoryBroker()
+    registry = InverterRegistry([InverterConfig('main', device)])
+    publisher = MqttPublisher(broker)
+    commands = MqttCommands(broker, registry, window=0, min_interval=0)
+    loop = asyncio.get_running_loop()
+    acks: asyncio.Queue[dict[str, Any]] = asyncio.Queue()
+    broker.subscribe('inverter/cmd/ack',
+                     lambda topic, payload: loop.call_soon_threadsafe(acks.put_nowait, json.loads(payload)))
+    registry.add_listener(publisher.publish)
+    publisher.start()
+    registry.start()
+    commands.start()
+    low, _, multiple = WRITE_LIMITS[f'{MQTT_COMMAND}_write']
+    samples: list[float] = []
+    try:
+        for index in range(count):
+            # Alternate the value, an unchanged one is acknowledged without a write
+            value = low + multiple * (1 + index % 2)
+            started = perf_counter()
+            broker.publish(f'inverter/cmd/{MQTT_COMMAND}', json.dumps({'value': value, 'id': index}))
+            try:
+                ack = await asyncio.wait_for(acks.get(), MQTT_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise RuntimeError(f"MQTT command {index} was not acknowledged.")
+            samples.append(perf_counter() - started)
+            if ack.get('status') != 'success' or ack.get('ids') != [index] or ack.get('value') != value:
+                raise RuntimeError(f"MQTT command {index} got the ack {ack}.")
+        deadline = monotonic() + MQTT_TIMEOUT
+        while not broker.topics('inverter/main/telemetry'):
+            if monotonic() > deadline:
+                raise RuntimeError("No MQTT telemetry was published.")
+            await asyncio.sleep(0.05)
+    finally:
+        await commands.stop()
+        await registry.stop()
+        publisher.stop()
+    return {
+        'commands': count,
+        'round_trip': distribution(samples),
+        'telemetry_messages': len(broker.topics('inverter/main/telemetry')),
+    }
+
+
+def bench_replay(path: str, speed: float) -> dict[str, Any]:
+    """Uncached records read from a capture until a record matches no recorded frame"""
+    replay = ReplaySerial(path, speed)
+    frames = replay.remaining
+    inverter = SRNEInverter(replay.port, transport=replay)
+    samples: list[float] = []
+    cpu = 0.0
+    while replay.remaining:
+        matched = replay.matched
+        inverter.invalidate_cache()
+        started = perf_counter()
+        started_cpu = process_time()
+        inverter.get_record()
+        cpu += process_time() - started_cpu
+        if replay.matched == matched:
+            break
+        samples.append(perf_counter() - started)
+    return {
+        'frames': frames,
+        'matched': replay.matched,
+        'missed': replay.missed,
+        'records': len(samples),
+        'latency': distribution(samples),
+        'cpu_ms_per_record': round(cpu / max(len(samples), 1) * 1000, 3),
+    }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    results: dict[str, Any] = {
+        'meta': {
+            'timestamp': time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'latency': args.latency,
+            'repeat': args.repeat,
+        },
+        'bauds': {},
+    }
+    if args.replay:
+        del results['bauds']
+        results['replay'] = bench_replay(args.replay, args.replay_speed)
+        return results
+    for baudrate in args.bauds:
+        process, device = start_simulator(baudrate, args.latency)
+        try:
+            inverter = SRNEInverter(device, baudrate)
+            results['bauds'][str(baudrate)] = {
+                'registers': bench_registers(inverter, args.repeat),
+                'record': bench_record(inverter, args.repeat, baudrate),
+            }
+            if baudrate == args.bauds[-1]:
+                results['decoding'] = bench_decoding(inverter, args.repeat * 100)
+        finally:
+            process.terminate()
+            process.wait()
+    process, device = start_simulator(args.bauds[-1], args.latency, static=False)
+    try:
+        results['encoding'] = bench_encoding(SRNEInverter(device, args.bauds[-1]), args.repeat * 100)
+    finally:
+        process.terminate()
+        process.wait()
+    if args.mqtt:
+        process, device = start_simulator(args.bauds[-1], args.latency)
+        try:
+            results['mqtt'] = asyncio.run(bench_mqtt(device, args.mqtt))
+        finally:
+            process.terminate()
+            process.wait()
+    if args.clients:
+        process, device = start_simulator(args.bauds[-1], args.latency)
+        try:
+            results['stream'] = asyncio.run(bench_stream(device, args.clients, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the inverter read path and the stream endpoint")
+    parser.add_argument('--bauds', default='9600', help="comma separated baudrates emulated by the simulator")
+    parser.add_argument('--latency', type=float, default=0.005, help="simulated slave processing time in seconds")
+    parser.add_argument('--repeat', type=int, default=20, help="samples per register and per record")
+    parser.add_argument('--clients', default='1,5,20', help="comma separated stream client counts, empty to skip")
+    parser.add_argument('--duration', type=float, default=10, help="seconds each stream client count runs")
+    parser.add_argument('--mqtt', type=int, default=20, help="MQTT commands sent through the in-process broker, 0 to skip")
+    parser.add_argument('--replay', help="read the records from this capture file instead of the simulator")
+    parser.add_argument('--replay-speed', type=float, default=0, help="replay pace relative to the capture, 0 for no waiting")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    arguments = parser.parse_args()
+    arguments.bauds = [int(baud) for baud in arguments.bauds.split(',')]
+    arguments.clients = [int(count) for count in arguments.clients.split(',') if count]
+    output = json.dumps(run(arguments), indent=2)
+    if arguments.output:
+        with open(arguments.output, 'w') as outfile:
+            outfile.write(output)
+    else:
+        print(output)
@@ -0,0 +1,46 @@
+"""
+Fan-out of inverter snapshots to any number of stream clients
+
+Every subscriber gets its own bounded queue. When a slow client falls
+behind, the oldest frames in its queue are dropped so it always receives
+the most recent snapshot.
+"""
+import asyncio
+from typing import Any, Optional
+
+
+class Broadcaster():
+    def __init__(self, queuesize: int = 2, replay: bool = True) -> None:
+        """replay queues the latest item for new subscribers"""
+        self._queuesize = queuesize
+        self._replay = replay
+        self._subscribers: set[asyncio.Queue[Any]] = set()
+        self._latest: Optional[Any] = None
+
+    @property
+    def latest(self) -> Optional[Any]:
+        """Last published item, None until the first publish"""
+        return self._latest
+
+    @property
+    def client_count(self) -> int:
+        return len(self._subscribers)
+
+    def subscribe(self) -> "asyncio.Queue[Any]":
+        """Register a new client, the latest item is queued right away if there is one and replay is on"""
+        queue: asyncio.Queue[Any] = asyncio.Queue(self._queuesize)
+        if self._replay and self._latest is not None:
+            queue.put_nowait(self._latest)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: "asyncio.Queue[Any]") -> None:
+        self._subscribers.discard(queue)
+
+    def publish(self, item: Any) -> None:
+        """Queue an item for every subscriber, dropping stale frames of full queues"""
+        self._latest = item
+        for queue in self._subscribers:
+            while queue.full():
+                queue.get_nowait()
+            queue.put_nowait(item)
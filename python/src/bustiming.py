@@ -0,0 +1,98 @@
+"""
+Modbus RTU bus timing
+
+Enforces the silent interval between frames based on when the previous
+frame actually ended, instead of a fixed sleep before every request.
+The gap backs off after timeouts and CRC errors and recovers gradually
+on successful transactions.
+"""
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic, sleep
+from typing import Iterator, Optional
+
+import minimalmodbus
+
+BITS_PER_CHARACTER = 11
+SILENT_CHARACTERS = 3.5
+MINIMUM_SILENT_PERIOD = 0.00175  # Fixed value for baudrates above 19200
+
+# Gap applied after the first error, then multiplied by the backoff factor
+ERROR_GAP = 0.05
+MAX_GAP = 1.0
+BACKOFF_FACTOR = 2.0
+RECOVERY_FACTOR = 0.75
+
+# Errors that indicate the slave needs more time between frames
+BACKOFF_ERRORS = (minimalmodbus.NoResponseError, minimalmodbus.InvalidResponseError)
+
+
+def silent_period(baudrate: int) -> float:
+    """Minimum Modbus RTU silent interval (3.5 character times) in seconds"""
+    return max(BITS_PER_CHARACTER * SILENT_CHARACTERS / baudrate, MINIMUM_SILENT_PERIOD)
+
+
+class BusTiming():
+    def __init__(self, baudrate: int, max_gap: float = MAX_GAP,
+                 backoff: float = BACKOFF_FACTOR, recovery: float = RECOVERY_FACTOR) -> None:
+        self.minimum_gap = silent_period(baudrate)
+        self._max_gap = max_gap
+        self._backoff = backoff
+        self._recovery = recovery
+        self._gap = self.minimum_gap
+        self._last_frame_end = 0.0
+        self._last_request = 0.0
+        self._interval = 0.0
+        self._lock = Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def gap(self) -> float:
+        """Current gap enforced between two frames, in seconds"""
+        return self._gap
+
+    @property
+    def request_rate(self) -> float:
+        """Effective requests per second, smoothed over the recent requests"""
+        return 1 / self._interval if self._interval else 0.0
+
+    def wait(self) -> None:
+        """Sleep until the gap since the end of the previous frame has passed"""
+        remaining = self._last_frame_end + self._gap - monotonic()
+        if remaining > 0:
+            sleep(remaining)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Wait for the bus, then track the outcome of the request/response exchange"""
+        self.wait()
+        self._mark_request()
+        try:
+            yield
+        except BACKOFF_ERRORS:
+            self._finish(False)
+            raise
+        except BaseException:
+            self._finish(None)
+            raise
+        self._finish(True)
+
+    def _mark_request(self) -> None:
+        now = monotonic()
+        with self._lock:
+            if self._last_request:
+                interval = now - self._last_request
+                # Exponential moving average of the time between requests
+                self._interval = interval if not self._interval else 0.8 * self._interval + 0.2 * interval
+            self._last_request = now
+            self.requests += 1
+
+    def _finish(self, success: Optional[bool]) -> None:
+        with self._lock:
+            self._last_frame_end = monotonic()
+            if success:
+                self._gap = max(self.minimum_gap, self._gap * self._recovery)
+            elif success is not None:
+                self.errors += 1
+                self._gap = min(self._max_gap, max(ERROR_GAP, self._gap * self._backoff))
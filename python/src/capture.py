@@ -0,0 +1,217 @@
+"""
+Binary capture and replay of Modbus RTU traffic
+
+`CaptureSerial` wraps the serial port of an instrument and records the
+request and response bytes of every transaction; `SRNEInverter` commits
+each one with its outcome to a `CaptureWriter`, which buffers records in
+memory and appends them to the capture file in batches.
+
+File layout (little endian):
+    header: magic 'SRNECAP1', version (u8), wall clock start (f64), monotonic start (u64 ns)
+    record: start offset (u64 ns), duration (u32 us), outcome (u8),
+            request length (u16), response length (u16), request bytes, response bytes
+
+Offsets are monotonic nanoseconds since the start of the capture, the
+duration spans from writing the request to the end of the response.
+Timeouts have an empty or short response, CRC errors keep the bytes as
+received.
+
+`ReplaySerial` stands in for the serial port of an `SRNEInverter` and
+answers every request with the next recorded response to the same
+request bytes, at the recorded pace, faster, or without waiting, so
+decoding and the API can be profiled and regression tested against
+production traces.
+"""
+import os
+import struct
+from collections import deque
+from threading import Lock
+from time import monotonic, monotonic_ns, sleep, time
+from typing import Any, Iterable, Iterator, NamedTuple, Optional, Union
+
+CAPTURE_MAGIC = b'SRNECAP1'
+CAPTURE_VERSION = 1
+CAPTURE_HEADER = struct.Struct('<8sBdQ')
+RECORD_HEADER = struct.Struct('<QIBHH')
+
+# Outcome codes, the names match the error type labels of srne_modbus_errors
+OUTCOMES = ('ok', 'timeout', 'invalid_response', 'slave_exception', 'io')
+
+BUFFER_SIZE = 64 * 1024  # bytes
+FLUSH_INTERVAL = 5  # second
+
+
+class CapturedFrame(NamedTuple):
+    offset: float  # seconds since the start of the capture
+    duration: float  # second
+    outcome: str
+    request: bytes
+    response: bytes
+
+
+class CaptureWriter():
+    """Append-only capture file, shared by the inverters of a serial port"""
+
+    def __init__(self, path: str, buffer_size: int = BUFFER_SIZE, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._start = monotonic_ns()
+        self._buffer = bytearray(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time(), self._start))
+        self._file = open(path, 'wb')
+        self._flushed = monotonic()
+        self._lock = Lock()
+
+    def record(self, started: int, finished: int, outcome: str, request: bytes, response: bytes) -> None:
+        """started and finished are monotonic_ns() readings"""
+        with self._lock:
+            if self._file.closed:
+                return
+            self._buffer += RECORD_HEADER.pack(started - self._start, min((finished - started) // 1000, 0xffffffff),
+                                               OUTCOMES.index(outcome), len(request), len(response))
+            self._buffer += request
+            self._buffer += response
+            if len(self._buffer) >= self._buffer_size or monotonic() - self._flushed >= self._flush_interval:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._flush_locked()
+                self._file.close()
+
+    def _flush_locked(self) -> None:
+        if not self._file.closed:
+            self._file.write(self._buffer)
+            self._file.flush()
+        self._buffer.clear()
+        self._flushed = monotonic()
+
+
+class CaptureSerial():
+    """Serial port proxy collecting the bytes of the current transaction
+    Attributes other than read and write go to the wrapped port
+    """
+
+    def __init__(self, serial: Any, writer: CaptureWriter) -> None:
+        object.__setattr__(self, '_serial', serial)
+        object.__setattr__(self, '_writer', writer)
+        object.__setattr__(self, '_started', None)
+        object.__setattr__(self, '_request', b'')
+        object.__setattr__(self, '_response', bytearray())
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._serial, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._serial, name, value)
+
+    def write(self, data: bytes) -> Optional[int]:
+        object.__setattr__(self, '_started', monotonic_ns())
+        object.__setattr__(self, '_request', bytes(data))
+        self._response.clear()
+        return self._serial.write(data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._serial.read(size)
+        self._response += data
+        return data
+
+    def commit(self, outcome: str) -> None:
+        """Record the transaction since the last write, called once it succeeded or failed"""
+        if self._started is None:
+            return
+        self._writer.record(self._started, monotonic_ns(), outcome, self._request, bytes(self._response))
+        object.__setattr__(self, '_started', None)
+
+
+def read_capture(path: str) -> Iterator[CapturedFrame]:
+    """Frames of a capture file in recorded order, a truncated last record is ignored"""
+    with open(path, 'rb') as file:
+        data = file.read()
+    magic, version, _, _ = CAPTURE_HEADER.unpack_from(data)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+        raise ValueError(f"{path} is not a supported capture.")
+    position = CAPTURE_HEADER.size
+    while position + RECORD_HEADER.size <= len(data):
+        offset, duration, outcome, request_length, response_length = RECORD_HEADER.unpack_from(data, position)
+        position += RECORD_HEADER.size
+        end = position + request_length + response_length
+        if end > len(data):
+            break
+        yield CapturedFrame(offset / 1e9, duration / 1e6, OUTCOMES[outcome],
+                            data[position:position + request_length], data[position + request_length:end])
+        position = end
+
+
+class ReplaySerial():
+    """Serial port stand-in answering requests from a capture
+    speed 1 keeps the recorded timing, 10 replays ten times faster, 0 does not wait at all
+    Requests without a recorded response left get no answer, like a timeout
+    """
+
+    def __init__(self, frames: Union[str, Iterable[CapturedFrame]], speed: float = 1, port: str = 'replay') -> None:
+        frames = read_capture(frames) if isinstance(frames, str) else frames
+        self._responses: dict[bytes, deque[CapturedFrame]] = {}
+        for frame in frames:
+            self._responses.setdefault(frame.request, deque()).append(frame)
+        self.remaining = sum(len(queue) for queue in self._responses.values())
+        self.speed = speed
+        self.port = port
+        self.baudrate = 9600
+        self.timeout = 1.0
+        self.is_open = True
+        self.matched = 0
+        self.missed = 0
+        self._answer = b''
+        self._due: Optional[float] = None
+        self._anchor: Optional[float] = None  # monotonic time of capture offset 0
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        self.is_open = False
+
+    def reset_input_buffer(self) -> None:
+        self._answer = b''
+
+    def reset_output_buffer(self) -> None:
+        pass
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        queue = self._responses.get(bytes(data))
+        if not queue:
+            self.missed += 1
+            self._answer = b''
+            self._due = None
+            return len(data)
+        frame = queue.popleft()
+        self.remaining -= 1
+        self.matched += 1
+        self._answer = frame.response
+        self._due = None
+        if self.speed > 0:
+            if self._anchor is None:
+                self._anchor = monotonic() - frame.offset / self.speed
+            self._due = self._anchor + (frame.offset + frame.duration) / self.speed
+        return len(data)
+
+    def read(self, size: int = 1) -> bytes:
+        if self._due is not None:
+            remaining = self._due - monotonic()
+            if remaining > 0:
+                sleep(remaining)
+            self._due = None
+        data, self._answer = self._answer[:size], self._answer[size:]
+        return data
@@ -1,9 +1,11 @@
 import json
+import sys
 
 from SRNEinverter import SRNEInverter
 
 # device_id = '/dev/tty.usbserial-143240'
-device_id = '/dev/ttyUSB0'
+# Pass the pty of `python simulator.py --pty` to run without hardware
+device_id = sys.argv[1] if len(sys.argv) > 1 else '/dev/ttyUSB0'
 inverter = SRNEInverter(device_id)
 
 record = inverter.get_record()
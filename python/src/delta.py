@@ -0,0 +1,57 @@
+"""
+Change-only encoding of the record stream
+
+A full keyframe is sent first and then every `keyframe_interval`
+seconds. In between only the leaf paths that changed since the last
+value sent to the client are emitted, numeric paths can ignore changes
+smaller than a per-metric deadband.
+"""
+from time import monotonic
+from typing import Any, Optional
+
+from records import flatten_record
+
+KEYFRAME_INTERVAL = 30  # second
+
+
+def parse_deadbands(value: str) -> dict[str, float]:
+    """Parse 'battery.voltage:0.1,pv.power:10' into a deadband map"""
+    deadbands: dict[str, float] = {}
+    for item in filter(None, value.split(',')):
+        path, _, band = item.partition(':')
+        try:
+            deadbands[path] = float(band)
+        except ValueError:
+            raise ValueError(f"Invalid deadband '{item}'.")
+    return deadbands
+
+
+class DeltaEncoder():
+    def __init__(self, keyframe_interval: float = KEYFRAME_INTERVAL,
+                 deadbands: Optional[dict[str, float]] = None) -> None:
+        self._keyframe_interval = keyframe_interval
+        self._deadbands = deadbands or {}
+        self._sent: Optional[dict[str, Any]] = None
+        self._keyframe_at = 0.0
+
+    def encode(self, record: dict[str, Any]) -> tuple[str, Any]:
+        """Returns ('keyframe', record) or ('delta', {path: value}), the delta may be empty"""
+        flat = flatten_record(record)
+        now = monotonic()
+        if (self._sent is None
+                or now - self._keyframe_at >= self._keyframe_interval
+                or flat.keys() != self._sent.keys()):
+            self._sent = flat
+            self._keyframe_at = now
+            return 'keyframe', record
+        changes: dict[str, Any] = {}
+        for path, value in flat.items():
+            if self._changed(path, self._sent[path], value):
+                changes[path] = value
+        self._sent.update(changes)
+        return 'delta', changes
+
+    def _changed(self, path: str, previous: Any, value: Any) -> bool:
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+            return abs(value - previous) > self._deadbands.get(path, 0)
+        return value != previous
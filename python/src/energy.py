@@ -0,0 +1,235 @@
+"""
+Streaming energy accounting
+
+`EnergyMeter` integrates the power of every published record into running
+energy totals, so daily and monthly yields never need a scan of the stored
+samples. Channels, from the record fields:
+
+    pv                 pv.power
+    load               inverter.power
+    grid_import        grid.voltage * grid.inputCurrent, apparent power (VA)
+    battery_charge     battery.voltage * battery.current while positive
+    battery_discharge  battery.voltage * battery.current while negative
+
+Consecutive samples are integrated with the trapezoidal rule. An interval
+where the battery power changes sign is split at the interpolated zero
+crossing and an interval crossing local midnight at the boundary, so every
+channel, day and month gets its exact share. Intervals longer than
+`max_gap` (the service was stopped, the inverter did not answer, a field
+was missing or flagged) are not integrated; the seconds between records
+lost that way are reported per day.
+
+The register map has no real power register for the grid input, so
+grid_import is apparent energy: VAh, reported as kVAh, above the real
+energy drawn whenever the power factor is below 1.
+
+Totals are kept in Wh (VAh for grid_import), updated in O(1) per sample and written to a JSON
+checkpoint every `checkpoint_interval` seconds and on close().
+"""
+import json
+import os
+from datetime import date, datetime, timedelta
+from time import monotonic, time
+from typing import Any, Iterable, Optional
+
+CHANNELS = ('pv', 'load', 'grid_import', 'battery_charge', 'battery_discharge')
+APPARENT_CHANNELS = ('grid_import',)  # VA based, no real power register
+UNITS = {channel: 'kVAh' if channel in APPARENT_CHANNELS else 'kWh' for channel in CHANNELS}
+GAP_SECONDS = 'gapSeconds'
+
+MAX_GAP = 30  # second
+CHECKPOINT_INTERVAL = 60  # second
+DAYS_KEPT = 62
+MONTHS_KEPT = 24
+CHECKPOINT_VERSION = 1
+
+
+def _field(record: dict[str, Any], section: str, name: str) -> Optional[float]:
+    """Numeric field value, None when it is missing or flagged in record['quality']"""
+    value = record.get(section, {}).get(name)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or f'{section}.{name}' in record.get('quality', {}):
+        return None
+    return float(value)
+
+
+def _product(a: Optional[float], b: Optional[float]) -> Optional[float]:
+    return a * b if a is not None and b is not None else None
+
+
+def record_powers(record: dict[str, Any]) -> dict[str, Optional[float]]:
+    """Power of each source in W (VA for grid_import), None where a field is unusable; battery is positive while charging"""
+    return {
+        'pv': _field(record, 'pv', 'power'),
+        'load': _field(record, 'inverter', 'power'),
+        'grid_import': _product(_field(record, 'grid', 'voltage'), _field(record, 'grid', 'inputCurrent')),
+        'battery': _product(_field(record, 'battery', 'voltage'), _field(record, 'battery', 'current')),
+    }
+
+
+def split_trapezoid(p0: float, p1: float, seconds: float) -> tuple[float, float]:
+    """Energy in joules of the positive and of the negative part of a linear power ramp"""
+    if p0 >= 0 and p1 >= 0:
+        return (p0 + p1) / 2 * seconds, 0.0
+    if p0 <= 0 and p1 <= 0:
+        return 0.0, -(p0 + p1) / 2 * seconds
+    crossing = p0 / (p0 - p1) * seconds
+    first, second = p0 * crossing / 2, p1 * (seconds - crossing) / 2
+    return (first, -second) if p0 > 0 else (second, -first)
+
+
+def _empty() -> dict[str, float]:
+    return {**dict.fromkeys(CHANNELS, 0.0), GAP_SECONDS: 0.0}
+
+
+def _kwh(bucket: Optional[dict[str, float]]) -> dict[str, float]:
+    bucket = bucket or _empty()
+    totals = {channel: round(bucket[channel] / 1000, 3) for channel in CHANNELS}
+    if GAP_SECONDS in bucket:
+        totals[GAP_SECONDS] = round(bucket[GAP_SECONDS], 1)
+    return totals
+
+
+class EnergyMeter():
+    def __init__(self, path: Optional[str] = None, max_gap: float = MAX_GAP,
+                 checkpoint_interval: float = CHECKPOINT_INTERVAL) -> None:
+        """path of the JSON checkpoint, totals are restored from it when it exists"""
+        self._path = path
+        self._max_gap = max_gap
+        self._checkpoint_interval = checkpoint_interval
+        self._last: dict[str, tuple[float, float]] = {}  # (timestamp, W) of the previous sample per source
+        self._previous: Optional[float] = None  # timestamp of the previous record
+        self._total = dict.fromkeys(CHANNELS, 0.0)
+        self._days: dict[str, dict[str, float]] = {}
+        self._months: dict[str, dict[str, float]] = {}
+        # Local day of the latest sample: (start, end, day key, month key)
+        self._period: tuple[float, float, str, str] = (0.0, 0.0, '', '')
+        self._saved = monotonic()
+        if path is not None and os.path.exists(path):
+            self._load(path)
+
+    def add(self, record: dict[str, Any], timestamp: Optional[float] = None) -> None:
+        """Integrate a record from the previous one, an empty record (failed read) is a gap"""
+        if not record:
+            return
+        timestamp = time() if timestamp is None else timestamp
+        if self._previous is not None and timestamp - self._previous > self._max_gap:
+            self._add_gap(self._previous, timestamp)
+        self._previous = timestamp
+        for source, power in record_powers(record).items():
+            last = self._last.pop(source, None)
+            if power is None:
+                continue
+            self._last[source] = (timestamp, power)
+            if last is not None and 0 < timestamp - last[0] <= self._max_gap:
+                self._integrate(source, *last, timestamp, power)
+        if self._path is not None and monotonic() - self._saved >= self._checkpoint_interval:
+            self.save()
+
+    def totals(self, timestamp: Optional[float] = None) -> dict[str, Any]:
+        """kWh (kVAh for grid_import) per channel of today, this month and the lifetime, plus the kept days and months"""
+        _, _, day, month = self._bounds(time() if timestamp is None else timestamp)
+        return {
+            'units': UNITS,
+            'day': day,
+            'today': _kwh(self._days.get(day)),
+            'month': _kwh(self._months.get(month)),
+            'total': _kwh(self._total),
+            'days': {key: _kwh(bucket) for key, bucket in self._days.items()},
+            'months': {key: _kwh(bucket) for key, bucket in self._months.items()},
+        }
+
+    def save(self) -> None:
+        """Write the checkpoint atomically"""
+        self._saved = monotonic()
+        if self._path is None:
+            return
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = f'{self._path}.tmp'
+        with open(temporary, 'w', encoding='utf-8') as file:
+            json.dump({'version': CHECKPOINT_VERSION, 'total': self._total,
+                       'days': self._days, 'months': self._months}, file)
+        os.replace(temporary, self._path)
+
+    def close(self) -> None:
+        self.save()
+
+    def _load(self, path: str) -> None:
+        with open(path, encoding='utf-8') as file:
+            checkpoint = json.load(file)
+        if checkpoint.get('version') != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported energy checkpoint '{path}'.")
+        self._total.update(checkpoint['total'])
+        self._days = {key: {**_empty(), **bucket} for key, bucket in checkpoint['days'].items()}
+        self._months = {key: {**_empty(), **bucket} for key, bucket in checkpoint['months'].items()}
+
+    def _bounds(self, timestamp: float) -> tuple[float, float, str, str]:
+        """Start, end, day and month key of the local day of a timestamp, cached for the current day"""
+        start, end, _, _ = self._period
+        if start <= timestamp < end:
+            return self._period
+        day = datetime.fromtimestamp(timestamp).date()
+        period = (_midnight(day), _midnight(day + timedelta(days=1)), day.isoformat(), day.isoformat()[:7])
+        if timestamp >= end:
+            self._period = period
+        return period
+
+    def _buckets(self, day: str, month: str) -> tuple[dict[str, float], dict[str, float]]:
+        if day not in self._days:
+            self._days[day] = _empty()
+            for key in sorted(self._days)[:-DAYS_KEPT]:
+                del self._days[key]
+        if month not in self._months:
+            self._months[month] = _empty()
+            for key in sorted(self._months)[:-MONTHS_KEPT]:
+                del self._months[key]
+        return self._days[day], self._months[month]
+
+    def _integrate(self, source: str, t0: float, p0: float, t1: float, p1: float) -> None:
+        while t0 < t1:
+            _, end, day, month = self._bounds(t0)
+            end = min(end, t1)
+            power = p0 + (p1 - p0) * (end - t0) / (t1 - t0)
+            positive, negative = split_trapezoid(p0, power, end - t0)
+            if source == 'battery':
+                energies = (('battery_charge', positive / 3600), ('battery_discharge', negative / 3600))
+            else:
+                energies = ((source, positive / 3600),)
+            for bucket in (*self._buckets(day, month), self._total):
+                for channel, wh in energies:
+                    bucket[channel] += wh
+            t0, p0 = end, power
+
+    def _add_gap(self, t0: float, t1: float) -> None:
+        while t0 < t1:
+            _, end, day, month = self._bounds(t0)
+            end = min(end, t1)
+            for bucket in self._buckets(day, month):
+                bucket[GAP_SECONDS] += end - t0
+            t0 = end
+
+
+def _midnight(day: date) -> float:
+    return datetime.combine(day, datetime.min.time()).timestamp()
+
+
+def sum_totals(totals: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """Add up the totals() of several meters, such as the inverters of a site"""
+    combined: dict[str, Any] = {}
+    for meter_totals in totals:
+        for key, value in meter_totals.items():
+            if key in ('today', 'month', 'total'):
+                _add_kwh(combined.setdefault(key, {}), value)
+            elif key in ('days', 'months'):
+                periods = combined.setdefault(key, {})
+                for period, bucket in value.items():
+                    _add_kwh(periods.setdefault(period, {}), bucket)
+            else:
+                combined.setdefault(key, value)
+    return combined
+
+
+def _add_kwh(target: dict[str, float], bucket: dict[str, float]) -> None:
+    for channel, value in bucket.items():
+        target[channel] = round(target.get(channel, 0) + value, 3)
@@ -0,0 +1,169 @@
+"""
+Compact binary telemetry frames
+
+Frames carry the raw register words of the record commands in a fixed
+order defined by the schema version, so no field names are repeated and
+no intermediate dict tree is built. Values are decoded by the receiver
+with the decimals, signed flags and scales published by `frame_schema()`:
+value = word (two's complement when signed) / 10 ** decimals * scale.
+
+Frame layout (little endian):
+    magic 'SF', schema version (u8), flags (u8), timestamp (f64), field count (u16),
+    missing-field bitmap (1 bit per field), one u16 word per field
+
+MessagePack and CBOR variants encode [version, timestamp, words] with
+None for missing words, when the msgpack or cbor2 package is installed.
+
+`decode_frames()` decodes a batch of frames into engineering unit
+columns with one vectorized pass, for backfills and bulk ingestion.
+"""
+import struct
+from typing import Any, Callable, Iterable, Optional
+
+from readplanner import decode_register
+from registerdecoder import DecodedColumns, RegisterDecoder
+from registermap import DEFAULT_MAP, RegisterMap
+from srnecommands import INVERTER_COMMANDS
+from SRNEinverter import RECORD_COMMANDS
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Bumped whenever the fields or their decoding change, 2 added the temperatures, 3 the scales
+SCHEMA_VERSION = 3
+FRAME_FIELDS = RECORD_COMMANDS
+FRAME_MAGIC = b'SF'
+FRAME_HEADER = struct.Struct('<2sBBdH')
+FRAME_WORDS = struct.Struct(f'<{len(FRAME_FIELDS)}H')
+BITMAP_SIZE = (len(FRAME_FIELDS) + 7) // 8
+
+FRAME_MEDIA_TYPE = 'application/vnd.srne.frame'
+MSGPACK_MEDIA_TYPE = 'application/msgpack'
+CBOR_MEDIA_TYPE = 'application/cbor'
+
+# Short names accepted by the ?format= query parameter
+FORMATS = {
+    'frame': FRAME_MEDIA_TYPE,
+    'msgpack': MSGPACK_MEDIA_TYPE,
+    'cbor': CBOR_MEDIA_TYPE,
+}
+
+_ADDRESSES = [INVERTER_COMMANDS[key][0] for key in FRAME_FIELDS]
+_DECODER = RegisterDecoder(FRAME_FIELDS)
+_NOTHING_MISSING = [False] * len(FRAME_FIELDS)
+
+
+def frame_schema(register_map: RegisterMap = DEFAULT_MAP) -> dict[str, Any]:
+    """Field order and decoding parameters of the current schema version
+    Scales depend on the battery voltage variant, pass the register map of the inverter
+    """
+    return {
+        'version': SCHEMA_VERSION,
+        'fields': [
+            {'key': register.key, 'register': register.address, 'decimals': register.decimals,
+             'signed': register.signed, 'scale': register.scale}
+            for register in (register_map.registers[key] for key in FRAME_FIELDS)
+        ],
+    }
+
+
+def _words(registers: dict[int, int]) -> list[Optional[int]]:
+    return [registers.get(address) for address in _ADDRESSES]
+
+
+def encode_frame(registers: dict[int, int], timestamp: float) -> bytes:
+    words = _words(registers)
+    bitmap = bytearray(BITMAP_SIZE)
+    for index, word in enumerate(words):
+        if word is None:
+            bitmap[index // 8] |= 1 << (index % 8)
+    return (FRAME_HEADER.pack(FRAME_MAGIC, SCHEMA_VERSION, 0, timestamp, len(words))
+            + bitmap
+            + FRAME_WORDS.pack(*(word or 0 for word in words)))
+
+
+def decode_frame(data: bytes, register_map: RegisterMap = DEFAULT_MAP) -> tuple[float, dict[str, Any]]:
+    """Returns the timestamp and the value of every field with the register map scale applied, None if missing
+    Enum fields stay numbers
+    """
+    magic, version, _, timestamp, count = FRAME_HEADER.unpack_from(data)
+    if magic != FRAME_MAGIC or version != SCHEMA_VERSION or count != len(FRAME_FIELDS):
+        raise ValueError("Unsupported frame.")
+    bitmap = data[FRAME_HEADER.size:FRAME_HEADER.size + BITMAP_SIZE]
+    words = FRAME_WORDS.unpack_from(data, FRAME_HEADER.size + BITMAP_SIZE)
+    values: dict[str, Any] = {}
+    for index, (key, word) in enumerate(zip(FRAME_FIELDS, words)):
+        _, decimals, _, signed = register_map.commands[key]
+        scale, cast, names = register_map.conversion(key)
+        missing = bitmap[index // 8] & (1 << (index % 8))
+        if missing:
+            values[key] = None
+        else:
+            value = decode_register(word, decimals, signed)
+            values[key] = value if names is not None else cast(value * scale)
+    return timestamp, values
+
+
+def decode_frames(frames: Iterable[bytes], register_map: RegisterMap = DEFAULT_MAP) -> tuple[list[float], DecodedColumns]:
+    """Returns the timestamps and the columns of many frames, missing words are NaN
+    Values are in engineering units like decode_frame()
+    """
+    decoder = _DECODER if register_map is DEFAULT_MAP else RegisterDecoder(FRAME_FIELDS, register_map=register_map)
+    timestamps: list[float] = []
+    rows: list[tuple[int, ...]] = []
+    missing: list[list[bool]] = []
+    for data in frames:
+        magic, version, _, timestamp, count = FRAME_HEADER.unpack_from(data)
+        if magic != FRAME_MAGIC or version != SCHEMA_VERSION or count != len(FRAME_FIELDS):
+            raise ValueError("Unsupported frame.")
+        bits = int.from_bytes(data[FRAME_HEADER.size:FRAME_HEADER.size + BITMAP_SIZE], 'little')
+        timestamps.append(timestamp)
+        rows.append(FRAME_WORDS.unpack_from(data, FRAME_HEADER.size + BITMAP_SIZE))
+        missing.append([bool(bits >> index & 1) for index in range(count)] if bits else _NOTHING_MISSING)
+    if not rows:
+        return timestamps, decoder.decode([])
+    return timestamps, decoder.decode(rows, missing)
+
+
+def encode_msgpack(registers: dict[int, int], timestamp: float) -> bytes:
+    return msgpack.packb([SCHEMA_VERSION, timestamp, _words(registers)])
+
+
+def encode_cbor(registers: dict[int, int], timestamp: float) -> bytes:
+    return cbor2.dumps([SCHEMA_VERSION, timestamp, _words(registers)])
+
+
+def encoders() -> dict[str, Callable[[dict[int, int], float], bytes]]:
+    """Encoders by media type, limited to the installed packages"""
+    available: dict[str, Callable[[dict[int, int], float], bytes]] = {FRAME_MEDIA_TYPE: encode_frame}
+    if msgpack is not None:
+        available[MSGPACK_MEDIA_TYPE] = encode_msgpack
+    if cbor2 is not None:
+        available[CBOR_MEDIA_TYPE] = encode_cbor
+    return available
+
+
+def negotiate(accept: str) -> Optional[str]:
+    """Pick the supported binary media type preferred by an Accept header, None for JSON"""
+    available = encoders()
+    candidates: list[tuple[float, int, str]] = []
+    for position, item in enumerate(accept.split(',')):
+        media_type, *params = [part.strip() for part in item.split(';')]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in available and quality > 0:
+            candidates.append((-quality, position, media_type))
+    return min(candidates)[2] if candidates else None
@@ -0,0 +1,197 @@
+"""
+In-memory time series of inverter records
+
+A fixed size ring buffer keeps one float column per metric plus a
+timestamp column in `array` storage, so memory use only depends on the
+capacity and the number of metrics. Ranges can be returned as raw
+samples or downsampled into min/max/mean buckets, computed with NumPy
+when it is installed.
+"""
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+from time import time
+from typing import Any, Iterable, Optional, Sequence
+
+from records import RECORD_METRICS, record_metrics
+
+try:
+    import numpy as np
+except ImportError:  # Downsampling falls back to plain Python
+    np = None
+
+DEFAULT_CAPACITY = 24 * 3600  # 24 h at 1 Hz
+
+
+class History():
+    def __init__(self, capacity: int = DEFAULT_CAPACITY, metrics: Iterable[str] = RECORD_METRICS) -> None:
+        self.metrics = tuple(metrics)
+        self.capacity = capacity
+        self._times = array('d', [0.0]) * capacity
+        self._columns = {metric: array('d', [math.nan]) * capacity for metric in self.metrics}
+        self._next = 0
+        self._size = 0
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def memory_bytes(self) -> int:
+        """Memory used by the sample storage"""
+        return (len(self._columns) + 1) * self.capacity * self._times.itemsize
+
+    def append(self, record: dict[str, Any], timestamp: Optional[float] = None) -> None:
+        """Add a record, overwriting the oldest sample once the buffer is full"""
+        values = record_metrics(record, self.metrics)
+        with self._lock:
+            index = self._next
+            self._times[index] = time() if timestamp is None else timestamp
+            for column, value in zip(self._columns.values(), values):
+                column[index] = value
+            self._next = (index + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def extend(self, timestamps: Sequence[float], columns: dict[str, Sequence[float]]) -> None:
+        """Add many samples at once, such as decoded frame columns or a backfill
+        columns are keyed by metric (NumPy arrays or sequences of floats), missing metrics are NaN;
+        samples have to be newer than the ones already stored
+        """
+        count = len(timestamps)
+        skip = max(0, count - self.capacity)  # Only the newest samples fit
+        with self._lock:
+            position = skip
+            while position < count:
+                index = self._next
+                chunk = min(count - position, self.capacity - index)
+                self._times[index:index + chunk] = _as_array(timestamps[position:position + chunk])
+                for metric, column in self._columns.items():
+                    values = columns.get(metric)
+                    column[index:index + chunk] = (_as_array(values[position:position + chunk]) if values is not None
+                                                   else array('d', [math.nan]) * chunk)
+                position += chunk
+                self._next = (index + chunk) % self.capacity
+                self._size = min(self._size + chunk, self.capacity)
+
+    def range(self, start: float, end: float, metrics: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Returns the raw samples between start and end (inclusive) as columns"""
+        times, columns = self._select(start, end, metrics)
+        return {
+            't': times.tolist(),
+            'values': {metric: _json_values(column) for metric, column in columns.items()},
+        }
+
+    def downsample(self, start: float, end: float, bucket: float,
+                   metrics: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Returns min, max and mean of every bucket of `bucket` seconds between start and end
+        Buckets are aligned to multiples of their size, buckets without samples
+        are left out and NaN values are ignored
+        """
+        if bucket <= 0:
+            raise ValueError("Bucket size should be greater than 0.")
+        times, columns = self._select(start, end, metrics)
+        origin = start - start % bucket
+        if np is not None:
+            return _downsample_numpy(times, columns, origin, bucket)
+        return _downsample_python(times, columns, origin, bucket)
+
+    def _select(self, start: float, end: float,
+                metrics: Optional[Iterable[str]]) -> tuple["array[float]", dict[str, "array[float]"]]:
+        metrics = self.metrics if metrics is None else tuple(metrics)
+        unknown = set(metrics).difference(self._columns)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+        with self._lock:
+            first = self._next - self._size
+            view = _RingView(self._times, first, self._size)
+            low = bisect_left(view, start)
+            high = bisect_right(view, end)
+            times = self._slice(self._times, first, low, high)
+            columns = {metric: self._slice(self._columns[metric], first, low, high) for metric in metrics}
+        return times, columns
+
+    def _slice(self, column: "array[float]", first: int, low: int, high: int) -> "array[float]":
+        """Copy the chronological positions [low, high) out of the ring"""
+        begin = (first + low) % self.capacity
+        count = high - low
+        if begin + count <= self.capacity:
+            return column[begin:begin + count]
+        return column[begin:] + column[:begin + count - self.capacity]
+
+
+class _RingView():
+    """Chronological read-only view of a ring buffer column, usable with bisect"""
+
+    def __init__(self, column: "array[float]", first: int, size: int) -> None:
+        self._column = column
+        self._first = first
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, position: int) -> float:
+        return self._column[(self._first + position) % len(self._column)]
+
+
+def _as_array(values: Sequence[float]) -> "array[float]":
+    if np is not None and isinstance(values, np.ndarray):
+        column = array('d')
+        column.frombytes(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+        return column
+    return array('d', values)
+
+
+def _json_values(values: Iterable[float]) -> list[Optional[float]]:
+    return [None if math.isnan(value) else value for value in values]
+
+
+def _downsample_numpy(times: "array[float]", columns: dict[str, "array[float]"],
+                      start: float, bucket: float) -> dict[str, Any]:
+    result: dict[str, Any] = {'t': [], 'min': {}, 'max': {}, 'mean': {}}
+    if not times:
+        for key in ('min', 'max', 'mean'):
+            result[key] = {metric: [] for metric in columns}
+        return result
+    buckets = ((np.frombuffer(times) - start) // bucket).astype(np.int64)
+    # Samples are sorted, so every bucket is a contiguous run starting at these offsets
+    offsets = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    result['t'] = (start + buckets[offsets] * bucket).tolist()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for metric, column in columns.items():
+            values = np.frombuffer(column)
+            valid = ~np.isnan(values)
+            sums = np.add.reduceat(np.where(valid, values, 0.0), offsets)
+            counts = np.add.reduceat(valid.astype(np.int64), offsets)
+            result['min'][metric] = _json_values(np.fmin.reduceat(values, offsets).tolist())
+            result['max'][metric] = _json_values(np.fmax.reduceat(values, offsets).tolist())
+            result['mean'][metric] = _json_values((sums / counts).tolist())
+    return result
+
+
+def _downsample_python(times: "array[float]", columns: dict[str, "array[float]"],
+                       start: float, bucket: float) -> dict[str, Any]:
+    offsets: list[int] = []
+    result: dict[str, Any] = {'t': [], 'min': {}, 'max': {}, 'mean': {}}
+    previous = None
+    for offset, timestamp in enumerate(times):
+        index = (timestamp - start) // bucket
+        if index != previous:
+            offsets.append(offset)
+            result['t'].append(start + index * bucket)
+            previous = index
+    bounds = list(zip(offsets, offsets[1:] + [len(times)]))
+    for metric, column in columns.items():
+        mins: list[Optional[float]] = []
+        maxs: list[Optional[float]] = []
+        means: list[Optional[float]] = []
+        for low, high in bounds:
+            values = [value for value in column[low:high] if not math.isnan(value)]
+            mins.append(min(values) if values else None)
+            maxs.append(max(values) if values else None)
+            means.append(sum(values) / len(values) if values else None)
+        result['min'][metric] = mins
+        result['max'][metric] = maxs
+        result['mean'][metric] = means
+    return result
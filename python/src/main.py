@@ -1,22 +1,234 @@
 import asyncio
+import base64
 import json
+import os
+from contextlib import asynccontextmanager
+from time import time
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request, Response
 from sse_starlette.sse import EventSourceResponse
 
-import srnecommands
-from SRNEinverter import ChargerPriority, OutputPriority, SRNEInverter
-from validator import Validator
+from alerts import DEFAULT_RULES, AlertEngine, WebhookNotifier, load_rules
+from asyncinverter import AsyncSRNEInverter
+from broadcaster import Broadcaster
+from capture import ReplaySerial
+from delta import KEYFRAME_INTERVAL, DeltaEncoder, parse_deadbands
+from energy import APPARENT_CHANNELS, EnergyMeter, sum_totals
+from frames import FORMATS, encoders, frame_schema, negotiate
+from history import History
+from metrics import (
+    OPENMETRICS_MEDIA_TYPE,
+    PROMETHEUS_MEDIA_TYPE,
+    REGISTRY,
+    Gauge,
+    metric_name,
+)
+from modbusgateway import ModbusGateway
+from mqttclient import PahoClient
+from mqttcommands import MqttCommands
+from mqttpublisher import MqttPublisher
+from records import RECORD_METRICS, record_metrics
+from registry import SITE_ID, InverterConfig, InverterRegistry
+from spool import DiskSpool
+from SRNEinverter import ChargerPriority, OutputPriority
+from tsstore import TelemetryStore
+from validator import validate_command
 
 # device_id = '/dev/tty.usbserial-143240'
-device_id = "/dev/ttyUSB0"
-inverter = SRNEInverter(device_id, mock=False)
+# SRNE_DEVICE can point to the pty printed by `python simulator.py --pty`
+device_id = os.environ.get("SRNE_DEVICE", "/dev/ttyUSB0")
+
+# Every inverter gets an id used by the ?inverter= query parameter, the first one is the default
+# Inverters in parallel on the same RS485 bus share the port with different slave addresses
+INVERTERS = [
+    InverterConfig("main", device_id, slaveaddress=1),
+    # InverterConfig("second", device_id, slaveaddress=2),
+]
 
 STREAM_DELAY = 1  # second
 RETRY_TIMEOUT = 15000  # milisecond
+HISTORY_WINDOW = 24 * 3600  # second
+STORAGE_PATH = "data"  # telemetry segments, one directory per inverter
+
+# Telemetry is published to MQTT when MQTT_HOST is set (same variables as the inverter bridge)
+MQTT_HOST = os.environ.get("MQTT_HOST")
+MQTT_PREFIX = os.environ.get("MQTT_PREFIX", "inverter")
+
+# SRNE_CAPTURE_DIR records the bus traffic of every port (capture.py), SRNE_REPLAY answers the
+# requests on SRNE_DEVICE from such a capture instead, at SRNE_REPLAY_SPEED times the recorded pace
+CAPTURE_DIR = os.environ.get("SRNE_CAPTURE_DIR")
+REPLAY_PATH = os.environ.get("SRNE_REPLAY")
+transports = {}
+if REPLAY_PATH:
+    transports[device_id] = ReplaySerial(REPLAY_PATH, float(os.environ.get("SRNE_REPLAY_SPEED", 1)), device_id)
+
+registry = InverterRegistry(INVERTERS, STREAM_DELAY, transports, CAPTURE_DIR)
+histories = {
+    inverter_id: History(int(HISTORY_WINDOW / STREAM_DELAY))
+    for inverter_id in [*registry.ids, SITE_ID]
+}
+stores = {
+    inverter_id: TelemetryStore(os.path.join(STORAGE_PATH, inverter_id))
+    for inverter_id in [*registry.ids, SITE_ID]
+}
+# Running kWh totals per inverter, checkpointed next to its telemetry segments
+meters = {
+    inverter_id: EnergyMeter(os.path.join(STORAGE_PATH, inverter_id, "energy.json"))
+    for inverter_id in registry.ids
+}
+
+
+# Alert rules evaluated on every published record, ALERT_RULES can point to a JSON list of rules
+ALERT_RULES = os.environ.get("ALERT_RULES")
+alerts = AlertEngine(load_rules(ALERT_RULES) if ALERT_RULES else DEFAULT_RULES)
+alert_broadcaster = Broadcaster(queuesize=64, replay=False)
+alerts.add_listener(alert_broadcaster.publish)
+# Comma separated URLs receiving {"events": [...]} batches
+ALERT_WEBHOOKS = [url for url in os.environ.get("ALERT_WEBHOOKS", "").split(",") if url]
+webhooks = None
+if ALERT_WEBHOOKS:
+    webhooks = WebhookNotifier(ALERT_WEBHOOKS)
+    alerts.add_listener(webhooks.notify)
+
+
+def record_listener(inverter_id: str, record, timestamp: float):
+    if record:
+        histories[inverter_id].append(record, timestamp)
+        stores[inverter_id].append(record, timestamp)
+        if inverter_id != SITE_ID:
+            meters[inverter_id].add(record, timestamp)
+            alerts.evaluate(inverter_id, record, timestamp)
+
+
+registry.add_listener(record_listener)
+
+mqtt_client = None
+mqtt_publisher = None
+mqtt_commands = None
+if MQTT_HOST:
+    mqtt_client = PahoClient(
+        MQTT_HOST,
+        int(os.environ.get("MQTT_PORT", 1883)),
+        os.environ.get("MQTT_USERNAME"),
+        os.environ.get("MQTT_PASSWORD"),
+        tls=os.environ.get("MQTT_TLS", "") == "1",
+        prefix=MQTT_PREFIX,
+    )
+    mqtt_publisher = MqttPublisher(
+        mqtt_client,
+        MQTT_PREFIX,
+        deadbands=parse_deadbands(os.environ.get("MQTT_DEADBANDS", "")),
+        spool=DiskSpool(os.path.join(STORAGE_PATH, "mqtt-spool")),
+    )
+    registry.add_listener(mqtt_publisher.publish)
+    # Control commands from <prefix>/<inverter>/cmd/<name>, acknowledged on .../cmd/ack
+    mqtt_commands = MqttCommands(mqtt_client, registry, MQTT_PREFIX)
+
+# Modbus TCP gateway sharing the RS485 link with other clients when MODBUS_TCP_PORT is set
+# Unit ids are the inverter slave addresses; MODBUS_TCP_WRITES=mapped|all|none
+MODBUS_TCP_PORT = os.environ.get("MODBUS_TCP_PORT")
+modbus_gateway = None
+if MODBUS_TCP_PORT:
+    modbus_gateway = ModbusGateway(
+        registry.units(),
+        os.environ.get("MODBUS_TCP_HOST", "127.0.0.1"),
+        int(MODBUS_TCP_PORT),
+        writes=os.environ.get("MODBUS_TCP_WRITES", "mapped"),
+        max_age=2 * STREAM_DELAY,
+    )
+
+# Exported by /metrics from the latest snapshots, a scrape never reads the inverter
+RECORD_GAUGES = [
+    Gauge(metric_name(path), f"Latest published value of {path}", ("inverter",))
+    for path in RECORD_METRICS
+]
+RECORD_TIMESTAMP = Gauge("srne_record_timestamp_seconds", "Time of the latest published record", ("inverter",))
+STREAM_CLIENTS = Gauge("srne_stream_clients", "Connected /stream clients", ("inverter",))
+ENERGY_TOTAL = Gauge("srne_energy_kwh", "Lifetime energy by channel", ("inverter", "channel"))
+ENERGY_APPARENT_TOTAL = Gauge("srne_energy_kvah", "Lifetime apparent energy by channel", ("inverter", "channel"))
+
 
-app = FastAPI()
+def collect_metrics():
+    for inverter_id, meter in meters.items():
+        for channel, value in meter.totals()["total"].items():
+            gauge = ENERGY_APPARENT_TOTAL if channel in APPARENT_CHANNELS else ENERGY_TOTAL
+            gauge.set(value, (inverter_id, channel))
+    for inverter_id in [*registry.ids, SITE_ID]:
+        STREAM_CLIENTS.set(registry.broadcaster(inverter_id).client_count, (inverter_id,))
+        snapshot = registry.latest(inverter_id)
+        if snapshot is None:
+            continue
+        RECORD_TIMESTAMP.set(snapshot.timestamp, (inverter_id,))
+        for gauge, value in zip(RECORD_GAUGES, record_metrics(snapshot.record)):
+            gauge.set(value, (inverter_id,))
+
+
+REGISTRY.add_callback(collect_metrics)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if mqtt_client is not None:
+        mqtt_commands.start()
+        mqtt_client.start()
+        mqtt_publisher.start()
+    if webhooks is not None:
+        webhooks.start()
+    registry.start()
+    if modbus_gateway is not None:
+        await modbus_gateway.start()
+    yield
+    if modbus_gateway is not None:
+        await modbus_gateway.stop()
+    if mqtt_commands is not None:
+        await mqtt_commands.stop()
+    await registry.stop()
+    if webhooks is not None:
+        await webhooks.stop()
+    if mqtt_client is not None:
+        mqtt_publisher.stop()
+        mqtt_client.stop()
+    for store in stores.values():
+        store.close()
+    for meter in meters.values():
+        meter.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def select_inverter(request: Request) -> AsyncSRNEInverter:
+    inverter_id = request.query_params.get("inverter")
+    try:
+        return registry.get(inverter_id)
+    except KeyError:
+        raise HTTPException(404, f"Unknown inverter '{inverter_id}'.")
+
+
+def select_binary_encoder(request: Request):
+    """Binary encoder chosen with ?format= or the Accept header, None for JSON"""
+    inverter_id = request.query_params.get("inverter")
+    name = request.query_params.get("format")
+    if name is not None:
+        media_type = FORMATS.get(name)
+        if media_type not in encoders():
+            raise HTTPException(406, f"Format '{name}' is not available.")
+    else:
+        media_type = negotiate(request.headers.get("accept", ""))
+        if media_type is None:
+            return None
+    if inverter_id == SITE_ID:
+        raise HTTPException(406, "Binary frames are not available for the site total.")
+    return encoders()[media_type]
+
+
+def select_broadcaster(request: Request) -> Broadcaster:
+    inverter_id = request.query_params.get("inverter")
+    try:
+        return registry.broadcaster(inverter_id)
+    except KeyError:
+        raise HTTPException(404, f"Unknown inverter '{inverter_id}'.")
 
 
 @app.get("/")
@@ -24,38 +236,206 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/inverters")
+async def list_inverters():
+    return {
+        "default": registry.default_id,
+        "site": SITE_ID,
+        "inverters": [config._asdict() for config in registry.configs],
+        "ports": registry.ports(),
+    }
+
+
 @app.get("/stream")
 async def message_stream(request: Request):
-    def new_messages():
+    """mode=delta sends a keyframe on connect and every `keyframe` seconds, and only the
+    changed paths in between. deadbands=battery.voltage:0.1,pv.power:10 ignores smaller changes
+    format=frame|msgpack|cbor (or a matching Accept media type) sends base64 binary frames
+    """
+    broadcaster = select_broadcaster(request)
+    params = request.query_params
+    binary = select_binary_encoder(request)
+    encoder = None
+    if params.get("mode") == "delta":
         try:
-            record = inverter.get_record()
-            return record
-        except:
-            return {}
+            encoder = DeltaEncoder(
+                float(params.get("keyframe", KEYFRAME_INTERVAL)),
+                parse_deadbands(params.get("deadbands", "")),
+            )
+        except ValueError as e:
+            raise HTTPException(400, str(e))
 
     async def event_generator():
-        while True:
-            if await request.is_disconnected():
-                break
-            yield {
-                "event": "message",
-                "id": "message_id",
-                "retry": RETRY_TIMEOUT,
-                "data": json.dumps(new_messages()),
-            }
-            await asyncio.sleep(STREAM_DELAY)
+        queue = broadcaster.subscribe()
+        try:
+            while True:
+                if await request.is_disconnected():
+                    break
+                snapshot = await queue.get()
+                record = snapshot.record
+                if binary is not None:
+                    if snapshot.registers is None:
+                        continue
+                    yield {
+                        "event": "frame",
+                        "retry": RETRY_TIMEOUT,
+                        "data": base64.b64encode(binary(snapshot.registers, snapshot.timestamp)).decode(),
+                    }
+                    continue
+                if encoder is None:
+                    yield {
+                        "event": "message",
+                        "id": "message_id",
+                        "retry": RETRY_TIMEOUT,
+                        "data": json.dumps(record),
+                    }
+                    continue
+                event, data = encoder.encode(record)
+                if data or event == "keyframe":
+                    yield {
+                        "event": event,
+                        "retry": RETRY_TIMEOUT,
+                        "data": json.dumps(data, separators=(",", ":")),
+                    }
+        finally:
+            broadcaster.unsubscribe(queue)
+
+    return EventSourceResponse(event_generator())
+
+
+@app.get("/snapshot")
+async def get_snapshot(request: Request):
+    """Latest record, as a binary frame when the Accept header or ?format= asks for one"""
+    snapshot = select_broadcaster(request).latest
+    if snapshot is None:
+        return {"success": False, "message": "No data has been read yet."}
+    binary = select_binary_encoder(request)
+    if binary is None:
+        return {"success": True, "timestamp": snapshot.timestamp, "record": snapshot.record}
+    if snapshot.registers is None:
+        raise HTTPException(406, "Binary frames are only available per inverter.")
+    media_type = FORMATS.get(request.query_params.get("format", "")) or negotiate(request.headers.get("accept", ""))
+    return Response(binary(snapshot.registers, snapshot.timestamp), media_type=media_type)
+
+
+@app.get("/metrics")
+async def get_metrics(request: Request):
+    """Prometheus exposition, OpenMetrics when the Accept header asks for it"""
+    openmetrics = "application/openmetrics-text" in request.headers.get("accept", "")
+    return Response(
+        REGISTRY.render(openmetrics),
+        media_type=OPENMETRICS_MEDIA_TYPE if openmetrics else PROMETHEUS_MEDIA_TYPE,
+    )
+
+
+@app.get("/frame-schema")
+async def get_frame_schema(request: Request):
+    return frame_schema(select_inverter(request).inverter.register_map)
+
+
+@app.get("/history")
+async def get_history(request: Request):
+    """Samples between start and end (unix seconds, last hour by default)
+    metrics: comma separated dotted paths, all metrics by default
+    bucket: when given, returns min/max/mean per bucket of that many seconds
+    """
+    params = request.query_params
+    history = histories.get(params.get("inverter") or registry.default_id)
+    if history is None:
+        raise HTTPException(404, f"Unknown inverter '{params.get('inverter')}'.")
+    try:
+        end = float(params.get("end", time()))
+        start = float(params.get("start", end - 3600))
+        metrics = params["metrics"].split(",") if "metrics" in params else None
+        if "bucket" in params:
+            series = await asyncio.to_thread(history.downsample, start, end, float(params["bucket"]), metrics)
+        else:
+            series = await asyncio.to_thread(history.range, start, end, metrics)
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    return {"success": True, **series}
+
+
+@app.get("/archive")
+async def get_archive(request: Request):
+    """Stored samples between start and end (unix seconds, last day by default)
+    metrics: comma separated dotted paths, all metrics by default
+    bucket: when given, returns min/max/mean per bucket of that many seconds from the block index
+    """
+    params = request.query_params
+    store = stores.get(params.get("inverter") or registry.default_id)
+    if store is None:
+        raise HTTPException(404, f"Unknown inverter '{params.get('inverter')}'.")
+    try:
+        end = float(params.get("end", time()))
+        start = float(params.get("start", end - 24 * 3600))
+        metrics = params["metrics"].split(",") if "metrics" in params else None
+        if "bucket" in params:
+            series = await asyncio.to_thread(store.summary, start, end, float(params["bucket"]), metrics)
+        else:
+            series = await asyncio.to_thread(store.query, start, end, metrics)
+    except ValueError as e:
+        return {"success": False, "message": str(e)}
+    return {"success": True, **series}
+
+
+@app.get("/energy")
+async def get_energy(request: Request):
+    """kWh per channel (pv, load, grid_import, battery_charge, battery_discharge) of today,
+    this month and the lifetime, plus the recent days and months; site adds up the inverters
+    grid_import is apparent energy in kVAh, see units
+    """
+    inverter_id = request.query_params.get("inverter") or registry.default_id
+    if inverter_id == SITE_ID:
+        return {"success": True, **sum_totals(meter.totals() for meter in meters.values())}
+    meter = meters.get(inverter_id)
+    if meter is None:
+        raise HTTPException(404, f"Unknown inverter '{inverter_id}'.")
+    return {"success": True, **meter.totals()}
+
+
+@app.get("/alerts")
+async def get_alerts(request: Request):
+    """Raised alerts (of one inverter with ?inverter=) and the configured rules"""
+    return {
+        "success": True,
+        "active": alerts.active(request.query_params.get("inverter")),
+        "rules": [rule.describe() for rule in alerts.rules],
+    }
+
+
+@app.get("/alerts/stream")
+async def alert_stream(request: Request):
+    """SSE: the raised alerts as an 'active' event on connect, then every 'alert' transition"""
+    inverter_id = request.query_params.get("inverter")
+
+    async def event_generator():
+        queue = alert_broadcaster.subscribe()
+        try:
+            yield {"event": "active", "retry": RETRY_TIMEOUT, "data": json.dumps(alerts.active(inverter_id))}
+            while True:
+                if await request.is_disconnected():
+                    break
+                event = await queue.get()
+                if inverter_id is None or event["inverter"] == inverter_id:
+                    yield {"event": "alert", "retry": RETRY_TIMEOUT, "data": json.dumps(event)}
+        finally:
+            alert_broadcaster.unsubscribe(queue)
 
     return EventSourceResponse(event_generator())
 
 
 @app.post("/set/output-priority")
 async def set_output_priority(request: Request):
+    inverter = select_inverter(request)
     request_data = await request.json()
     value = request_data.get("value")
-    validation = Validator(value).maximum(2).minimum(0).validate()
-    if validation:
-        if inverter.set_inverter_output_priority(OutputPriority(value)):
-            new_value = inverter.get_inverter_output_priority()
+    validation = validate_command(
+        "inverter_output_priority_write", value, inverter.inverter.register_map.write_limits
+    )
+    if validation is True:
+        if await inverter.set_inverter_output_priority(OutputPriority(value)):
+            new_value = await inverter.get_inverter_output_priority()
             return {"success": True, "value": new_value}
         else:
             return {
@@ -68,12 +448,15 @@ async def set_output_priority(request: Request):
 
 @app.post("/set/charger-priority")
 async def set_charger_priority(request: Request):
+    inverter = select_inverter(request)
     request_data = await request.json()
     value = request_data.get("value")
-    validation = Validator(value).maximum(3).minimum(0).validate()
-    if validation:
-        if inverter.set_inverter_charger_priority(ChargerPriority(value)):
-            new_value = inverter.get_inverter_charger_priority()
+    validation = validate_command(
+        "inverter_charger_priority_write", value, inverter.inverter.register_map.write_limits
+    )
+    if validation is True:
+        if await inverter.set_inverter_charger_priority(ChargerPriority(value)):
+            new_value = await inverter.get_inverter_charger_priority()
             return {"success": True, "value": new_value}
         else:
             return {
@@ -86,18 +469,15 @@ async def set_charger_priority(request: Request):
 
 @app.post("/set/grid-charge-current")
 async def set_grid_charge_current(request: Request):
+    inverter = select_inverter(request)
     request_data = await request.json()
     value = request_data.get("value")
-    validation = (
-        Validator(value)
-        .maximum(srnecommands.MAX_UTILITY_CHARGE_CURRENT)
-        .minimum(srnecommands.MIN_UTILITY_CHARGE_CURRENT)
-        .multiple(srnecommands.MULTIPLIER_UTILITY_CHARGE_CURRENT)
-        .validate()
+    validation = validate_command(
+        "grid_battery_charge_max_current_write", value, inverter.inverter.register_map.write_limits
     )
-    if validation:
-        if inverter.set_grid_battery_charger_maximum_current(value):
-            new_value = inverter.get_grid_battery_charge_max_current()
+    if validation is True:
+        if await inverter.set_grid_battery_charger_maximum_current(value):
+            new_value = await inverter.get_grid_battery_charge_max_current()
             return {"success": True, "value": new_value}
         else:
             return {
@@ -110,18 +490,15 @@ async def set_grid_charge_current(request: Request):
 
 @app.post("/set/max-charge-current")
 async def set_max_charge_current(request: Request):
+    inverter = select_inverter(request)
     request_data = await request.json()
     value = request_data.get("value")
-    validation = (
-        Validator(value)
-        .maximum(srnecommands.MAX_CHARGE_CURRENT)
-        .minimum(srnecommands.MIN_CHARGE_CURRENT)
-        .multiple(srnecommands.MULTIPLIER_CHARGE_CURRENT)
-        .validate()
+    validation = validate_command(
+        "battery_max_charge_current_write", value, inverter.inverter.register_map.write_limits
     )
-    if validation:
-        if inverter.set_battery_charge_max_current(value):
-            new_value = inverter.get_battery_charge_max_current()
+    if validation is True:
+        if await inverter.set_battery_charge_max_current(value):
+            new_value = await inverter.get_battery_charge_max_current()
             return {"success": True, "value": new_value}
         else:
             return {
@@ -132,15 +509,29 @@ async def set_max_charge_current(request: Request):
         return {"success": False, "message": validation.get("message")}
 
 
+@app.post("/set/settings")
+async def set_settings(request: Request):
+    inverter = select_inverter(request)
+    request_data = await request.json()
+    if not isinstance(request_data, dict) or not request_data:
+        return {"success": False, "message": "Expected an object of settings."}
+    results = await inverter.apply_settings(request_data)
+    return {
+        "success": all(result["success"] for result in results.values()),
+        "results": results,
+    }
+
+
 @app.get("/get/all-configs")
 async def get_all_config(request: Request):
+    inverter = select_inverter(request)
     try:
         return {
             "success": True,
-            "chargerPriority": inverter.get_inverter_charger_priority(),
-            "outputPriority": inverter.get_inverter_output_priority(),
-            "maxBatteryChargeCurrent": inverter.get_battery_charge_max_current(),
-            "maxGridChargeCurrent": inverter.get_grid_battery_charge_max_current(),
+            "chargerPriority": await inverter.get_inverter_charger_priority(),
+            "outputPriority": await inverter.get_inverter_output_priority(),
+            "maxBatteryChargeCurrent": await inverter.get_battery_charge_max_current(),
+            "maxGridChargeCurrent": await inverter.get_grid_battery_charge_max_current(),
         }
     except:
         return {
@@ -0,0 +1,192 @@
+"""
+Prometheus metrics
+
+Counters, gauges and histograms with labels, rendered in the Prometheus
+text format or in OpenMetrics for GET /metrics. Updating a metric is a
+dict lookup under a lock, so they can be used on the Modbus hot path.
+Scrape-time values (latest records, client counts) are set by callbacks
+registered with `MetricsRegistry.add_callback()` right before rendering.
+"""
+import math
+import re
+from threading import Lock
+from typing import Any, Callable, Iterable, Optional
+
+PROMETHEUS_MEDIA_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+OPENMETRICS_MEDIA_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# Histogram buckets in seconds, sized for Modbus transactions
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+Labels = tuple[str, ...]
+
+
+def metric_name(path: str, prefix: str = 'srne') -> str:
+    """Metric name of a dotted record path, 'battery.chargePower' -> 'srne_battery_charge_power'"""
+    snake = re.sub(r'(?<=[a-z0-9])([A-Z])', r'_\1', path).lower().replace('.', '_')
+    return f'{prefix}_{snake}'
+
+
+def _format_value(value: float) -> str:
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _sample(name: str, labelnames: Iterable[str], labels: Iterable[str], value: float) -> str:
+    pairs = ','.join(f'{labelname}="{_escape(label)}"' for labelname, label in zip(labelnames, labels))
+    return f'{name}{{{pairs}}} {_format_value(value)}' if pairs else f'{name} {_format_value(value)}'
+
+
+class MetricsRegistry():
+    def __init__(self) -> None:
+        self._metrics: list["Metric"] = []
+        self._callbacks: list[Callable[[], None]] = []
+        self._lock = Lock()
+
+    def register(self, metric: "Metric") -> None:
+        with self._lock:
+            if any(existing.name == metric.name for existing in self._metrics):
+                raise ValueError(f"Metric '{metric.name}' is already registered.")
+            self._metrics.append(metric)
+
+    def add_callback(self, callback: Callable[[], None]) -> None:
+        """Call callback() before every render, to update metrics from the latest state"""
+        self._callbacks.append(callback)
+
+    def render(self, openmetrics: bool = False) -> str:
+        for callback in self._callbacks:
+            callback()
+        with self._lock:
+            metrics = list(self._metrics)
+        lines: list[str] = []
+        for metric in metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+
+# Registry the metrics are added to when none is given
+REGISTRY = MetricsRegistry()
+
+
+class Metric():
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 registry: Optional[MetricsRegistry] = None) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[Labels, Any] = {}
+        self._lock = Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Iterable[Any]) -> Labels:
+        key = tuple(str(label) for label in labels)
+        if len(key) != len(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' expects labels {self.labelnames}.")
+        return key
+
+    def remove(self, labels: Iterable[Any] = ()) -> None:
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def render(self, openmetrics: bool = False) -> list[str]:
+        with self._lock:
+            values = self._copy()
+        lines = [
+            f'# HELP {self.name} {_escape(self.documentation)}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        for labels, value in sorted(values.items()):
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _copy(self) -> dict[Labels, Any]:
+        return dict(self._values)
+
+    def _samples(self, labels: Labels, value: Any) -> list[str]:
+        return [_sample(self.name, self.labelnames, labels, value)]
+
+
+class Counter(Metric):
+    """Monotonic counter, the name is given without the _total suffix"""
+    kind = 'counter'
+
+    def inc(self, labels: Iterable[Any] = (), amount: float = 1) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, labels: Iterable[Any] = ()) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self, openmetrics: bool = False) -> list[str]:
+        lines = super().render(openmetrics)
+        if not openmetrics:
+            # The text format types the sample name, OpenMetrics the family name
+            lines[:2] = [line.replace(f' {self.name} ', f' {self.name}_total ', 1) for line in lines[:2]]
+        return lines
+
+    def _samples(self, labels: Labels, value: Any) -> list[str]:
+        return [_sample(f'{self.name}_total', self.labelnames, labels, value)]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, labels: Iterable[Any] = ()) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, labels: Iterable[Any] = ()) -> float:
+        return self._values.get(self._key(labels), math.nan)
+
+
+class Histogram(Metric):
+    """Cumulative histogram, each label set keeps [bucket counts, sum, count]"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Iterable[float] = LATENCY_BUCKETS, registry: Optional[MetricsRegistry] = None) -> None:
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, labels: Iterable[Any] = ()) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def _copy(self) -> dict[Labels, Any]:
+        # observe() mutates the bucket counts in place
+        return {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+
+    def _samples(self, labels: Labels, value: Any) -> list[str]:
+        counts, total, count = value
+        names = (*self.labelnames, 'le')
+        lines: list[str] = []
+        cumulative = 0
+        for bound, bucket in zip(self.buckets, counts):
+            cumulative += bucket
+            lines.append(_sample(f'{self.name}_bucket', names, (*labels, _format_value(bound)), cumulative))
+        lines.append(_sample(f'{self.name}_bucket', names, (*labels, '+Inf'), count))
+        lines.append(_sample(f'{self.name}_sum', self.labelnames, labels, total))
+        lines.append(_sample(f'{self.name}_count', self.labelnames, labels, count))
+        return lines
@@ -0,0 +1,217 @@
+"""
+Modbus TCP gateway
+
+Lets other Modbus clients (home automation, the vendor tool, scripts)
+share the RS485 link owned by this service. Requests arrive as Modbus TCP
+frames (MBAP header) and are addressed by unit id, the slave address of a
+configured inverter.
+
+Holding register reads (function code 3) of registers fetched by the
+poller within their freshness window are answered from the latest block
+reads without touching the bus. Everything else is queued on the I/O worker of the
+inverter's port like any other request: reads at interactive priority,
+writes (6 and 16) at control priority. A connection has at most one
+request queued at a time and the worker serves a priority class in
+submission order, so clients take turns on the bus instead of a fast
+poller starving the others.
+
+Writes are limited to the write commands of the register map and checked
+against their write limits unless the gateway is created with
+writes='all'; writes='none' makes it read-only.
+"""
+import asyncio
+import struct
+from typing import Optional
+
+import minimalmodbus
+from asyncinverter import AsyncSRNEInverter
+from metrics import Counter, Gauge
+from readplanner import decode_register
+from registermap import WRITE_FUNCTION_CODE
+from validator import validate_command
+
+READ_HOLDING_REGISTERS = 3
+READ_INPUT_REGISTERS = 4
+WRITE_SINGLE_REGISTER = 6
+WRITE_MULTIPLE_REGISTERS = 16
+
+# Exception codes of a Modbus exception response
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_DATA_ADDRESS = 0x02
+ILLEGAL_DATA_VALUE = 0x03
+SLAVE_DEVICE_FAILURE = 0x04
+SLAVE_DEVICE_BUSY = 0x06
+NEGATIVE_ACKNOWLEDGE = 0x07
+GATEWAY_PATH_UNAVAILABLE = 0x0A
+GATEWAY_TARGET_FAILED = 0x0B
+
+MAX_READ_COUNT = 125
+MAX_WRITE_COUNT = 123
+
+WRITE_MODES = ('none', 'mapped', 'all')
+
+MBAP_HEADER = struct.Struct('>HHHB')  # transaction id, protocol id, length, unit id
+
+GATEWAY_REQUESTS = Counter('srne_gateway_requests', "Modbus TCP gateway requests by function and outcome",
+                           ('function', 'outcome'))
+GATEWAY_CLIENTS = Gauge('srne_gateway_clients', "Connected Modbus TCP clients")
+
+
+class ModbusError(Exception):
+    """Answered with a Modbus exception response"""
+
+    def __init__(self, code: int) -> None:
+        super().__init__(code)
+        self.code = code
+
+
+def exception_code(error: IOError) -> int:
+    """Exception code reported to the client for a failed bus transaction"""
+    if isinstance(error, minimalmodbus.IllegalRequestError):
+        return ILLEGAL_DATA_ADDRESS
+    if isinstance(error, minimalmodbus.SlaveDeviceBusyError):
+        return SLAVE_DEVICE_BUSY
+    if isinstance(error, minimalmodbus.NegativeAcknowledgeError):
+        return NEGATIVE_ACKNOWLEDGE
+    if isinstance(error, minimalmodbus.SlaveReportedException):
+        return SLAVE_DEVICE_FAILURE
+    return GATEWAY_TARGET_FAILED
+
+
+class ModbusGateway():
+    def __init__(self, units: dict[int, AsyncSRNEInverter], host: str = '127.0.0.1', port: int = 502,
+                 writes: str = 'mapped', max_age: float = 2, max_clients: int = 16) -> None:
+        """units maps unit ids to inverters
+        max_age: seconds a polled register is served from memory, longer for commands cached longer
+        """
+        if writes not in WRITE_MODES:
+            raise ValueError(f"writes must be one of {', '.join(WRITE_MODES)}.")
+        self._units = units
+        self._host = host
+        self._port = port
+        self._writes = writes
+        self._max_age = max_age
+        self._max_clients = max_clients
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._clients: dict[asyncio.StreamWriter, asyncio.Task[None]] = {}
+
+    @property
+    def port(self) -> int:
+        """Listening port, the one picked by the system when created with port 0"""
+        if self._server is None:
+            return self._port
+        return self._server.sockets[0].getsockname()[1]
+
+    async def start(self) -> None:
+        if self._server is None:
+            self._server = await asyncio.start_server(self._serve, self._host, self._port)
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        handlers = list(self._clients.values())
+        for writer in list(self._clients):
+            writer.close()
+        await asyncio.gather(*handlers, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        if len(self._clients) >= self._max_clients:
+            writer.close()
+            return
+        self._clients[writer] = asyncio.current_task()
+        GATEWAY_CLIENTS.set(len(self._clients))
+        try:
+            while True:
+                header = await reader.readexactly(MBAP_HEADER.size)
+                transaction, protocol, length, unit = MBAP_HEADER.unpack(header)
+                if protocol != 0 or not 2 <= length <= 254:
+                    break
+                pdu = await reader.readexactly(length - 1)
+                # One request at a time per connection, pipelined requests wait in the socket
+                response = await self.respond(unit, pdu)
+                writer.write(MBAP_HEADER.pack(transaction, 0, len(response) + 1, unit) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            GATEWAY_CLIENTS.set(len(self._clients))
+            writer.close()
+
+    async def respond(self, unit: int, pdu: bytes) -> bytes:
+        """Response PDU of a request PDU, an exception response when it fails"""
+        function = pdu[0]
+        try:
+            inverter = self._units.get(unit)
+            if inverter is None:
+                raise ModbusError(GATEWAY_PATH_UNAVAILABLE)
+            if function in (READ_HOLDING_REGISTERS, READ_INPUT_REGISTERS):
+                return await self._read(inverter, function, pdu)
+            if function in (WRITE_SINGLE_REGISTER, WRITE_MULTIPLE_REGISTERS):
+                return await self._write(inverter, function, pdu)
+            raise ModbusError(ILLEGAL_FUNCTION)
+        except ModbusError as e:
+            GATEWAY_REQUESTS.inc((function, 'exception'))
+            return bytes((function | 0x80, e.code))
+
+    async def _read(self, inverter: AsyncSRNEInverter, function: int, pdu: bytes) -> bytes:
+        if len(pdu) != 5:
+            raise ModbusError(ILLEGAL_DATA_VALUE)
+        start, count = struct.unpack_from('>HH', pdu, 1)
+        if not 1 <= count <= MAX_READ_COUNT or start + count > 0x10000:
+            raise ModbusError(ILLEGAL_DATA_VALUE)
+        words = None
+        if function == READ_HOLDING_REGISTERS:
+            words = inverter.inverter.recent_words(start, count, self._max_age)
+        if words is not None:
+            GATEWAY_REQUESTS.inc((function, 'cache'))
+        else:
+            try:
+                words = await inverter.run(inverter.inverter.read_words, start, count, function)
+            except IOError as e:
+                raise ModbusError(exception_code(e))
+            GATEWAY_REQUESTS.inc((function, 'bus'))
+        return struct.pack(f'>BB{count}H', function, 2 * count, *words)
+
+    async def _write(self, inverter: AsyncSRNEInverter, function: int, pdu: bytes) -> bytes:
+        if function == WRITE_SINGLE_REGISTER:
+            if len(pdu) != 5:
+                raise ModbusError(ILLEGAL_DATA_VALUE)
+            start, word = struct.unpack_from('>HH', pdu, 1)
+            words = [word]
+            response = pdu
+        else:
+            if len(pdu) < 6:
+                raise ModbusError(ILLEGAL_DATA_VALUE)
+            start, count, size = struct.unpack_from('>HHB', pdu, 1)
+            if not 1 <= count <= MAX_WRITE_COUNT or size != 2 * count or len(pdu) != 6 + size:
+                raise ModbusError(ILLEGAL_DATA_VALUE)
+            words = list(struct.unpack_from(f'>{count}H', pdu, 6))
+            response = pdu[:5]
+        self._check_write(inverter, start, words)
+        try:
+            await inverter.control(inverter.inverter.write_words, start, words, function)
+        except IOError as e:
+            raise ModbusError(exception_code(e))
+        GATEWAY_REQUESTS.inc((function, 'bus'))
+        return response
+
+    def _check_write(self, inverter: AsyncSRNEInverter, start: int, words: list[int]) -> None:
+        """Raises ModbusError unless the write mode allows writing the words"""
+        if self._writes == 'all':
+            return
+        if self._writes == 'none':
+            raise ModbusError(ILLEGAL_FUNCTION)
+        commands = {address: (key, decimals, signed)
+                    for key, (address, decimals, functioncode, signed) in inverter.inverter.register_map.commands.items()
+                    if functioncode == WRITE_FUNCTION_CODE}
+        for address, word in enumerate(words, start):
+            if address not in commands:
+                raise ModbusError(ILLEGAL_DATA_ADDRESS)
+            key, decimals, signed = commands[address]
+            if validate_command(key, decode_register(word, decimals, signed),
+                                inverter.inverter.register_map.write_limits) is not True:
+                raise ModbusError(ILLEGAL_DATA_VALUE)
@@ -0,0 +1,163 @@
+"""
+MQTT broker connection
+
+`MqttClient` is the abstract interface the publisher and the command
+consumer need. `PahoClient` implements it with paho-mqtt when that
+package is installed, `MemoryBroker` is an in-process stand-in that
+delivers published messages to local subscribers; `benchmark.py --mqtt`
+runs commands and acks through it against the simulator.
+
+Topics follow the inverter bridge: '<prefix>/status' is retained
+'online' / 'offline' (also set as the last will).
+"""
+from abc import ABC, abstractmethod
+from threading import Lock
+from typing import Callable, Optional, Union
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+Payload = Union[str, bytes]
+MessageCallback = Callable[[str, bytes], None]
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """MQTT filter matching with the + and # wildcards"""
+    parts = topic.split('/')
+    for index, level in enumerate(pattern.split('/')):
+        if level == '#':
+            return True
+        if index >= len(parts) or (level != '+' and level != parts[index]):
+            return False
+    return len(pattern.split('/')) == len(parts)
+
+
+class MqttClient(ABC):
+    """Broker connection used by MqttPublisher and MqttCommands"""
+
+    @property
+    @abstractmethod
+    def connected(self) -> bool: ...
+
+    @abstractmethod
+    def publish(self, topic: str, payload: Payload, qos: int = 0, retain: bool = False) -> bool:
+        """Returns True when the message was handed to the broker connection"""
+
+    @abstractmethod
+    def subscribe(self, pattern: str, callback: MessageCallback) -> None:
+        """Call callback(topic, payload) for every message matching pattern, kept across reconnects"""
+
+    def start(self) -> None:
+        """Connect, nothing to do for connections that need no network"""
+
+    def stop(self) -> None:
+        """Disconnect"""
+
+
+class PahoClient(MqttClient):
+    """paho-mqtt connection, reconnecting in the background. Callbacks run on the paho network thread"""
+
+    def __init__(self, host: str, port: int = 1883, username: Optional[str] = None,
+                 password: Optional[str] = None, tls: bool = False, prefix: str = 'inverter',
+                 client_id: str = '') -> None:
+        if mqtt is None:
+            raise RuntimeError("paho-mqtt is required to connect to an MQTT broker.")
+        try:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id)
+        except AttributeError:
+            # paho-mqtt 1.x
+            client = mqtt.Client(client_id)
+        if username:
+            client.username_pw_set(username, password)
+        if tls:
+            client.tls_set()
+        self._status_topic = f'{prefix}/status'
+        client.will_set(self._status_topic, 'offline', qos=1, retain=True)
+        client.on_connect = self._on_connect
+        client.on_message = self._on_message
+        self._client = client
+        self._host = host
+        self._port = port
+        self._subscriptions: list[tuple[str, MessageCallback]] = []
+        self._lock = Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._client.is_connected()
+
+    def publish(self, topic: str, payload: Payload, qos: int = 0, retain: bool = False) -> bool:
+        if not self.connected:
+            return False
+        return self._client.publish(topic, payload, qos, retain).rc == mqtt.MQTT_ERR_SUCCESS
+
+    def subscribe(self, pattern: str, callback: MessageCallback) -> None:
+        with self._lock:
+            self._subscriptions.append((pattern, callback))
+        if self.connected:
+            self._client.subscribe(pattern, qos=1)
+
+    def start(self) -> None:
+        self._client.connect_async(self._host, self._port)
+        self._client.loop_start()
+
+    def stop(self) -> None:
+        if self.connected:
+            self._client.publish(self._status_topic, 'offline', qos=1, retain=True).wait_for_publish(1)
+        self._client.disconnect()
+        self._client.loop_stop()
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties=None) -> None:
+        client.publish(self._status_topic, 'online', qos=1, retain=True)
+        with self._lock:
+            patterns = [pattern for pattern, _ in self._subscriptions]
+        for pattern in patterns:
+            client.subscribe(pattern, qos=1)
+
+    def _on_message(self, client, userdata, message) -> None:
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for pattern, callback in subscriptions:
+            if topic_matches(pattern, message.topic):
+                callback(message.topic, message.payload)
+
+
+class MemoryBroker(MqttClient):
+    """In-process broker stand-in: keeps every published message and retained values,
+    and delivers messages to matching subscribers synchronously
+    """
+
+    def __init__(self, online: bool = True) -> None:
+        self.online = online
+        self.messages: list[tuple[str, bytes, int, bool]] = []
+        self.retained: dict[str, bytes] = {}
+        self._subscriptions: list[tuple[str, MessageCallback]] = []
+        self._lock = Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self.online
+
+    def publish(self, topic: str, payload: Payload, qos: int = 0, retain: bool = False) -> bool:
+        if not self.online:
+            return False
+        data = payload.encode() if isinstance(payload, str) else payload
+        with self._lock:
+            self.messages.append((topic, data, qos, retain))
+            if retain:
+                self.retained[topic] = data
+            subscriptions = list(self._subscriptions)
+        for pattern, callback in subscriptions:
+            if topic_matches(pattern, topic):
+                callback(topic, data)
+        return True
+
+    def subscribe(self, pattern: str, callback: MessageCallback) -> None:
+        with self._lock:
+            self._subscriptions.append((pattern, callback))
+
+    def topics(self, pattern: str = '#') -> list[tuple[str, bytes]]:
+        """Published (topic, payload) pairs matching pattern, oldest first"""
+        with self._lock:
+            return [(topic, payload) for topic, payload, _, _ in self.messages if topic_matches(pattern, topic)]
@@ -0,0 +1,179 @@
+"""
+MQTT command consumer
+
+Maps command topics to the write commands of the register map of the
+addressed inverter:
+
+    <prefix>/<inverter>/cmd/<name>   acknowledged on <prefix>/<inverter>/cmd/ack
+    <prefix>/cmd/<name>              default inverter, acknowledged on <prefix>/cmd/ack
+
+<name> is a write key without the '_write' suffix (for example
+'battery_max_charge_current') or one of the inverter bridge names in
+`COMMAND_ALIASES`. The payload is a number or {"value": number, "id": any}.
+
+Commands for one register are coalesced: the value is written once the
+`window` has passed, and at most once per `min_interval`, so only the
+last value of a burst reaches the bus. Writes are skipped when the fresh
+cached value already matches. Every ack lists the ids of the commands it
+covers and the value read back after the write.
+"""
+import asyncio
+import json
+import math
+from typing import Any, NamedTuple, Optional
+
+from metrics import Counter
+from mqttclient import MqttClient
+from registermap import Command
+from registry import InverterRegistry
+from srnecommands import INVERTER_COMMANDS
+from validator import validate_command
+
+WINDOW = 0.5  # second
+MIN_INTERVAL = 2  # second
+
+# Command names used by the inverter bridge
+COMMAND_ALIASES = {
+    'priority': 'inverter_output_priority_write',
+    'output_priority': 'inverter_output_priority_write',
+    'charger_priority': 'inverter_charger_priority_write',
+}
+
+MQTT_COMMANDS = Counter('srne_mqtt_commands', "MQTT commands by outcome", ('outcome',))
+
+
+def command_key(name: str, commands: dict[str, Command] = INVERTER_COMMANDS) -> Optional[str]:
+    """Write command of a topic name, None if there is none"""
+    key = COMMAND_ALIASES.get(name, f'{name}_write')
+    return key if key in commands else None
+
+
+class Request(NamedTuple):
+    ack_topic: str
+    id: Any
+
+
+class PendingWrite():
+    """Latest value for a register and the requests it answers"""
+
+    def __init__(self, value: Any, request: Request) -> None:
+        self.value = value
+        self.requests = [request]
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MqttCommands():
+    def __init__(self, client: MqttClient, registry: InverterRegistry, prefix: str = 'inverter',
+                 window: float = WINDOW, min_interval: float = MIN_INTERVAL) -> None:
+        self._client = client
+        self._registry = registry
+        self._prefix = prefix
+        self._window = window
+        self._min_interval = min_interval
+        self._pending: dict[tuple[str, str], PendingWrite] = {}
+        self._last_write: dict[tuple[str, str], float] = {}
+        self._tasks: set[asyncio.Task[None]] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def start(self) -> None:
+        """Subscribe to the command topics, must be called from the event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._client.subscribe(f'{self._prefix}/cmd/+', self._on_message)
+        self._client.subscribe(f'{self._prefix}/+/cmd/+', self._on_message)
+
+    async def stop(self) -> None:
+        """Drop the commands still waiting for their window and finish the running writes"""
+        for pending in self._pending.values():
+            pending.timer.cancel()
+        self._pending.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _on_message(self, topic: str, payload: bytes) -> None:
+        # Called from the broker client thread
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._receive, topic, payload)
+
+    def _receive(self, topic: str, payload: bytes) -> None:
+        levels = topic[len(self._prefix) + 1:].split('/')
+        if levels[-1] == 'ack':
+            return
+        if len(levels) == 2:
+            inverter_id, ack_topic = self._registry.default_id, f'{self._prefix}/cmd/ack'
+        else:
+            inverter_id, ack_topic = levels[0], f'{self._prefix}/{levels[0]}/cmd/ack'
+        name = levels[-1]
+        try:
+            data = json.loads(payload)
+        except ValueError:
+            data = None
+        value, request_id = (data.get('value'), data.get('id')) if isinstance(data, dict) else (data, None)
+        request = Request(ack_topic, request_id)
+
+        try:
+            register_map = self._registry.get(inverter_id).inverter.register_map
+        except KeyError:
+            self._reject(request, name, f"Unknown inverter '{inverter_id}'.")
+            return
+        key = command_key(name, register_map.commands)
+        if key is None:
+            self._reject(request, name, f"Unknown command '{name}'.")
+            return
+        validation = validate_command(key, value, register_map.write_limits)
+        if validation is not True:
+            self._reject(request, name, validation.get('message'))
+            return
+
+        pending = self._pending.get((inverter_id, key))
+        if pending is not None:
+            pending.value = value
+            pending.requests.append(request)
+            MQTT_COMMANDS.inc(('coalesced',))
+            return
+        pending = self._pending[(inverter_id, key)] = PendingWrite(value, request)
+        due = max(self._loop.time() + self._window,
+                  self._last_write.get((inverter_id, key), -math.inf) + self._min_interval)
+        pending.timer = self._loop.call_at(due, self._flush, inverter_id, key)
+
+    def _flush(self, inverter_id: str, key: str) -> None:
+        pending = self._pending.pop((inverter_id, key), None)
+        if pending is None:
+            return
+        task = asyncio.create_task(self._write(inverter_id, key, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _write(self, inverter_id: str, key: str, pending: PendingWrite) -> None:
+        inverter = self._registry.get(inverter_id)
+        read_key = key.removesuffix('_write')
+        cached = inverter.cached(read_key)
+        if cached is not None and math.isclose(cached, pending.value):
+            MQTT_COMMANDS.inc(('unchanged',))
+            self._ack(pending, {'status': 'unchanged', 'cmd': read_key, 'value': cached})
+            return
+        self._last_write[(inverter_id, key)] = self._loop.time()
+        if not await inverter.write_command(key, pending.value):
+            MQTT_COMMANDS.inc(('failed',))
+            self._ack(pending, {'status': 'error', 'cmd': read_key, 'message': "Error occurred when setting the value."})
+            return
+        result = (await inverter.read_results([read_key]))[read_key]
+        verified = result.good and math.isclose(result.value, pending.value)
+        MQTT_COMMANDS.inc(('written' if verified else 'unverified',))
+        self._ack(pending, {
+            'status': 'success' if verified else 'unverified',
+            'cmd': read_key,
+            'value': result.value,
+            'quality': result.quality.value,
+        })
+
+    def _ack(self, pending: PendingWrite, ack: dict[str, Any]) -> None:
+        topics: dict[str, list[Any]] = {}
+        for request in pending.requests:
+            topics.setdefault(request.ack_topic, []).append(request.id)
+        for topic, ids in topics.items():
+            self._client.publish(topic, json.dumps({**ack, 'requested': pending.value, 'ids': ids}), qos=1)
+
+    def _reject(self, request: Request, name: str, message: str) -> None:
+        MQTT_COMMANDS.inc(('rejected',))
+        self._client.publish(request.ack_topic, json.dumps(
+            {'status': 'error', 'cmd': name, 'message': message, 'ids': [request.id]}), qos=1)
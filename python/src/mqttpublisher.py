@@ -0,0 +1,167 @@
+"""
+MQTT telemetry publisher
+
+Publishes the records of every inverter, fed by an InverterRegistry
+listener, on a background thread so the event loop never waits for the
+broker or the disk.
+
+    <prefix>/<inverter>/battery/voltage   retained latest value, QoS 0
+    <prefix>/<inverter>/telemetry         {"t": unix time, "v": {path: value}} per cycle, QoS 1
+
+A path is published when it changed by more than its deadband, at most
+once per `min_interval` and at least every `heartbeat` seconds. Fields
+flagged in record['quality'] are not published. Batches that cannot be
+delivered go to a bounded DiskSpool and are sent again, oldest first
+and at most `drain_rate` per second, once the broker is back. The
+per-metric topics only carry the current state, so they are refreshed
+in full after a reconnect instead of being spooled.
+"""
+import json
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import monotonic, time
+from typing import Any, Optional
+
+from metrics import Counter, Gauge
+from mqttclient import MqttClient
+from records import flatten_record
+from spool import DiskSpool, SpooledMessage
+
+MIN_INTERVAL = 1  # second
+HEARTBEAT = 60  # second
+DRAIN_RATE = 20  # spooled messages per second
+QUEUE_SIZE = 1000
+RECONNECT_CHECK = 1  # second
+
+MQTT_MESSAGES = Counter('srne_mqtt_messages', "Telemetry messages by outcome", ('outcome',))
+MQTT_SPOOL_BYTES = Gauge('srne_mqtt_spool_bytes', "Size of the MQTT telemetry spool")
+
+
+def topic_path(path: str) -> str:
+    """Topic levels of a dotted record path"""
+    return path.replace('.', '/')
+
+
+class MqttPublisher():
+    def __init__(self, client: MqttClient, prefix: str = 'inverter', per_metric: bool = True,
+                 batch: bool = True, deadbands: Optional[dict[str, float]] = None,
+                 min_interval: float = MIN_INTERVAL, heartbeat: float = HEARTBEAT,
+                 spool: Optional[DiskSpool] = None, drain_rate: float = DRAIN_RATE) -> None:
+        self._client = client
+        self._prefix = prefix
+        self._per_metric = per_metric
+        self._batch = batch
+        self._deadbands = deadbands or {}
+        self._min_interval = min_interval
+        self._heartbeat = heartbeat
+        self._spool = spool
+        self._drain_interval = 1 / drain_rate
+        self._queue: Queue[Optional[tuple[str, dict[str, Any], float]]] = Queue(QUEUE_SIZE)
+        # Last published (value, monotonic time) per inverter and path
+        self._sent: dict[str, dict[str, tuple[Any, float]]] = {}
+        self._connected = False
+        self._thread: Optional[Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = Thread(target=self._run, name='mqtt-publisher', daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def publish(self, inverter_id: str, record: dict[str, Any], timestamp: Optional[float] = None) -> None:
+        """Queue a record, usable as an InverterRegistry listener; never blocks"""
+        if not record:
+            return
+        try:
+            self._queue.put_nowait((inverter_id, record, time() if timestamp is None else timestamp))
+        except Full:
+            MQTT_MESSAGES.inc(('dropped',))
+
+    def _run(self) -> None:
+        next_drain = 0.0
+        while True:
+            timeout = None
+            if self._spool is not None and self._spool.pending:
+                timeout = max(0.0, next_drain - monotonic()) if self._connected else RECONNECT_CHECK
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                item = ()
+            if item is None:
+                break
+            self._check_connection()
+            if item:
+                self._process(*item)
+            if (self._connected and self._spool is not None and self._spool.pending
+                    and monotonic() >= next_drain):
+                self._drain_one()
+                next_drain = monotonic() + self._drain_interval
+
+    def _check_connection(self) -> None:
+        connected = self._client.connected
+        if connected and not self._connected:
+            # Retained per-metric topics may be outdated, send every path again
+            self._sent.clear()
+        self._connected = connected
+
+    def _process(self, inverter_id: str, record: dict[str, Any], timestamp: float) -> None:
+        flagged = record.get('quality', {})
+        values = {
+            path: value for path, value in flatten_record(record).items()
+            if value is not None and path not in flagged and not path.startswith('quality.')
+        }
+        changes = self._changes(inverter_id, values)
+        if not changes:
+            return
+        base = f'{self._prefix}/{inverter_id}'
+        if self._per_metric and self._connected:
+            for path, value in changes.items():
+                self._client.publish(f'{base}/{topic_path(path)}', json.dumps(value), qos=0, retain=True)
+        if self._batch:
+            payload = json.dumps({'t': round(timestamp, 3), 'v': changes}, separators=(',', ':'))
+            self._send(SpooledMessage(f'{base}/telemetry', payload, 1))
+
+    def _changes(self, inverter_id: str, values: dict[str, Any]) -> dict[str, Any]:
+        sent = self._sent.setdefault(inverter_id, {})
+        now = monotonic()
+        changes: dict[str, Any] = {}
+        for path, value in values.items():
+            previous = sent.get(path)
+            if previous is not None:
+                last_value, last_time = previous
+                age = now - last_time
+                if age < self._heartbeat and (age < self._min_interval or not self._changed(path, last_value, value)):
+                    continue
+            changes[path] = value
+            sent[path] = (value, now)
+        return changes
+
+    def _changed(self, path: str, previous: Any, value: Any) -> bool:
+        if isinstance(value, (int, float)) and isinstance(previous, (int, float)):
+            return abs(value - previous) > self._deadbands.get(path, 0)
+        return value != previous
+
+    def _send(self, message: SpooledMessage) -> None:
+        if self._connected and self._client.publish(*message):
+            MQTT_MESSAGES.inc(('published',))
+            return
+        if self._spool is None:
+            MQTT_MESSAGES.inc(('dropped',))
+            return
+        self._spool.append(message)
+        MQTT_SPOOL_BYTES.set(self._spool.size)
+        MQTT_MESSAGES.inc(('spooled',))
+
+    def _drain_one(self) -> None:
+        message = self._spool.peek()
+        if message is None:
+            return
+        if self._client.publish(*message):
+            self._spool.pop()
+            MQTT_SPOOL_BYTES.set(self._spool.size)
+            MQTT_MESSAGES.inc(('drained',))
@@ -0,0 +1,65 @@
+"""
+Background acquisition of inverter records
+
+A single task per serial port reads a record from every inverter on that
+port each interval and publishes it, so the serial traffic does not
+depend on the number of connected clients. The inverters of a port are
+read in turn, which keeps a shared bus fair between them.
+"""
+import asyncio
+from time import time
+from typing import Any, Callable, NamedTuple, Optional
+
+from asyncinverter import AsyncSRNEInverter
+from metrics import Counter, Histogram
+
+POLL_CYCLE = Histogram('srne_poll_cycle_seconds', "Time to read a record from every inverter of a port", ('port',))
+RECORD_FAILURES = Counter('srne_record_failures', "Records that could not be read", ('inverter',))
+
+
+class Snapshot(NamedTuple):
+    """One published reading: the record plus the raw register words it was decoded from"""
+    timestamp: float
+    record: dict[str, Any]
+    registers: Optional[dict[int, int]] = None
+
+
+class Poller():
+    def __init__(self, inverters: dict[str, AsyncSRNEInverter], publish: Callable[[str, Snapshot], None],
+                 interval: float = 1, port: str = '') -> None:
+        self._inverters = inverters
+        self._port = port
+        self._publish = publish
+        self._interval = interval
+        self._task: Optional[asyncio.Task[None]] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _read(self, inverter_id: str, inverter: AsyncSRNEInverter):
+        try:
+            return await inverter.get_record()
+        except Exception:
+            RECORD_FAILURES.inc((inverter_id,))
+            return {}
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            for inverter_id, inverter in self._inverters.items():
+                record = await self._read(inverter_id, inverter)
+                self._publish(inverter_id, Snapshot(time(), record, inverter.raw_registers()))
+            elapsed = loop.time() - started
+            POLL_CYCLE.observe(elapsed, (self._port,))
+            await asyncio.sleep(max(0, self._interval - elapsed))
@@ -0,0 +1,110 @@
+"""
+Block read planner for the SRNE register map
+
+Merges the requested command keys into as few multi-register
+`read_registers` requests as possible and decodes the returned words
+using the decimals and signed flags from `INVERTER_COMMANDS`. Every block
+carries a decode table compiled when it is planned, so decoding is a loop
+over (key, offset, divisor, signed) rows. Write commands are grouped the
+same way into runs of consecutive registers for `write_registers`.
+"""
+from typing import Iterable, Union
+
+from srnecommands import INVERTER_COMMANDS
+
+Number = Union[int, float]
+Command = tuple[int, int, int, bool]
+
+# Maximum number of registers fetched by a single request (Modbus allows 125)
+MAX_BLOCK_SPAN = 32
+# Maximum number of unused registers tolerated between two requested ones
+MAX_BLOCK_GAP = 10
+# Maximum number of registers written by a single request (Modbus allows 123)
+MAX_WRITE_SPAN = 32
+
+
+class ReadBlock():
+    """A contiguous range of registers fetched with one request"""
+
+    def __init__(self, start: int, functioncode: int) -> None:
+        self.start = start
+        self.functioncode = functioncode
+        self.count = 1
+        self.keys: list[str] = []
+        # (key, offset in the block, divisor or 0 without decimals, signed) per key
+        self.table: list[tuple[str, int, int, bool]] = []
+
+    @property
+    def end(self) -> int:
+        """Address of the last register in the block"""
+        return self.start + self.count - 1
+
+    def __repr__(self) -> str:
+        return f"ReadBlock(0x{self.start:04x}-0x{self.end:04x}, {self.keys})"
+
+
+def plan_reads(keys: Iterable[str], commands: dict[str, Command] = INVERTER_COMMANDS,
+               max_span: int = MAX_BLOCK_SPAN, max_gap: int = MAX_BLOCK_GAP) -> list[ReadBlock]:
+    """Group the given command keys into contiguous read blocks
+
+    Registers are sorted by address and a new block is started whenever
+    adding the next register would exceed `max_span` registers, leave more
+    than `max_gap` unused registers in between or need a different
+    function code.
+    """
+    ordered = sorted(set(keys), key=lambda key: (commands[key][2], commands[key][0]))
+    blocks: list[ReadBlock] = []
+    block = None
+    for key in ordered:
+        register, _, functioncode, _ = commands[key]
+        if (block is None
+                or functioncode != block.functioncode
+                or register - block.end - 1 > max_gap
+                or register - block.start + 1 > max_span):
+            block = ReadBlock(register, functioncode)
+            blocks.append(block)
+        block.count = max(block.count, register - block.start + 1)
+        block.keys.append(key)
+    for block in blocks:
+        block.table = [compile_decoder(key, block.start, commands[key]) for key in block.keys]
+    return blocks
+
+
+def compile_decoder(key: str, start: int, command: Command) -> tuple[str, int, int, bool]:
+    """Decode table row of a command in a block starting at start"""
+    register, decimals, _, signed = command
+    return key, register - start, 10 ** decimals if decimals else 0, signed
+
+
+def plan_writes(keys: Iterable[str], commands: dict[str, Command] = INVERTER_COMMANDS,
+                max_span: int = MAX_WRITE_SPAN) -> list[ReadBlock]:
+    """Group write command keys into blocks of consecutive registers, without gaps"""
+    return plan_reads(keys, commands, max_span, 0)
+
+
+def encode_register(value: Number, decimals: int = 0, signed: bool = False) -> int:
+    """Convert a value to the raw 16 bit register word, the inverse of `decode_register`"""
+    word = round(value * 10 ** decimals)
+    if signed and word < 0:
+        word += 0x10000
+    return word & 0xffff
+
+
+def decode_register(raw: int, decimals: int = 0, signed: bool = False) -> Number:
+    """Convert a raw 16 bit register word the same way `read_register` does"""
+    if signed and raw >= 0x8000:
+        raw -= 0x10000
+    if decimals:
+        return raw / 10 ** decimals
+    return raw
+
+
+def decode_block(block: ReadBlock, registers: list[int]) -> dict[str, Number]:
+    """Decode every key of a block from the words returned by `read_registers`"""
+    values: dict[str, Number] = {}
+    for key, offset, divisor, signed in block.table:
+        raw = registers[offset]
+        if signed and raw >= 0x8000:
+            raw -= 0x10000
+        values[key] = raw / divisor if divisor else raw
+    return values
@@ -0,0 +1,48 @@
+"""
+Typed results of register reads
+
+Every value read from the inverter comes with a quality flag and the
+time it was read, instead of a sentinel value standing in for failures.
+"""
+from enum import Enum
+from typing import NamedTuple, Optional, Union
+
+import minimalmodbus
+
+Number = Union[int, float]
+
+
+class Quality(Enum):
+    GOOD = 'good'
+    STALE = 'stale'  # Last good value, served because the read failed
+    TIMEOUT = 'timeout'
+    CRC_ERROR = 'crc_error'  # Also covers malformed responses
+    ERROR = 'error'  # Slave exception or other I/O error
+    INVALID = 'invalid'  # Read fine but outside the values the field accepts
+
+
+class ReadResult(NamedTuple):
+    value: Optional[Number]
+    quality: Quality
+    timestamp: Optional[float] = None  # Unix time the value was read, None without a value
+
+    @property
+    def good(self) -> bool:
+        return self.quality is Quality.GOOD
+
+
+class ReadError(IOError):
+    """Raised by the single value getters when no value is available"""
+
+    def __init__(self, key: str, quality: Quality) -> None:
+        super().__init__(f"Reading '{key}' failed: {quality.value}.")
+        self.key = key
+        self.quality = quality
+
+
+def error_quality(error: IOError) -> Quality:
+    if isinstance(error, minimalmodbus.NoResponseError):
+        return Quality.TIMEOUT
+    if isinstance(error, minimalmodbus.InvalidResponseError):
+        return Quality.CRC_ERROR
+    return Quality.ERROR
@@ -0,0 +1,57 @@
+"""
+Helpers for the nested records returned by SRNEInverter.get_record()
+
+Metrics are addressed with dotted paths such as 'battery.voltage'.
+"""
+from typing import Any, Optional, Union
+
+from registermap import DEFAULT_MAP
+
+Number = Union[int, float]
+
+# Command each metric is read from; numeric fields of the register map, in record order
+METRIC_COMMANDS = DEFAULT_MAP.metric_commands
+
+# Numeric metrics of a record, in a fixed order
+RECORD_METRICS = tuple(METRIC_COMMANDS)
+
+# Command every field of a record is read from, including the non-numeric ones
+FIELD_COMMANDS = DEFAULT_MAP.field_commands
+
+# Decimal places of each metric, as defined by its register
+METRIC_DECIMALS = {metric: DEFAULT_MAP.registers[key].decimals for metric, key in METRIC_COMMANDS.items()}
+
+
+def flatten_record(record: dict[str, Any], prefix: str = '') -> dict[str, Any]:
+    """Returns the leaves of a nested record keyed by their dotted path"""
+    flat: dict[str, Any] = {}
+    for key, value in record.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten_record(value, f'{path}.'))
+        else:
+            flat[path] = value
+    return flat
+
+
+def record_value(record: dict[str, Any], path: str) -> Optional[Number]:
+    """Numeric value of a dotted path, None if missing, not numeric or flagged in record['quality']"""
+    section, _, name = path.partition('.')
+    value = record.get(section, {}).get(name)
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or path in record.get('quality', {}):
+        return None
+    return value
+
+
+def record_metrics(record: dict[str, Any], metrics: tuple[str, ...] = RECORD_METRICS) -> list[Number]:
+    """Returns the numeric metrics of a record as floats
+    NaN for missing values and for fields flagged in record['quality'] (stale or failed)
+    """
+    flat = flatten_record(record)
+    flagged = record.get('quality', {})
+    values: list[Number] = []
+    for metric in metrics:
+        value = flat.get(metric)
+        usable = isinstance(value, (int, float)) and not isinstance(value, bool) and metric not in flagged
+        values.append(float(value) if usable else float('nan'))
+    return values
@@ -0,0 +1,72 @@
+"""
+Register value cache with per-command freshness
+
+Each command key belongs to a freshness class from `srnecommands`
+(fast telemetry, slow telemetry or settings). A cached value is served
+until it is older than the time-to-live of its class.
+"""
+from threading import Lock
+from time import monotonic
+from typing import Iterable, Optional, Union
+
+from srnecommands import COMMAND_FRESHNESS, FAST_TELEMETRY, SETTINGS, SLOW_TELEMETRY
+
+Number = Union[int, float]
+
+# Seconds a value of each freshness class is served from the cache
+CACHE_TTL = {
+    FAST_TELEMETRY: 0.5,
+    SLOW_TELEMETRY: 10,
+    SETTINGS: 300,
+}
+
+
+class RegisterCache():
+    def __init__(self, ttl: Optional[dict[int, float]] = None, freshness: Optional[dict[str, int]] = None) -> None:
+        """freshness maps command keys to their class, COMMAND_FRESHNESS by default"""
+        self._ttl = {**CACHE_TTL, **(ttl or {})}
+        self._freshness = freshness if freshness is not None else COMMAND_FRESHNESS
+        self._values: dict[str, tuple[Number, float]] = {}
+        self._lock = Lock()
+
+    def ttl(self, key: str) -> float:
+        return self._ttl[self._freshness.get(key, FAST_TELEMETRY)]
+
+    def get(self, key: str) -> Optional[Number]:
+        """Returns the cached value, None if missing or expired"""
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is None or monotonic() - entry[1] > self.ttl(key):
+            return None
+        return entry[0]
+
+    def last(self, key: str) -> Optional[tuple[Number, float]]:
+        """Returns the latest value and its age in seconds, even when expired"""
+        with self._lock:
+            entry = self._values.get(key)
+        if entry is None:
+            return None
+        return entry[0], monotonic() - entry[1]
+
+    def fresh(self, keys: Iterable[str]) -> dict[str, Number]:
+        """Returns the keys that can be served from the cache"""
+        values: dict[str, Number] = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def update(self, values: dict[str, Number]) -> None:
+        now = monotonic()
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = (value, now)
+
+    def invalidate(self, key: Optional[str] = None) -> None:
+        """Drop one key, or the whole cache when no key is given"""
+        with self._lock:
+            if key is None:
+                self._values.clear()
+            else:
+                self._values.pop(key, None)
@@ -0,0 +1,139 @@
+"""
+Vectorized decoding of raw register words
+
+A `RegisterDecoder` is compiled once for a list of commands and the
+position of each command in the input rows. It converts a whole matrix
+of raw uint16 words, one row per sample, into engineering units in one
+pass per column: two's complement for signed registers, division by
+10 ** decimals, then the scale of the register map (sign flips, battery
+voltage multipliers). NumPy is used when installed, otherwise columns
+are computed into `array` storage.
+
+The output is columnar (`DecodedColumns`) for storage and aggregation;
+`rows()` builds JSON style dicts (ints, enum names, None for missing
+words) only when they are needed.
+"""
+import math
+from array import array
+from typing import Any, Iterator, Optional, Sequence, Union
+
+from readplanner import ReadBlock
+from registermap import DEFAULT_MAP, RegisterMap
+
+try:
+    import numpy as np
+except ImportError:  # Decoding falls back to array columns
+    np = None
+
+Column = Union["array[float]", "np.ndarray"]
+
+
+class DecodedColumns():
+    """Engineering values by command key, one column per key and one entry per row
+    Words marked missing are NaN
+    """
+
+    def __init__(self, keys: tuple[str, ...], columns: list[Column], register_map: RegisterMap) -> None:
+        self.keys = keys
+        self.columns = dict(zip(keys, columns))
+        self._map = register_map
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, key: str) -> Column:
+        return self.columns[key]
+
+    def metric_columns(self) -> dict[str, Column]:
+        """Columns of the numeric record fields, keyed by their dotted record path"""
+        return {metric: self.columns[key] for metric, key in self._map.metric_commands.items() if key in self.columns}
+
+    def rows(self) -> Iterator[dict[str, Any]]:
+        """Dict per row, with the types of the record fields: int or float, enum names, None if missing"""
+        lists = [column.tolist() for column in self.columns.values()]
+        conversions = [self._map.conversion(key)[1:] for key in self.keys]
+        for values in zip(*lists):
+            yield {
+                key: _convert(value, cast, names)
+                for key, value, (cast, names) in zip(self.keys, values, conversions)
+            }
+
+
+def _convert(value: float, cast: type, names: Optional[dict[int, str]]) -> Any:
+    if math.isnan(value):
+        return None
+    if names is not None:
+        return names.get(int(value))
+    return int(value) if cast is int else value
+
+
+class RegisterDecoder():
+    def __init__(self, keys: Sequence[str], offsets: Optional[Sequence[int]] = None,
+                 register_map: RegisterMap = DEFAULT_MAP, scaled: bool = True) -> None:
+        """offsets are the positions of the keys in an input row, the key order by default
+        scaled applies the register map scale, without it values match decode_register()
+        """
+        self.keys = tuple(keys)
+        self.offsets = tuple(offsets) if offsets is not None else tuple(range(len(self.keys)))
+        if len(self.offsets) != len(self.keys):
+            raise ValueError("Every key needs an offset.")
+        self.width = max(self.offsets, default=-1) + 1
+        self._map = register_map
+        registers = [register_map.registers[key] for key in self.keys]
+        self._signed = [register.signed for register in registers]
+        self._divisors = [float(10 ** register.decimals) for register in registers]
+        self._scales = [float(register.scale) if scaled else 1.0 for register in registers]
+        if np is not None:
+            # Shaped (keys, 1) to broadcast over the rows of a key-major matrix
+            self._np_offsets = np.array(self.offsets, dtype=np.intp)
+            self._np_signed = np.array(self._signed, dtype=bool)[:, None]
+            self._np_divisors = np.array(self._divisors)[:, None]
+            self._np_scales = np.array(self._scales)[:, None]
+
+    @classmethod
+    def for_block(cls, block: ReadBlock, register_map: RegisterMap = DEFAULT_MAP,
+                  scaled: bool = True) -> "RegisterDecoder":
+        """Decoder of the rows returned by read_registers() for a planned block"""
+        return cls([key for key, *_ in block.table], [offset for _, offset, *_ in block.table],
+                   register_map, scaled)
+
+    def decode(self, words: Any, missing: Optional[Any] = None) -> DecodedColumns:
+        """words: rows of raw register words, as a 2-D uint16 array or a sequence of rows;
+        a single flat row is accepted too
+        missing: optional (rows, keys) booleans, True where the word of a key was not read
+        """
+        if np is not None:
+            return self._decode_numpy(words, missing)
+        return self._decode_python(words, missing)
+
+    def _decode_numpy(self, words: Any, missing: Optional[Any]) -> DecodedColumns:
+        matrix = np.asarray(words, dtype=np.uint16)
+        if matrix.ndim == 1:
+            matrix = matrix[None, :] if matrix.size else matrix.reshape(0, self.width)
+        # Key-major, so every column of the result is contiguous
+        raw = np.ascontiguousarray(matrix[:, self._np_offsets].T, dtype=np.int32)
+        raw -= (self._np_signed & (raw >= 0x8000)) * 0x10000
+        values = raw / self._np_divisors * self._np_scales
+        if missing is not None:
+            mask = np.asarray(missing, dtype=bool)
+            values[mask.reshape(len(matrix), -1).T] = np.nan
+        return DecodedColumns(self.keys, list(values), self._map)
+
+    def _decode_python(self, words: Any, missing: Optional[Any]) -> DecodedColumns:
+        rows = list(words)
+        if rows and isinstance(rows[0], int):
+            rows = [rows]
+            missing = [missing] if missing is not None else None
+        columns = []
+        for index, (offset, signed, divisor, scale) in enumerate(
+                zip(self.offsets, self._signed, self._divisors, self._scales)):
+            raws = [row[offset] for row in rows]
+            if signed:
+                raws = [raw - 0x10000 if raw >= 0x8000 else raw for raw in raws]
+            column = array('d', [raw / divisor * scale for raw in raws])
+            if missing is not None:
+                for position, flags in enumerate(missing):
+                    if flags[index]:
+                        column[position] = math.nan
+            columns.append(column)
+        return DecodedColumns(self.keys, columns, self._map)
@@ -0,0 +1,172 @@
+"""
+Declarative SRNE register map
+
+Every register is described once in `registermap.json`: address, decimals,
+sign, scale, unit, enum names, freshness class, record field and write
+limits. Battery voltage variants (and the models using them) provide the
+parameters a scale can refer to, such as the 12 V multiplier of the
+charge voltage settings.
+
+`load_register_map()` compiles the definitions for one model or variant
+into the command tuples used by the block read planner and a flat field
+table, so building a record is one loop over the table instead of one
+getter per field.
+"""
+import json
+import os
+from typing import Any, NamedTuple, Optional, Union
+
+from readresult import Quality, ReadResult
+
+Number = Union[int, float]
+Command = tuple[int, int, int, bool]
+
+REGISTER_MAP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'registermap.json')
+
+READ_FUNCTION_CODE = 3
+WRITE_FUNCTION_CODE = 6
+WRITE_SUFFIX = '_write'
+
+# Freshness classes, decide how long a cached register value can be served
+FAST_TELEMETRY = 0
+SLOW_TELEMETRY = 1
+SETTINGS = 2
+
+FRESHNESS_CLASSES = {
+    'fast': FAST_TELEMETRY,
+    'slow': SLOW_TELEMETRY,
+    'settings': SETTINGS,
+}
+
+
+class Register(NamedTuple):
+    key: str
+    address: int
+    decimals: int
+    functioncode: int
+    signed: bool
+    scale: Number  # Applied to the decoded value, after the decimals
+    unit: str
+    name: str
+    enum: Optional[tuple[str, ...]]  # Names by register value
+    freshness: int
+    field: Optional[str]  # Dotted record path
+    limits: Optional[tuple[Number, Number, Number]]  # Write (minimum, maximum, multiple)
+
+    @property
+    def command(self) -> Command:
+        return (self.address, self.decimals, self.functioncode, self.signed)
+
+    @property
+    def numeric(self) -> bool:
+        return self.enum is None
+
+
+class RegisterMap():
+    """Register definitions compiled for one model or battery voltage variant"""
+
+    def __init__(self, variant: str, parameters: dict[str, Number], registers: list[Register]) -> None:
+        self.variant = variant
+        self.parameters = parameters
+        self.registers = {register.key: register for register in registers}
+        self.commands: dict[str, Command] = {register.key: register.command for register in registers}
+        self.write_limits: dict[str, tuple[Number, Number, Number]] = {}
+        for register in registers:
+            if register.limits is not None:
+                write_key = register.key + WRITE_SUFFIX
+                self.commands[write_key] = (register.address, register.decimals, WRITE_FUNCTION_CODE, register.signed)
+                self.write_limits[write_key] = register.limits
+        self.freshness = {register.key: register.freshness for register in registers}
+        # Record layout, in the order of the definitions
+        self.field_commands = {register.field: register.key for register in registers if register.field}
+        self.metric_commands = {register.field: register.key for register in registers
+                                if register.field and register.numeric}
+        self.record_commands = tuple(self.field_commands.values())
+        # (scale, cast, enum names) per register and (section, name, path, key, conversion) per record field
+        self._conversions = {register.key: _conversion(register) for register in registers}
+        self._fields = [(*register.field.split('.'), register.field, register.key, *self._conversions[register.key])
+                        for register in registers if register.field]
+
+    def conversion(self, key: str) -> tuple[Number, type, Optional[dict[int, str]]]:
+        """(scale, int or float, enum names or None) of a read command"""
+        return self._conversions[key]
+
+    def value(self, key: str, value: Number) -> Union[Number, str, None]:
+        """Engineering value of a decoded register value: scaled, or the enum name
+        None when the register value is not one of the enum values
+        """
+        scale, cast, names = self._conversions[key]
+        return names.get(int(value)) if names is not None else cast(value * scale)
+
+    def build_record(self, results: dict[str, ReadResult]) -> dict[str, Any]:
+        """Nested record of the record fields, without bus access
+        Fields without a value are None, record['quality'] maps the path of every field that
+        is not good to its quality; a good value that cannot be converted is flagged invalid
+        """
+        record: dict[str, Any] = {}
+        quality: dict[str, str] = {}
+        for section, name, path, key, scale, cast, names in self._fields:
+            result = results.get(key)
+            value = result.value if result is not None else None
+            if value is not None:
+                value = names.get(int(value)) if names is not None else cast(value * scale)
+            record.setdefault(section, {})[name] = value
+            if result is None:
+                quality[path] = Quality.ERROR.value
+            elif not result.good:
+                quality[path] = result.quality.value
+            elif value is None:
+                quality[path] = Quality.INVALID.value
+        record['quality'] = quality
+        return record
+
+
+def _conversion(register: Register) -> tuple[Number, type, Optional[dict[int, str]]]:
+    """Integer registers without decimals or fractional scale stay int, enums map to their names"""
+    cast = int if register.decimals == 0 and isinstance(register.scale, int) else float
+    names = dict(enumerate(register.enum)) if register.enum is not None else None
+    return register.scale, cast, names
+
+
+def _register(key: str, definition: dict[str, Any], parameters: dict[str, Number]) -> Register:
+    scale = definition.get('scale', 1)
+    if isinstance(scale, str):
+        scale = parameters[scale]
+    limits = definition.get('write')
+    if limits is not None and scale != 1:
+        raise ValueError(f"Writable register '{key}' cannot be scaled.")
+    enum = definition.get('enum')
+    return Register(
+        key=key,
+        address=int(definition['address'], 16),
+        decimals=definition.get('decimals', 0),
+        functioncode=definition.get('functionCode', READ_FUNCTION_CODE),
+        signed=definition.get('signed', False),
+        scale=scale,
+        unit=definition.get('unit', ''),
+        name=definition.get('name', key),
+        enum=tuple(enum) if enum is not None else None,
+        freshness=FRESHNESS_CLASSES[definition.get('freshness', 'fast')],
+        field=definition.get('field'),
+        limits=(limits['min'], limits['max'], limits.get('multiple', 1)) if limits is not None else None,
+    )
+
+
+def read_definitions(path: str = REGISTER_MAP_PATH) -> dict[str, Any]:
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def load_register_map(variant: Optional[str] = None, definitions: Optional[dict[str, Any]] = None) -> RegisterMap:
+    """Compile the register map of a model ('HF2430S80-H') or variant ('48V'), the default variant if None"""
+    definitions = definitions if definitions is not None else read_definitions()
+    name = variant or definitions['defaultVariant']
+    name = definitions.get('models', {}).get(name, name)
+    if name not in definitions['variants']:
+        raise ValueError(f"Unknown model or variant '{variant}'.")
+    parameters = definitions['variants'][name]
+    registers = [_register(key, definition, parameters) for key, definition in definitions['registers'].items()]
+    return RegisterMap(name, parameters, registers)
+
+
+DEFAULT_MAP = load_register_map()
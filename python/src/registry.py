@@ -0,0 +1,184 @@
+"""
+Registry of the inverters managed by the service
+
+Inverters are grouped by serial port. Every port gets one I/O worker and
+one poller, so separate ports are polled in parallel while the devices
+sharing an RS485 bus take turns on it. Each inverter has its own stream
+broadcaster and a site-total record aggregates all of them.
+"""
+import asyncio
+import os
+from time import strftime, time
+from typing import Any, Callable, Iterable, NamedTuple, Optional
+
+from asyncinverter import AsyncSRNEInverter, IOWorker
+from broadcaster import Broadcaster
+from bustiming import BusTiming
+from capture import CaptureWriter
+from poller import Poller, Snapshot
+from SRNEinverter import SRNEInverter
+from supervisor import SerialSupervisor
+
+SITE_ID = 'site'
+
+# Record fields added up across inverters for the site total
+SITE_SUMS = (
+    ('battery', 'current'), ('battery', 'chargePower'),
+    ('pv', 'current'), ('pv', 'power'),
+    ('grid', 'inputCurrent'), ('grid', 'batteryChargeCurrent'),
+    ('inverter', 'current'), ('inverter', 'power'),
+)
+# Record fields averaged across inverters for the site total
+SITE_MEANS = (
+    ('battery', 'voltage'), ('battery', 'soc'),
+    ('pv', 'voltage'),
+    ('grid', 'voltage'), ('grid', 'frequency'),
+    ('inverter', 'voltage'), ('inverter', 'frequency'),
+)
+
+
+class InverterConfig(NamedTuple):
+    id: str
+    port: str
+    slaveaddress: int = 1
+    baudrate: int = 9600
+    model: Optional[str] = None  # Register map model or battery voltage variant, see registermap.json
+
+
+def site_record(records: Iterable[dict[str, Any]]) -> dict[str, Any]:
+    """Aggregate the records of several inverters into one site-total record"""
+    records = [record for record in records if record]
+    site: dict[str, Any] = {}
+    for fields, combine in ((SITE_SUMS, sum), (SITE_MEANS, _mean)):
+        for section, name in fields:
+            values = [record[section][name] for record in records
+                      if isinstance(record.get(section, {}).get(name), (int, float))]
+            if values:
+                site.setdefault(section, {})[name] = round(combine(values), 2)
+    site['inverters'] = len(records)
+    return site
+
+
+def _mean(values: list[Any]) -> float:
+    return sum(values) / len(values)
+
+
+class InverterRegistry():
+    def __init__(self, configs: Iterable[InverterConfig], interval: float = 1,
+                 transports: Optional[dict[str, Any]] = None, capture_dir: Optional[str] = None) -> None:
+        """Ports are opened on first use and reopened after failures by a SerialSupervisor
+        transports replaces the serial port of a port name with another serial port like object (replay)
+        capture_dir gets one capture file of the bus traffic per port and run
+        """
+        self._configs = list(configs)
+        if not self._configs:
+            raise ValueError("At least one inverter has to be configured.")
+        if SITE_ID in (config.id for config in self._configs):
+            raise ValueError(f"Inverter id '{SITE_ID}' is reserved.")
+        self._interval = interval
+        self._workers: dict[str, IOWorker] = {}
+        self._inverters: dict[str, AsyncSRNEInverter] = {}
+        self._records: dict[str, Any] = {}
+        self._broadcasters = {SITE_ID: Broadcaster()}
+        self._captures: dict[str, CaptureWriter] = {}
+        self._transports = dict(transports or {})
+        timings: dict[str, BusTiming] = {}
+        for config in self._configs:
+            if config.port not in self._workers:
+                self._workers[config.port] = IOWorker(f'srne-io-{config.port}')
+                timings[config.port] = BusTiming(config.baudrate)
+                self._transports.setdefault(config.port, SerialSupervisor(config.port, config.baudrate))
+                if capture_dir is not None:
+                    name = f"{os.path.basename(config.port)}-{strftime('%Y%m%dT%H%M%S')}.cap"
+                    self._captures[config.port] = CaptureWriter(os.path.join(capture_dir, name))
+            inverter = SRNEInverter(config.port, config.baudrate, config.slaveaddress,
+                                    bus_timing=timings[config.port], model=config.model,
+                                    transport=self._transports[config.port], capture=self._captures.get(config.port))
+            self._inverters[config.id] = AsyncSRNEInverter(inverter, self._workers[config.port])
+            self._broadcasters[config.id] = Broadcaster()
+        self._pollers = [
+            Poller({config.id: self._inverters[config.id] for config in self._configs if config.port == port},
+                   self._publish, interval, port)
+            for port in self._workers
+        ]
+        self._site_task: Optional[asyncio.Task[None]] = None
+        self._listeners: list[Callable[[str, Any, float], None]] = []
+
+    @property
+    def default_id(self) -> str:
+        return self._configs[0].id
+
+    @property
+    def ids(self) -> list[str]:
+        return [config.id for config in self._configs]
+
+    @property
+    def configs(self) -> list[InverterConfig]:
+        return list(self._configs)
+
+    def get(self, inverter_id: Optional[str] = None) -> AsyncSRNEInverter:
+        """Returns the inverter with the given id, the first configured one by default
+        Raises KeyError for unknown ids
+        """
+        return self._inverters[inverter_id or self.default_id]
+
+    def units(self) -> dict[int, AsyncSRNEInverter]:
+        """Inverters by slave address, the first configured one when ports share an address"""
+        units: dict[int, AsyncSRNEInverter] = {}
+        for config in self._configs:
+            units.setdefault(config.slaveaddress, self._inverters[config.id])
+        return units
+
+    def ports(self) -> list[dict[str, Any]]:
+        """Connection state of every supervised serial port"""
+        return [transport.status() for transport in self._transports.values()
+                if isinstance(transport, SerialSupervisor)]
+
+    def broadcaster(self, inverter_id: Optional[str] = None) -> Broadcaster:
+        """Returns the stream of an inverter, or of the site total for SITE_ID"""
+        return self._broadcasters[inverter_id or self.default_id]
+
+    def latest(self, inverter_id: Optional[str] = None) -> Optional[Snapshot]:
+        return self.broadcaster(inverter_id).latest
+
+    def add_listener(self, listener: Callable[[str, Any, float], None]) -> None:
+        """Call listener(inverter_id, record, timestamp) for every published record, including the site total
+        timestamp is the time the record was read (Snapshot.timestamp)
+        """
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        for poller in self._pollers:
+            poller.start()
+        if self._site_task is None:
+            self._site_task = asyncio.create_task(self._publish_site())
+
+    async def stop(self) -> None:
+        for poller in self._pollers:
+            await poller.stop()
+        if self._site_task is not None:
+            self._site_task.cancel()
+            try:
+                await self._site_task
+            except asyncio.CancelledError:
+                pass
+            self._site_task = None
+        for worker in self._workers.values():
+            worker.stop()
+        for capture in self._captures.values():
+            capture.close()
+        for transport in self._transports.values():
+            transport.close()
+
+    def _publish(self, inverter_id: str, snapshot: Snapshot) -> None:
+        if inverter_id != SITE_ID:
+            self._records[inverter_id] = snapshot.record
+        self._broadcasters[inverter_id].publish(snapshot)
+        for listener in self._listeners:
+            listener(inverter_id, snapshot.record, snapshot.timestamp)
+
+    async def _publish_site(self) -> None:
+        while True:
+            await asyncio.sleep(self._interval)
+            if self._records:
+                self._publish(SITE_ID, Snapshot(time(), site_record(self._records.values())))
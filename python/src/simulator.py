@@ -0,0 +1,268 @@
+"""
+Virtual SRNE inverter
+
+A software Modbus RTU slave serving the `INVERTER_COMMANDS` register map
+over a pseudo terminal (usable as the SRNEInverter device path) or as
+RTU frames over TCP. Per-frame latency, baudrate timing, CRC errors and
+timeouts can be injected, and live values follow a scripted scenario.
+
+    python simulator.py --pty
+    python simulator.py --tcp 5020 --latency 0.02 --crc-errors 0.01
+"""
+import argparse
+import math
+import os
+import random
+import socketserver
+import struct
+import tty
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Optional, Union
+
+from readplanner import encode_register
+from srnecommands import INVERTER_COMMANDS
+
+Number = Union[int, float]
+
+ILLEGAL_FUNCTION = 1
+ILLEGAL_DATA_ADDRESS = 2
+MAX_READ_COUNT = 125
+
+# Engineering values served before the scenario sets them
+DEFAULT_VALUES: dict[str, Number] = {
+    'battery_voltage': 26.1,
+    'battery_current': 0,
+    'battery_charge_power': 0,
+    'battery_soc': 60,
+    'battery_max_charge_current': 40,
+    'battery_type': 4,
+    'battery_boost_charge_voltage': 14.4,
+    'battery_boost_charge_time': 120,
+    'battery_float_charge_voltage': 13.8,
+    'battery_over_discharge_voltage': 10.5,
+    'grid_voltage': 230.0,
+    'grid_input_current': 0,
+    'grid_battery_charge_current': 0,
+    'grid_frequency': 50.0,
+    'grid_battery_charge_max_current': 20,
+    'inverter_voltage': 230.0,
+    'inverter_current': 0,
+    'inverter_frequency': 50.0,
+    'inverter_power': 0,
+    'inverter_output_priority': 2,
+    'inverter_charger_priority': 3,
+    'temp_dc': 32.0,
+    'temp_ac': 35.0,
+    'temp_tr': 38.0,
+}
+
+
+def crc16(data: bytes) -> bytes:
+    """Modbus RTU CRC, low byte first"""
+    crc = 0xffff
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xa001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+class DayCycle():
+    """Scripted waveforms: a PV half-sine day, a fluctuating load and a SoC integrated from both
+
+    period is the length of a simulated day in seconds, so a full cycle
+    can be replayed quickly.
+    """
+
+    def __init__(self, period: float = 600, pv_peak: float = 2500, load_base: float = 400,
+                 load_swing: float = 300, capacity_ah: float = 200, soc: float = 60) -> None:
+        self.period = period
+        self.pv_peak = pv_peak
+        self.load_base = load_base
+        self.load_swing = load_swing
+        self.capacity_ah = capacity_ah
+        self.soc = soc
+
+    def values(self, elapsed: float, step: float) -> dict[str, Number]:
+        phase = (elapsed % self.period) / self.period
+        pv_power = max(0.0, math.sin(2 * math.pi * phase)) * self.pv_peak
+        load = self.load_base + self.load_swing * (0.5 + 0.5 * math.sin(2 * math.pi * phase * 7)) \
+            + random.uniform(-20, 20)
+        battery_voltage = 24.0 + 0.04 * self.soc
+        # Positive register value means the battery is discharging
+        battery_current = (load - pv_power) / battery_voltage
+        self.soc = min(100.0, max(0.0, self.soc - battery_current * step / 3600 / self.capacity_ah * 100))
+        pv_voltage = 90 + 30 * math.sqrt(pv_power / self.pv_peak) if pv_power else 0.0
+        return {
+            'pv_power': round(pv_power),
+            'pv_voltage': pv_voltage,
+            'pv_current': pv_power / pv_voltage if pv_voltage else 0.0,
+            'inverter_power': round(load),
+            'inverter_current': load / 230,
+            'battery_voltage': battery_voltage,
+            'battery_current': battery_current,
+            'battery_charge_power': round(max(0.0, -battery_current * battery_voltage)),
+            'battery_soc': round(self.soc),
+        }
+
+
+class VirtualInverter():
+    def __init__(self, slaveaddress: int = 1, scenario: Optional[DayCycle] = None, latency: float = 0,
+                 baudrate: Optional[int] = None, crc_error_rate: float = 0, timeout_rate: float = 0) -> None:
+        """baudrate adds the transmission time of every frame, None answers at full speed"""
+        self.slaveaddress = slaveaddress
+        self.scenario = scenario
+        self.latency = latency
+        self.baudrate = baudrate
+        self.crc_error_rate = crc_error_rate
+        self.timeout_rate = timeout_rate
+        self.requests = 0
+        self._registers: dict[int, int] = {}
+        self._lock = Lock()
+        self._started = monotonic()
+        self._updated = self._started
+        self.set_values(DEFAULT_VALUES)
+
+    def set_values(self, values: dict[str, Number]) -> None:
+        """Set registers from engineering values keyed by command"""
+        with self._lock:
+            for key, value in values.items():
+                register, decimals, _, signed = INVERTER_COMMANDS[key]
+                self._registers[register] = encode_register(value, decimals, signed)
+
+    def registers(self, start: int, count: int) -> list[int]:
+        with self._lock:
+            return [self._registers.get(register, 0) for register in range(start, start + count)]
+
+    def handle(self, request: bytes) -> Optional[bytes]:
+        """Returns the response frame, None when the slave stays silent"""
+        if len(request) < 4 or crc16(request[:-2]) != request[-2:]:
+            return None
+        address, functioncode = request[0], request[1]
+        if address not in (self.slaveaddress, 0):
+            return None
+        self.requests += 1
+        self._update()
+        if self.baudrate:
+            sleep(len(request) * 11 / self.baudrate)
+        if random.random() < self.timeout_rate:
+            return None
+        payload = self._execute(functioncode, request[2:-2])
+        response = bytes([self.slaveaddress]) + payload
+        response += crc16(response)
+        if random.random() < self.crc_error_rate:
+            response = response[:-1] + bytes([response[-1] ^ 0xff])
+        sleep(self.latency + (len(response) * 11 / self.baudrate if self.baudrate else 0))
+        return None if address == 0 else response
+
+    def _execute(self, functioncode: int, data: bytes) -> bytes:
+        if functioncode in (3, 4):
+            start, count = struct.unpack('>HH', data[:4])
+            if not 1 <= count <= MAX_READ_COUNT:
+                return self._exception(functioncode, ILLEGAL_DATA_ADDRESS)
+            words = self.registers(start, count)
+            return bytes([functioncode, count * 2]) + struct.pack(f'>{count}H', *words)
+        if functioncode == 6:
+            register, value = struct.unpack('>HH', data[:4])
+            with self._lock:
+                self._registers[register] = value
+            return bytes([functioncode]) + data[:4]
+        if functioncode == 16:
+            start, count, size = struct.unpack('>HHB', data[:5])
+            if size != count * 2 or len(data) < 5 + size:
+                return self._exception(functioncode, ILLEGAL_DATA_ADDRESS)
+            values = struct.unpack(f'>{count}H', data[5:5 + size])
+            with self._lock:
+                self._registers.update(zip(range(start, start + count), values))
+            return bytes([functioncode]) + data[:4]
+        return self._exception(functioncode, ILLEGAL_FUNCTION)
+
+    def _exception(self, functioncode: int, code: int) -> bytes:
+        return bytes([functioncode | 0x80, code])
+
+    def _update(self) -> None:
+        if self.scenario is None:
+            return
+        now = monotonic()
+        values = self.scenario.values(now - self._started, now - self._updated)
+        self._updated = now
+        self.set_values(values)
+
+
+def read_frame(read: Callable[[int], bytes]) -> bytes:
+    """Read one request frame from a byte stream, using the function code to find its length"""
+    head = read(2)
+    functioncode = head[1]
+    if functioncode in (3, 4, 6):
+        return head + read(6)
+    if functioncode == 16:
+        body = read(5)
+        return head + body + read(body[4] + 2)
+    return head + read(2)
+
+
+def serve_pty(inverter: VirtualInverter) -> None:
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    print(f"Virtual inverter listening on {os.ttyname(slave)}", flush=True)
+
+    def read(count: int) -> bytes:
+        data = b''
+        while len(data) < count:
+            data += os.read(master, count - len(data))
+        return data
+
+    while True:
+        response = inverter.handle(read_frame(read))
+        if response is not None:
+            os.write(master, response)
+
+
+def serve_tcp(inverter: VirtualInverter, host: str = '127.0.0.1', port: int = 5020) -> None:
+    """Serve RTU framed requests (RTU over TCP) to any number of connections"""
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self) -> None:
+            def read(count: int) -> bytes:
+                data = b''
+                while len(data) < count:
+                    chunk = self.request.recv(count - len(data))
+                    if not chunk:
+                        raise ConnectionError()
+                    data += chunk
+                return data
+
+            try:
+                while True:
+                    response = inverter.handle(read_frame(read))
+                    if response is not None:
+                        self.request.sendall(response)
+            except ConnectionError:
+                pass
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((host, port), Handler) as server:
+        print(f"Virtual inverter listening on {host}:{port}", flush=True)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Virtual SRNE inverter (Modbus RTU slave)")
+    parser.add_argument('--pty', action='store_true', help="serve on a pseudo terminal (default)")
+    parser.add_argument('--tcp', type=int, metavar='PORT', help="serve RTU frames over TCP on this port")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--slave', type=int, default=1, help="slave address")
+    parser.add_argument('--latency', type=float, default=0.0, help="extra seconds before every response")
+    parser.add_argument('--baud', type=int, help="emulate the transmission time at this baudrate")
+    parser.add_argument('--crc-errors', type=float, default=0.0, help="fraction of responses with a bad CRC")
+    parser.add_argument('--timeouts', type=float, default=0.0, help="fraction of requests left unanswered")
+    parser.add_argument('--day', type=float, default=600, help="length of a simulated day in seconds")
+    parser.add_argument('--static', action='store_true', help="serve the default values without a scenario")
+    args = parser.parse_args()
+
+    virtual = VirtualInverter(args.slave, None if args.static else DayCycle(args.day), args.latency,
+                              args.baud, args.crc_errors, args.timeouts)
+    if args.tcp:
+        serve_tcp(virtual, args.host, args.tcp)
+    else:
+        serve_pty(virtual)
@@ -0,0 +1,119 @@
+"""
+Bounded on-disk message spool
+
+Messages that could not be published are appended as JSON lines to
+numbered segment files. When the spool grows past its size limit the
+oldest segment is deleted, so an outage loses the oldest backlog first.
+Messages are read back oldest first; a segment is deleted once it has
+been read completely. The read position is only kept in memory, so
+after a restart the oldest segment is sent again (at least once). A
+line cut short by a crash while appending is truncated away on load.
+"""
+import json
+import os
+from typing import Any, NamedTuple, Optional
+
+SEGMENT_SUFFIX = '.spool'
+MAX_SPOOL_BYTES = 16 * 1024 * 1024
+SEGMENT_BYTES = 256 * 1024
+
+
+class SpooledMessage(NamedTuple):
+    topic: str
+    payload: str
+    qos: int = 0
+    retain: bool = False
+
+
+class DiskSpool():
+    """Not thread-safe, used from the publisher thread only"""
+
+    def __init__(self, root: str, max_bytes: int = MAX_SPOOL_BYTES, segment_bytes: int = SEGMENT_BYTES) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.dropped_segments = 0
+        os.makedirs(root, exist_ok=True)
+        names = sorted(name for name in os.listdir(root) if name.endswith(SEGMENT_SUFFIX))
+        self._segments: dict[int, int] = {
+            int(name.removesuffix(SEGMENT_SUFFIX)): os.path.getsize(os.path.join(root, name)) for name in names
+        }
+        self._offset = 0  # Read position in the oldest segment
+        self._next_offset = 0
+        if self._segments:
+            self._truncate_partial_line(max(self._segments))
+
+    def _path(self, sequence: int) -> str:
+        return os.path.join(self.root, f'{sequence:08d}{SEGMENT_SUFFIX}')
+
+    @property
+    def size(self) -> int:
+        """Bytes on disk, including the part of the oldest segment already read"""
+        return sum(self._segments.values())
+
+    @property
+    def pending(self) -> bool:
+        return self.size > self._offset
+
+    def append(self, message: SpooledMessage) -> None:
+        line = (json.dumps(message._asdict(), separators=(',', ':')) + '\n').encode()
+        if not self._segments or self._segments[max(self._segments)] + len(line) > self.segment_bytes:
+            self._segments[max(self._segments, default=-1) + 1] = 0
+        tail = max(self._segments)
+        with open(self._path(tail), 'ab') as segment:
+            segment.write(line)
+        self._segments[tail] += len(line)
+        while self.size > self.max_bytes and len(self._segments) > 1:
+            self._drop_oldest()
+            self.dropped_segments += 1
+
+    def peek(self) -> Optional[SpooledMessage]:
+        """Oldest unsent message, None when the spool is empty"""
+        while self._segments:
+            oldest = min(self._segments)
+            with open(self._path(oldest), 'rb') as segment:
+                segment.seek(self._offset)
+                line = segment.readline()
+            if not line.endswith(b'\n'):
+                if oldest == max(self._segments):
+                    return None
+                # Fully read, or cut short by a crash while writing
+                self._drop_oldest()
+                continue
+            self._next_offset = self._offset + len(line)
+            try:
+                return SpooledMessage(**json.loads(line))
+            except (ValueError, TypeError):
+                self._offset = self._next_offset
+        return None
+
+    def pop(self) -> None:
+        """Mark the message returned by peek() as sent"""
+        self._offset = self._next_offset
+        oldest = min(self._segments, default=None)
+        if oldest is not None and self._offset >= self._segments[oldest]:
+            self._drop_oldest()
+
+    def _truncate_partial_line(self, sequence: int) -> None:
+        """Cut a segment back to its last complete line, so appends start on a clean line"""
+        path = self._path(sequence)
+        with open(path, 'rb+') as segment:
+            data = segment.read()
+            size = data.rfind(b'\n') + 1
+            if size < len(data):
+                segment.truncate(size)
+        if size:
+            self._segments[sequence] = size
+        else:
+            del self._segments[sequence]
+            os.remove(path)
+
+    def _drop_oldest(self) -> None:
+        oldest = min(self._segments)
+        del self._segments[oldest]
+        os.remove(self._path(oldest))
+        self._offset = 0
+        self._next_offset = 0
+
+    def info(self) -> dict[str, Any]:
+        return {'bytes': self.size, 'segments': len(self._segments), 'dropped_segments': self.dropped_segments}
@@ -0,0 +1,208 @@
+"""
+Serial port supervision
+
+`SerialSupervisor` stands in for the serial port of the inverters on one
+bus (pass it as the `transport` of `SRNEInverter`). The real port is only
+opened by the first transaction, so the service starts without the
+adapter. I/O errors, a run of timeouts while the device node is gone, or
+a longer run of timeouts close the port; it is reopened by a later
+transaction once the backoff delay (doubling up to `max_backoff`) has
+passed, and transactions in between fail right away instead of waiting
+for a timeout.
+
+USB adapters can re-enumerate under another name (ttyUSB0 becomes
+ttyUSB1). The port is opened through its /dev/serial/by-id link when
+there is one, so it is found again after replugging.
+"""
+import glob
+import os
+from threading import Lock
+from time import monotonic
+from typing import Any, Optional
+
+import serial
+from metrics import Counter, Gauge
+
+try:
+    import termios
+    # pyserial lets termios errors of a vanished tty through (tcflush)
+    PORT_ERRORS: tuple[type[Exception], ...] = (OSError, termios.error)
+except ImportError:  # Windows
+    PORT_ERRORS = (OSError,)
+
+BY_ID_PATTERN = '/dev/serial/by-id/*'
+
+MISSING_TIMEOUTS = 3  # consecutive timeouts after which a missing device node closes the port
+REOPEN_TIMEOUTS = 10  # consecutive timeouts after which the port is reopened anyway
+MIN_BACKOFF = 0.1  # second
+MAX_BACKOFF = 1.0  # second
+
+PORT_OPENS = Counter('srne_port_opens', "Serial port opens by outcome", ('port', 'outcome'))
+PORT_CONNECTED = Gauge('srne_port_connected', "1 while the serial port is open", ('port',))
+
+
+def stable_path(port: str, pattern: str = BY_ID_PATTERN) -> str:
+    """The /dev/serial/by-id link of a device node, the port itself if there is none"""
+    target = os.path.realpath(port)
+    for link in sorted(glob.glob(pattern)):
+        if os.path.realpath(link) == target:
+            return link
+    return port
+
+
+class SerialSupervisor():
+    def __init__(self, port: str, baudrate: int = 9600, timeout: float = 1,
+                 min_backoff: float = MIN_BACKOFF, max_backoff: float = MAX_BACKOFF) -> None:
+        self.port = port
+        self._baudrate = baudrate
+        self._timeout = timeout
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._serial: Optional[serial.Serial] = None
+        self._paths = [port]  # stable path first once it is known
+        self._path: Optional[str] = None
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        self._timeouts = 0
+        self._failures = 0
+        self._error: Optional[str] = None
+        self._lock = Lock()
+        # Always reported open, minimalmodbus refuses ports that are not
+        self.is_open = True
+
+    # region Serial port interface used by minimalmodbus
+
+    @property
+    def baudrate(self) -> int:
+        return self._baudrate
+
+    @baudrate.setter
+    def baudrate(self, value: int) -> None:
+        self._baudrate = value
+        if self._serial is not None:
+            self._serial.baudrate = value
+
+    @property
+    def timeout(self) -> float:
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, value: float) -> None:
+        self._timeout = value
+        if self._serial is not None:
+            self._serial.timeout = value
+
+    def open(self) -> None:
+        self.is_open = True
+
+    def close(self) -> None:
+        """Close the real port, the next transaction opens it again"""
+        with self._lock:
+            self._close()
+
+    def reset_input_buffer(self) -> None:
+        self._call('reset_input_buffer')
+
+    def reset_output_buffer(self) -> None:
+        self._call('reset_output_buffer')
+
+    def flush(self) -> None:
+        self._call('flush')
+
+    def write(self, data: bytes) -> Optional[int]:
+        return self._call('write', data)
+
+    def read(self, size: int = 1) -> bytes:
+        data = self._call('read', size)
+        if len(data) < size:
+            self._timed_out()
+        else:
+            self._timeouts = 0
+            self._failures = 0
+            self._backoff = 0.0
+        return data
+
+    # endregion
+
+    def status(self) -> dict[str, Any]:
+        return {
+            'port': self.port,
+            'path': self._path,
+            'connected': self._serial is not None,
+            'failures': self._failures,
+            'retryIn': round(max(self._retry_at - monotonic(), 0), 3) if self._serial is None else 0,
+            'error': self._error,
+        }
+
+    def _call(self, method: str, *args: Any) -> Any:
+        port = self._connect()
+        try:
+            return getattr(port, method)(*args)
+        except PORT_ERRORS as e:
+            self._fail(e)
+            if isinstance(e, OSError):
+                raise
+            raise serial.SerialException(f"Port {self.port} failed: {e}") from e
+
+    def _connect(self) -> serial.Serial:
+        """The open port, opened now if the backoff allows it
+        Raises SerialException while the port is unavailable
+        """
+        with self._lock:
+            if self._serial is not None:
+                return self._serial
+            if monotonic() < self._retry_at:
+                raise serial.SerialException(f"Port {self.port} is unavailable: {self._error}")
+            for path in self._paths:
+                if not os.path.exists(path):
+                    continue
+                try:
+                    self._serial = serial.Serial(port=path, baudrate=self._baudrate, bytesize=8,
+                                                 parity=serial.PARITY_NONE, stopbits=1,
+                                                 timeout=self._timeout, write_timeout=2.0)
+                except PORT_ERRORS as e:
+                    self._error = str(e)
+                    continue
+                self._path = path
+                stable = stable_path(path)
+                self._paths = [stable, self.port] if stable != self.port else [self.port]
+                self._error = None
+                self._timeouts = 0
+                PORT_OPENS.inc((self.port, 'ok'))
+                PORT_CONNECTED.set(1, (self.port,))
+                return self._serial
+            if not any(os.path.exists(path) for path in self._paths):
+                self._error = "Device node not found."
+            PORT_OPENS.inc((self.port, 'error'))
+            self._schedule_retry()
+            raise serial.SerialException(f"Port {self.port} is unavailable: {self._error}")
+
+    def _timed_out(self) -> None:
+        self._timeouts += 1
+        missing = self._path is not None and not os.path.exists(self._path)
+        if (missing and self._timeouts >= MISSING_TIMEOUTS) or self._timeouts >= REOPEN_TIMEOUTS:
+            with self._lock:
+                self._error = "Device node disappeared." if missing else "Repeated timeouts."
+                self._close()
+                self._schedule_retry()
+
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            self._error = str(error)
+            self._close()
+            self._schedule_retry()
+
+    def _schedule_retry(self) -> None:
+        self._failures += 1
+        self._backoff = min(max(self._backoff * 2, self._min_backoff), self._max_backoff)
+        self._retry_at = monotonic() + self._backoff
+
+    def _close(self) -> None:
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except PORT_ERRORS:
+                pass
+            self._serial = None
+            PORT_CONNECTED.set(0, (self.port,))
+        self._timeouts = 0
@@ -0,0 +1,443 @@
+"""
+Persistent telemetry store
+
+Records are buffered in memory and written in batches to append-only
+segment files, one per UTC day. Each batch is a zlib compressed block:
+timestamps are stored as delta-of-delta milliseconds and every metric as
+delta encoded integers, scaled by the decimals of its register. A small
+fixed-size index next to each segment keeps the time range, position and
+min/max/sum/count per metric of every block, so range lookups only touch
+the blocks they need (read through mmap) and coarse summaries over long
+ranges are answered from the index alone.
+
+Queries decode only the requested columns of a block, the varints of the
+others are skipped. With NumPy the varints of a column are decoded in one
+vectorized pass (byte groups found from the continuation bits, summed
+with reduceat, then the running sums); without it byte by byte.
+
+Blocks are written by a background thread; a failed write is logged and
+counted in srne_store_write_errors, its samples are lost.
+"""
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from time import gmtime, monotonic, strftime, time
+from typing import Any, Iterable, Iterator, Optional, Sequence
+
+from metrics import Counter
+from records import METRIC_DECIMALS, RECORD_METRICS, record_metrics
+
+try:
+    import numpy as np
+except ImportError:  # Blocks are decoded varint by varint
+    np = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SRNESEG1'
+SEGMENT_HEADER = struct.Struct('<8sI')
+# first timestamp, last timestamp, block offset, block length, sample count
+INDEX_ENTRY = struct.Struct('<ddQII')
+# min, max, sum, count of one metric in a block
+INDEX_SUMMARY = struct.Struct('<dddd')
+
+DEFAULT_DECIMALS = 2
+DEFAULT_BATCH_SIZE = 300  # samples per block
+DEFAULT_FLUSH_INTERVAL = 300  # second
+
+STORE_WRITE_ERRORS = Counter('srne_store_write_errors', "Telemetry blocks that could not be written")
+
+
+# region Encoding
+
+def _zigzag(value: int) -> int:
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    value = _zigzag(value)
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return _unzigzag(value), position
+        shift += 7
+
+
+def encode_block(times: list[float], columns: list[list[float]], decimals: list[int]) -> bytes:
+    """Encode a batch of samples, columns hold one list of floats (NaN if missing) per metric"""
+    out = bytearray()
+    _write_varint(out, len(times))
+    previous = 0
+    delta = 0
+    for timestamp in times:
+        millis = round(timestamp * 1000)
+        _write_varint(out, millis - previous - delta)
+        delta = millis - previous
+        previous = millis
+    for column, places in zip(columns, decimals):
+        missing = [math.isnan(value) for value in column]
+        if any(missing):
+            out.append(1)
+            bitmap = bytearray((len(column) + 7) // 8)
+            for index, flag in enumerate(missing):
+                if flag:
+                    bitmap[index // 8] |= 1 << (index % 8)
+            out += bitmap
+        else:
+            out.append(0)
+        scale = 10 ** places
+        previous = 0
+        for value, flag in zip(column, missing):
+            if not flag:
+                scaled = round(value * scale)
+                _write_varint(out, scaled - previous)
+                previous = scaled
+    return zlib.compress(bytes(out))
+
+
+def _skip_varints(data: bytes, position: int, count: int) -> int:
+    for _ in range(count):
+        while data[position] & 0x80:
+            position += 1
+        position += 1
+    return position
+
+
+def _read_varints(data: bytes, position: int, count: int) -> tuple[list[int], int]:
+    values = []
+    for _ in range(count):
+        value, position = _read_varint(data, position)
+        values.append(value)
+    return values, position
+
+
+def _read_varints_numpy(buffer: "np.ndarray", ends: "np.ndarray", position: int,
+                        count: int) -> tuple["np.ndarray", int]:
+    """count varints from position; ends holds the positions of all bytes without continuation bit"""
+    if count == 0:
+        return np.zeros(0, dtype=np.int64), position
+    stops = ends[np.searchsorted(ends, position):][:count]
+    starts = np.empty(count, dtype=np.int64)
+    starts[0] = position
+    starts[1:] = stops[:-1] + 1
+    end = int(stops[-1]) + 1
+    groups = buffer[position:end].astype(np.uint64) & 0x7f
+    shifts = (np.arange(position, end) - np.repeat(starts, stops - starts + 1)) * 7
+    zigzag = np.add.reduceat(groups << shifts.astype(np.uint64), starts - position)
+    return (zigzag >> 1).astype(np.int64) ^ -(zigzag & 1).astype(np.int64), end
+
+
+def decode_block(data: bytes, decimals: list[int],
+                 wanted: Optional[Sequence[int]] = None) -> tuple[Any, list[Any]]:
+    """Returns the timestamps and the columns (NaN if missing) of a block, as NumPy arrays when installed
+    wanted limits decoding to the columns at those positions, the others are None
+    """
+    data = zlib.decompress(data)
+    wanted = set(range(len(decimals)) if wanted is None else wanted)
+    count, position = _read_varint(data, 0)
+    if np is not None:
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(buffer < 0x80)
+        deltas, position = _read_varints_numpy(buffer, ends, position, count)
+        times = np.cumsum(np.cumsum(deltas)) / 1000
+    else:
+        deltas, position = _read_varints(data, position, count)
+        times = []
+        previous = 0
+        delta = 0
+        for value in deltas:
+            delta += value
+            previous += delta
+            times.append(previous / 1000)
+    columns: list[Any] = []
+    for index, places in enumerate(decimals):
+        bitmap = b''
+        if data[position]:
+            bitmap = data[position + 1:position + 1 + (count + 7) // 8]
+            position += len(bitmap)
+        position += 1
+        present = count - bin(int.from_bytes(bitmap, 'little')).count('1')
+        if index not in wanted:
+            if np is None:
+                position = _skip_varints(data, position, present)
+            elif present:
+                position = int(ends[np.searchsorted(ends, position) + present - 1]) + 1
+            columns.append(None)
+            continue
+        scale = 10 ** places
+        if np is not None:
+            deltas, position = _read_varints_numpy(buffer, ends, position, present)
+            column = np.cumsum(deltas) / scale
+            if present < count:
+                missing = np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), count=count, bitorder='little')
+                values, column = column, np.full(count, np.nan)
+                column[missing == 0] = values
+        else:
+            deltas, position = _read_varints(data, position, present)
+            column = []
+            previous = 0
+            flags = (bool(bitmap[sample // 8] & (1 << (sample % 8))) for sample in range(count)) if bitmap else iter(())
+            for value in deltas:
+                while next(flags, False):
+                    column.append(math.nan)
+                previous += value
+                column.append(previous / scale)
+            column += [math.nan] * (count - len(column))
+        columns.append(column)
+    return times, columns
+
+# endregion
+
+
+class Segment():
+    """Append-only block file of one UTC day, with its index"""
+
+    def __init__(self, path: str, metrics: Optional[tuple[str, ...]] = None,
+                 decimals: Optional[list[int]] = None) -> None:
+        self.path = path
+        self.index_path = path[:-len('.seg')] + '.idx'
+        if os.path.exists(path):
+            with open(path, 'rb') as segment:
+                magic, length = SEGMENT_HEADER.unpack(segment.read(SEGMENT_HEADER.size))
+                if magic != MAGIC:
+                    raise ValueError(f"{path} is not a telemetry segment.")
+                schema = json.loads(segment.read(length))
+            self.metrics = tuple(schema['metrics'])
+            self.decimals = list(schema['decimals'])
+        elif metrics is None or decimals is None:
+            raise FileNotFoundError(path)
+        else:
+            self.metrics = metrics
+            self.decimals = decimals
+            schema = json.dumps({'metrics': self.metrics, 'decimals': self.decimals}).encode()
+            with open(path, 'wb') as segment:
+                segment.write(SEGMENT_HEADER.pack(MAGIC, len(schema)) + schema)
+        self._entry_size = INDEX_ENTRY.size + INDEX_SUMMARY.size * len(self.metrics)
+
+    def append(self, times: list[float], columns: list[list[float]]) -> None:
+        block = encode_block(times, columns, self.decimals)
+        with open(self.path, 'ab') as segment:
+            offset = segment.tell()
+            segment.write(block)
+        entry = bytearray(INDEX_ENTRY.pack(times[0], times[-1], offset, len(block), len(times)))
+        for column in columns:
+            values = [value for value in column if not math.isnan(value)]
+            if values:
+                entry += INDEX_SUMMARY.pack(min(values), max(values), sum(values), len(values))
+            else:
+                entry += INDEX_SUMMARY.pack(math.nan, math.nan, 0.0, 0)
+        # The index is written after the block, a crash in between only loses this block
+        with open(self.index_path, 'ab') as index:
+            index.write(entry)
+
+    def entries(self) -> Iterator[tuple[float, float, int, int, int, list[tuple[float, ...]]]]:
+        """Yields (first, last, offset, length, count, summaries) for every indexed block"""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as index:
+            data = index.read()
+        for start in range(0, len(data) - self._entry_size + 1, self._entry_size):
+            first, last, offset, length, count = INDEX_ENTRY.unpack_from(data, start)
+            summaries = [INDEX_SUMMARY.unpack_from(data, start + INDEX_ENTRY.size + INDEX_SUMMARY.size * column)
+                         for column in range(len(self.metrics))]
+            yield first, last, offset, length, count, summaries
+
+    def read(self, start: float, end: float, wanted: Optional[Sequence[int]] = None) -> Iterator[tuple[Any, list[Any]]]:
+        """Yields the decoded blocks overlapping [start, end], see decode_block()"""
+        blocks = [(offset, length) for first, last, offset, length, _, _ in self.entries()
+                  if last >= start and first <= end]
+        if not blocks:
+            return
+        with open(self.path, 'rb') as segment, mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset, length in blocks:
+                yield decode_block(mapped[offset:offset + length], self.decimals, wanted)
+
+
+class TelemetryStore():
+    def __init__(self, root: str, metrics: Iterable[str] = RECORD_METRICS,
+                 decimals: Optional[dict[str, int]] = None, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL) -> None:
+        """decimals sets how many decimal places are kept per metric, taken from the register map by default"""
+        self.root = root
+        self.metrics = tuple(metrics)
+        decimals = METRIC_DECIMALS if decimals is None else decimals
+        self._decimals = [decimals.get(metric, DEFAULT_DECIMALS) for metric in self.metrics]
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._times: list[float] = []
+        self._rows: list[list[float]] = []
+        self._day: Optional[str] = None
+        self._inflight: list[tuple[list[float], list[list[float]]]] = []
+        self._last_flush = monotonic()
+        self._lock = Lock()
+        self._writer = ThreadPoolExecutor(1, 'srne-store')
+        os.makedirs(root, exist_ok=True)
+
+    def append(self, record: dict[str, Any], timestamp: Optional[float] = None) -> None:
+        """Buffer a record, full batches are written by a background thread"""
+        timestamp = time() if timestamp is None else timestamp
+        day = _day(timestamp)
+        with self._lock:
+            if self._day is not None and day != self._day:
+                self._flush_locked()
+            self._day = day
+            self._times.append(timestamp)
+            self._rows.append(record_metrics(record, self.metrics))
+            if len(self._times) >= self._batch_size or monotonic() - self._last_flush >= self._flush_interval:
+                self._flush_locked()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush_locked()
+
+    def close(self) -> None:
+        self.flush()
+        self._writer.shutdown()
+
+    def query(self, start: float, end: float, metrics: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Returns the samples between start and end (inclusive) as columns"""
+        metrics = self._check_metrics(metrics)
+        # Samples not written yet are taken first, anything from their start on is skipped in the segments
+        with self._lock:
+            batches = [*self._inflight, (self._times, self._rows)]
+            pending = [(timestamp, row) for batch_times, rows in batches for timestamp, row in zip(batch_times, rows)]
+        cutoff = pending[0][0] if pending else math.inf
+        times: list[float] = []
+        values: dict[str, list[Optional[float]]] = {metric: [] for metric in metrics}
+        for segment in self._segments(start, end):
+            positions = [segment.metrics.index(metric) if metric in segment.metrics else None for metric in metrics]
+            wanted = [position for position in positions if position is not None]
+            for block_times, columns in segment.read(start, end, wanted):
+                if np is not None:
+                    selected = np.flatnonzero((block_times >= start) & (block_times <= end) & (block_times < cutoff))
+                    times += block_times[selected].tolist()
+                    for metric, position in zip(metrics, positions):
+                        values[metric] += _nullable(columns[position][selected]) if position is not None \
+                            else [None] * len(selected)
+                    continue
+                selected = [index for index, timestamp in enumerate(block_times)
+                            if start <= timestamp <= end and timestamp < cutoff]
+                times += [block_times[index] for index in selected]
+                for metric, position in zip(metrics, positions):
+                    column = columns[position] if position is not None else None
+                    values[metric] += [None if column is None or math.isnan(column[index]) else column[index]
+                                       for index in selected]
+        positions = [self.metrics.index(metric) for metric in metrics]
+        for timestamp, row in pending:
+            if start <= timestamp <= end:
+                times.append(timestamp)
+                for metric, position in zip(metrics, positions):
+                    values[metric].append(None if math.isnan(row[position]) else row[position])
+        return {'t': times, 'values': values}
+
+    def summary(self, start: float, end: float, bucket: float,
+                metrics: Optional[Iterable[str]] = None) -> dict[str, Any]:
+        """Returns min, max and mean per bucket using only the block index
+        Blocks are assigned to the bucket of their first sample, so buckets
+        shorter than a block are effectively widened to the block length
+        """
+        if bucket <= 0:
+            raise ValueError("Bucket size should be greater than 0.")
+        metrics = self._check_metrics(metrics)
+        origin = start - start % bucket
+        buckets: dict[float, dict[str, list[float]]] = {}
+        for segment in self._segments(start, end):
+            positions = [segment.metrics.index(metric) if metric in segment.metrics else None for metric in metrics]
+            for first, last, _, _, _, summaries in segment.entries():
+                if last < start or first > end:
+                    continue
+                key = origin + (first - origin) // bucket * bucket
+                totals = buckets.setdefault(key, {metric: [math.inf, -math.inf, 0.0, 0] for metric in metrics})
+                for metric, position in zip(metrics, positions):
+                    if position is None:
+                        continue
+                    low, high, total, count = summaries[position]
+                    if count:
+                        aggregate = totals[metric]
+                        aggregate[0] = min(aggregate[0], low)
+                        aggregate[1] = max(aggregate[1], high)
+                        aggregate[2] += total
+                        aggregate[3] += count
+        keys = sorted(buckets)
+        result: dict[str, Any] = {'t': keys, 'min': {}, 'max': {}, 'mean': {}}
+        for metric in metrics:
+            aggregates = [buckets[key][metric] for key in keys]
+            result['min'][metric] = [low if count else None for low, _, _, count in aggregates]
+            result['max'][metric] = [high if count else None for _, high, _, count in aggregates]
+            result['mean'][metric] = [total / count if count else None for _, _, total, count in aggregates]
+        return result
+
+    def _check_metrics(self, metrics: Optional[Iterable[str]]) -> tuple[str, ...]:
+        metrics = self.metrics if metrics is None else tuple(metrics)
+        unknown = set(metrics).difference(self.metrics)
+        if unknown:
+            raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))}")
+        return metrics
+
+    def _segments(self, start: float, end: float) -> Iterator[Segment]:
+        first = _day(max(start, 0))
+        last = _day(max(end, 0))
+        for name in sorted(os.listdir(self.root)):
+            if name.endswith('.seg') and first <= name[:-len('.seg')] <= last:
+                yield Segment(os.path.join(self.root, name))
+
+    def _flush_locked(self) -> None:
+        if self._times:
+            batch = (self._times, self._rows)
+            self._inflight.append(batch)
+            future = self._writer.submit(self._write, os.path.join(self.root, f'{self._day}.seg'), batch)
+            future.add_done_callback(_report_write)
+            self._times = []
+            self._rows = []
+        self._last_flush = monotonic()
+
+    def _write(self, path: str, batch: tuple[list[float], list[list[float]]]) -> None:
+        times, rows = batch
+        try:
+            segment = Segment(path, self.metrics, self._decimals)
+            # Segments created by an older schema keep their own column layout
+            positions = [self.metrics.index(metric) if metric in self.metrics else None for metric in segment.metrics]
+            columns = [[row[position] if position is not None else math.nan for row in rows] for position in positions]
+            segment.append(times, columns)
+        finally:
+            with self._lock:
+                self._inflight.remove(batch)
+
+
+def _nullable(column: "np.ndarray") -> list[Optional[float]]:
+    """Values of a float array with None for NaN"""
+    values = column.astype(object)
+    values[np.isnan(column)] = None
+    return values.tolist()
+
+
+def _report_write(future: "Future[None]") -> None:
+    error = None if future.cancelled() else future.exception()
+    if error is not None:
+        STORE_WRITE_ERRORS.inc()
+        logger.error("Telemetry block could not be written", exc_info=error)
+
+
+def _day(timestamp: float) -> str:
+    return strftime('%Y%m%d', gmtime(timestamp))
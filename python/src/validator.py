@@ -1,4 +1,6 @@
-from typing import Union
+from typing import Any, Union
+
+from srnecommands import WRITE_LIMITS
 
 Number = Union[int, float]
 
@@ -50,4 +52,15 @@ class Validator():
             return {
                 'message': self._error,
                 'validation': self._validator
-            }
\ No newline at end of file
+            }
+
+
+def validate_command(key: str, value: Any,
+                     limits: dict[str, tuple[Number, Number, Number]] = WRITE_LIMITS) -> Union[bool, dict[str, str]]:
+    """Validate the value of a write command against its (minimum, maximum, multiple) limits"""
+    if key not in limits:
+        return {'message': f"Unknown command '{key}'.", 'validation': 'command'}
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return {'message': "Value should be a number.", 'validation': 'type'}
+    minimum, maximum, multiple = limits[key]
+    return Validator(value).maximum(maximum).minimum(minimum).multiple(multiple).validate()